@@ -0,0 +1,98 @@
+"""
+Compare the conversion throughput and peak memory of two git revisions.
+
+Each revision is checked out in a temporary git worktree and measured in its own
+interpreter on the same fixed-seed data file, with the measurement code of this
+checkout. "." is the working tree, including uncommitted changes.
+
+    python benchmarks/compare.py origin/master . --sessions 20000
+"""
+
+import argparse
+import json
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PERF_MODULE = os.path.join(REPO_DIR, "benchmarks", "perf.py")
+MODES = {"rows": 0, "batches": 1000}
+
+
+def measure(revision_dir, data_file, batch_size, repeat):
+    # PYTHONPATH puts the revision's package ahead of an installed one
+    env = dict(os.environ, PYTHONPATH=revision_dir)
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run", "--data-file", data_file,
+         "--batch-size", str(batch_size), "--repeat", str(repeat)],
+        check=True, capture_output=True, text=True, cwd=revision_dir, env=env,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def measure_revision(revision, work_dir, data_file, repeat):
+    if revision == ".":
+        revision_dir = REPO_DIR
+    else:
+        revision_dir = os.path.join(work_dir, revision.replace("/", "_"))
+        subprocess.run(["git", "worktree", "add", "--detach", revision_dir, revision],
+                       check=True, cwd=REPO_DIR, capture_output=True)
+    try:
+        return {mode: measure(revision_dir, data_file, batch_size, repeat)
+                for mode, batch_size in MODES.items()}
+    finally:
+        if revision_dir != REPO_DIR:
+            subprocess.run(["git", "worktree", "remove", "--force", revision_dir],
+                           check=True, cwd=REPO_DIR)
+
+
+def change(base, head):
+    return f"{(head - base) / base:+.1%}" if base else "n/a"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base", nargs="?")
+    parser.add_argument("head", nargs="?", default=".")
+    parser.add_argument("--sessions", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--data-file", help=argparse.SUPPRESS)
+    parser.add_argument("--batch-size", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # the revision may not have perf.py, so this checkout's copy is run
+        measure_transform = runpy.run_path(PERF_MODULE)["measure_transform"]
+        print(json.dumps(measure_transform(args.data_file, args.batch_size, args.repeat)))
+        return 0
+    if args.base is None:
+        parser.error("the base revision is required")
+
+    from leanplum_data_export.synthetic import write_ndjson
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_file = os.path.join(work_dir, "data.ndjson")
+        write_ndjson(data_file, args.sessions, args.seed)
+
+        results = {revision: measure_revision(revision, work_dir, data_file, args.repeat)
+                   for revision in (args.base, args.head)}
+
+    base, head = results[args.base], results[args.head]
+    print(f"{args.sessions:,} sessions, seed {args.seed}: {args.base} -> {args.head}")
+    print(f"{'mode':<8} {'sessions/s':>24} {'change':>8} {'peak MB':>18} {'change':>8}")
+    for mode in MODES:
+        print(f"{mode:<8} "
+              f"{base[mode]['sessions_per_second']:>11,} {head[mode]['sessions_per_second']:>12,} "
+              f"{change(base[mode]['sessions_per_second'], head[mode]['sessions_per_second']):>8} "
+              f"{base[mode]['peak_memory_mb']:>9} {head[mode]['peak_memory_mb']:>8} "
+              f"{change(base[mode]['peak_memory_mb'], head[mode]['peak_memory_mb']):>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
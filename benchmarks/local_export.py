@@ -0,0 +1,63 @@
+"""
+Run a full export of a synthetic day on this machine, with local directories in place
+of S3 and GCS and SQLite in place of BigQuery, and report the time of each phase.
+
+    python benchmarks/local_export.py --files 8 --sessions-per-file 50000 --nested --rollups
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from leanplum_data_export.local import LocalExporter
+from leanplum_data_export.synthetic import write_export_files
+
+DATE = "20200601"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--sessions-per-file", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=0)
+    parser.add_argument("--nested", action="store_true")
+    parser.add_argument("--rollups", action="store_true")
+    parser.add_argument("--work-dir", default=None,
+                        help="Keep the data, stage and database here instead of a temp dir")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.work_dir or temp_dir
+        source_dir = os.path.join(work_dir, "source")
+        database = os.path.join(work_dir, "leanplum.db")
+
+        start = time.perf_counter()
+        paths = write_export_files(os.path.join(source_dir, "bench"), DATE, args.files,
+                                   args.sessions_per_file)
+        size = sum(os.path.getsize(path) for path in paths)
+        print(f"generated {size / 2 ** 20:,.0f}MB in {time.perf_counter() - start:.2f}s")
+
+        exporter = LocalExporter(database, batch_size=args.batch_size, nested=args.nested,
+                                 rollups=args.rollups)
+        start = time.perf_counter()
+        exporter.export(DATE, source_dir, os.path.join(work_dir, "stage"), "bench",
+                        "leanplum", "", "1", True)
+        seconds = time.perf_counter() - start
+
+        sessions = args.files * args.sessions_per_file
+        print(f"exported {sessions:,} sessions in {seconds:.2f}s "
+              f"({sessions / seconds:,.0f} sessions/s, {size / 2 ** 20 / seconds:,.1f}MB/s)")
+
+        with sqlite3.connect(database) as connection:
+            loaded = connection.execute(
+                'SELECT COUNT(*) FROM "leanplum.sessions_v1"').fetchone()[0]
+        print(f"loaded sessions: {loaded:,}")
+        return 0 if loaded == sessions else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
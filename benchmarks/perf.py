@@ -0,0 +1,111 @@
+"""
+Throughput and peak memory of converting a data file, for the performance tests and
+benchmarks/compare.py, which load this file with runpy.
+
+Only the exporter's constructor and transform_data_file are used, with the data file
+"downloaded" from local disk, so that revisions from before the current exporter
+can be measured with the same code.
+
+Throughput is also given relative to a calibration loop of JSON parsing and CSV writing
+timed in the same process, which cancels out most of the speed of the machine, so that
+a baseline recorded on one machine can be checked on another.
+"""
+
+import contextlib
+import csv
+import io
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+from typing import Dict
+from unittest import mock
+
+DATA_FILE_KEY = "perf/20200601/export-0-output-0"
+CALIBRATION_RECORDS = 20000
+
+
+class LocalDataFile(object):
+    """
+    S3 client that downloads one local data file, whatever the key
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def download_file(self, bucket, key, filename, Config=None):
+        shutil.copyfile(self.path, filename)
+
+
+def create_exporter(batch_size: int = 0):
+    from leanplum_data_export.export import LeanplumExporter
+
+    # earlier revisions create their clients in the constructor
+    with contextlib.ExitStack() as stack:
+        for client in ["boto3.client", "google.cloud.bigquery.Client",
+                       "google.cloud.storage.Client"]:
+            stack.enter_context(mock.patch(client))
+        exporter = LeanplumExporter("perf")
+    exporter.batch_size = batch_size
+    return exporter
+
+
+def measure_calibration(repeat: int = 3) -> float:
+    """
+    Records per second of a fixed loop that parses JSON and writes CSV rows, like
+    conversion does, from the fastest of repeat runs
+    """
+    lines = [json.dumps({"id": i, "name": f"event-{i % 50}", "time": 1590969600.0 + i,
+                         "values": {str(j): j * i for j in range(5)}})
+             for i in range(CALIBRATION_RECORDS)]
+
+    timings = []
+    for _ in range(repeat):
+        writer = csv.writer(io.StringIO())
+        start = time.perf_counter()
+        for line in lines:
+            record = json.loads(line)
+            writer.writerow([record["id"], record["name"], record["time"],
+                             *record["values"].values()])
+        timings.append(time.perf_counter() - start)
+    return CALIBRATION_RECORDS / min(timings)
+
+
+def measure_transform(data_file: str, batch_size: int = 0, repeat: int = 3) -> Dict:
+    """
+    Sessions converted per second, from the fastest of repeat runs, the same relative
+    to the calibration loop, and the peak memory allocated by one more run
+    """
+    exporter = create_exporter(batch_size)
+    exporter.s3_client = LocalDataFile(data_file)
+    schemas = {data_type: [field["name"] for field in exporter.parse_schema(data_type)]
+               for data_type in exporter.DATA_TYPES}
+    with open(data_file) as f:
+        sessions = sum(1 for _ in f)
+
+    def transform():
+        with tempfile.TemporaryDirectory() as data_dir:
+            exporter.transform_data_file(DATA_FILE_KEY, schemas, data_dir, "perf")
+
+    calibration = measure_calibration(repeat)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        transform()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        transform()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "sessions": sessions,
+        "sessions_per_second": round(sessions / min(timings)),
+        # sessions converted in the time the calibration loop takes for a record
+        "relative_throughput": round(sessions / min(timings) / calibration, 4),
+        "peak_memory_mb": round(peak / 2 ** 20, 2),
+    }
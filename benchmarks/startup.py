@@ -0,0 +1,75 @@
+"""
+Measure how long the leanplum-data-export CLI takes to start.
+
+Each command is run in a fresh interpreter, like a Kubernetes job or an
+iteration of a backfill loop would. Fails when the median wall time of any
+command is above --max-seconds, so it can be used to catch regressions.
+
+    python benchmarks/startup.py --runs 10 --max-seconds 1.5
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = [
+    ["--help"],
+    ["export-leanplum", "--help"],
+    ["get-messages", "--help"],
+]
+
+# modules that should only be imported by the commands that use them
+HEAVY_MODULES = ["boto3", "google.cloud.bigquery", "google.cloud.storage"]
+
+
+def time_command(args, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "leanplum_data_export", *args],
+                       check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def loaded_heavy_modules(args):
+    code = (
+        "import sys\n"
+        "from leanplum_data_export.__main__ import main\n"
+        "try:\n"
+        f"    main({args!r})\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        f"print('heavy:' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            capture_output=True, text=True).stdout
+    heavy = output.rsplit("heavy:", 1)[1].strip()
+    return [module for module in heavy.split(",") if module]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    failed = False
+    for command in COMMANDS:
+        timings = time_command(command, args.runs)
+        median = statistics.median(timings)
+        heavy = loaded_heavy_modules(command)
+        print(f"{' '.join(command):<28} median {median:.3f}s  "
+              f"min {min(timings):.3f}s  max {max(timings):.3f}s  "
+              f"heavy imports: {', '.join(heavy) or 'none'}")
+        if args.max_seconds is not None and median > args.max_seconds:
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""
+Compare the row-at-a-time and column-batched CSV conversion on identical input.
+
+    python benchmarks/transform_batch.py --sessions 100000 --batch-size 10000
+"""
+
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+from leanplum_data_export.export import LeanplumExporter
+from leanplum_data_export.synthetic import write_ndjson
+
+
+def convert(data_file, output_dir, batch_size):
+    exporter = LeanplumExporter("benchmark", batch_size=batch_size)
+    schemas = {data_type: [field["name"] for field in exporter.parse_schema(data_type)]
+               for data_type in exporter.DATA_TYPES}
+    os.makedirs(output_dir)
+    csv_files = {data_type: open(os.path.join(output_dir, f"{data_type}.csv"), "w")
+                 for data_type in exporter.DATA_TYPES}
+
+    start = time.perf_counter()
+    try:
+        if batch_size > 0:
+            exporter.write_batches(csv_files, data_file, schemas)
+        else:
+            exporter.write_rows(csv_files, data_file, schemas)
+    finally:
+        for csv_file in csv_files.values():
+            csv_file.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50000)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_file = os.path.join(work_dir, "data.ndjson")
+        write_ndjson(data_file, args.sessions, args.seed)
+
+        timings = {"rows": [], "batch": []}
+        for run in range(args.runs):
+            for engine, batch_size in (("rows", 0), ("batch", args.batch_size)):
+                output_dir = os.path.join(work_dir, f"{engine}-{run}")
+                timings[engine].append(convert(data_file, output_dir, batch_size))
+
+        match, mismatch, errors = filecmp.cmpfiles(
+            os.path.join(work_dir, "rows-0"), os.path.join(work_dir, "batch-0"),
+            os.listdir(os.path.join(work_dir, "rows-0")), shallow=False)
+
+    rows, batch = min(timings["rows"]), min(timings["batch"])
+    print(f"sessions: {args.sessions}  batch size: {args.batch_size}")
+    print(f"rows:  {rows:.2f}s  ({args.sessions / rows:,.0f} sessions/s)")
+    print(f"batch: {batch:.2f}s  ({args.sessions / batch:,.0f} sessions/s)  "
+          f"speedup {rows / batch:.2f}x")
+    print(f"identical output: {not mismatch and not errors} ({len(match)} files)")
+    return 0 if not mismatch and not errors else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
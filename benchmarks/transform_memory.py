@@ -0,0 +1,89 @@
+"""
+Compare memory used by the extract functions with and without string interning.
+
+A synthetic day is generated with a fixed seed and every extracted row is held
+in memory, as a buffering writer would. Each mode runs in its own interpreter
+so that peak RSS is measured independently.
+
+    python benchmarks/transform_memory.py --sessions 200000
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def run(data_file, interned):
+    from leanplum_data_export import data_parser
+    from leanplum_data_export.export import LeanplumExporter
+
+    if not interned:
+        data_parser.pool.max_size = 0
+
+    exporter = LeanplumExporter("benchmark")
+    session_columns = [field["name"] for field in exporter.parse_schema("sessions")]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = []
+    with open(data_file) as f:
+        for line in f:
+            session_data = json.loads(line)
+            rows.extend(data_parser.extract_user_attributes(session_data))
+            rows.extend(data_parser.extract_experiments(session_data))
+            rows.append(data_parser.extract_session(session_data, session_columns))
+            events, event_parameters = data_parser.extract_events(session_data)
+            rows.extend(events)
+            rows.extend(event_parameters)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+
+    return {
+        "mode": "interned" if interned else "plain",
+        "rows": len(rows),
+        "seconds": round(elapsed, 2),
+        "retained_mb": round(current / 2 ** 20, 1),
+        "peak_mb": round(peak / 2 ** 20, 1),
+        "live_blocks": blocks,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--run", choices=["plain", "interned"], help=argparse.SUPPRESS)
+    parser.add_argument("--data-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(args.data_file, args.run == "interned")))
+        return 0
+
+    from leanplum_data_export.synthetic import write_ndjson
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_file = os.path.join(data_dir, "data.ndjson")
+        write_ndjson(data_file, args.sessions, args.seed)
+
+        for mode in ("plain", "interned"):
+            output = subprocess.run(
+                [sys.executable, __file__, "--run", mode, "--data-file", data_file],
+                check=True, capture_output=True, text=True).stdout
+            print(output.strip())
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,8 +8,110 @@ import click
 import logging
 import sys
 
-from leanplum_data_export.export import LeanplumExporter
-from leanplum_data_export.get_messages import LeanplumMessageFetcher
+
+def parse_table_option(value):
+    data_type, separator, setting = value.partition("=")
+    if not separator:
+        raise click.BadParameter(f"Expected DATA_TYPE=VALUE, got {value}")
+    return data_type.strip(), setting.strip()
+
+
+# options that configure the LeanplumExporter, shared by the commands that export to BigQuery
+EXPORTER_OPTIONS = [
+    click.option("--max-pool-connections", default=32, envvar="LEANPLUM_MAX_POOL_CONNECTIONS",
+                 help="Size of the HTTP connection pool of each S3, GCS and BigQuery client"),
+    click.option("--max-attempts", default=10, envvar="LEANPLUM_S3_MAX_ATTEMPTS",
+                 help="Maximum number of attempts for S3 requests, using adaptive retries"),
+    click.option("--multipart-threshold", default=8,
+                 envvar="LEANPLUM_S3_MULTIPART_THRESHOLD_MB",
+                 help="Size in MB above which S3 downloads are split into parts"),
+    click.option("--multipart-chunksize", default=8,
+                 envvar="LEANPLUM_S3_MULTIPART_CHUNKSIZE_MB",
+                 help="Size in MB of each part of a multipart S3 download"),
+    click.option("--max-concurrency", default=10, envvar="LEANPLUM_S3_MAX_CONCURRENCY",
+                 help="Number of threads used to download parts of an S3 file"),
+    click.option("--gcs-chunk-size", default=50.0, envvar="LEANPLUM_GCS_CHUNK_SIZE_MB",
+                 help="Size in MB of each chunk of a GCS upload; must be a multiple of 0.25"),
+    click.option("--workers", default=1, envvar="LEANPLUM_WORKERS",
+                 help="Number of data files downloaded, converted and uploaded concurrently"),
+    click.option("--max-inflight", default=2048.0, envvar="LEANPLUM_MAX_INFLIGHT_MB",
+                 help="Size in MB of downloaded and converted files that may be held at once "
+                      "with --workers; downloads wait until uploads free enough of it"),
+    click.option("--batch-size", default=0, envvar="LEANPLUM_BATCH_SIZE",
+                 help="Convert sessions in column batches of this many sessions. "
+                      "0 converts one session at a time."),
+    click.option("--coerce-types/--no-coerce-types", default=True,
+                 help="Convert values to the encoding of their schema type before loading. "
+                      "Values that can't be converted are written to rejects files in GCS."),
+    click.option("--nested/--no-nested", default=False,
+                 help="Also export sessions_nested, a table of whole sessions with their "
+                      "attributes, experiments, states, events and parameters as repeated "
+                      "records."),
+    click.option("--rollups/--no-rollups", default=False,
+                 help="Count daily rollups (events by name and country, sessions and users by "
+                      "app version, experiment exposures) while converting and load them into "
+                      "rollup tables."),
+    click.option("--dedup", type=click.Choice(["drop", "flag"]), default=None,
+                 help="Check sessions against those of the day's other data files. drop leaves "
+                      "out sessions that were already exported, flag only records them; either "
+                      "way they are loaded into the duplicates table."),
+    click.option("--dedup-capacity", default=10000000, envvar="LEANPLUM_DEDUP_CAPACITY",
+                 help="Expected number of sessions in a day, which sizes the dedup Bloom "
+                      "filter"),
+    click.option("--partition-by", multiple=True, metavar="DATA_TYPE=COLUMN",
+                 help="Partition a data type's table by a TIMESTAMP column instead of "
+                      "load_date, e.g. sessions=start. Applies to new tables. "
+                      "Can be given more than once."),
+    click.option("--cluster-by", multiple=True, metavar="DATA_TYPE=COLUMN[,COLUMN...]",
+                 help="Cluster a data type's table by up to 4 columns, "
+                      "e.g. events=eventName,sessionId. An empty column list disables "
+                      "clustering. Can be given more than once."),
+    click.option("--cache-dir", default=None, envvar="LEANPLUM_CACHE_DIR",
+                 help="Keep downloaded S3 data files in this directory for later runs"),
+    click.option("--cache-max-size", default=50.0, envvar="LEANPLUM_CACHE_MAX_SIZE_GB",
+                 help="Size in GB above which the least recently used cached files are "
+                      "removed"),
+]
+
+
+def exporter_options(command):
+    for option in reversed(EXPORTER_OPTIONS):
+        command = option(command)
+    return command
+
+
+def create_exporter(project, profiler, max_pool_connections, max_attempts, multipart_threshold,
+                    multipart_chunksize, max_concurrency, gcs_chunk_size, workers, max_inflight,
+                    batch_size, coerce_types, nested, rollups, dedup, dedup_capacity,
+                    partition_by, cluster_by, cache_dir, cache_max_size):
+    """
+    Create a LeanplumExporter from the values of EXPORTER_OPTIONS
+    """
+    from leanplum_data_export.cache import DownloadCache, GB
+    from leanplum_data_export.clients import ClientConfig, MB
+    from leanplum_data_export.export import LeanplumExporter
+
+    client_config = ClientConfig(
+        max_pool_connections=max_pool_connections,
+        max_attempts=max_attempts,
+        multipart_threshold=multipart_threshold * MB,
+        multipart_chunksize=multipart_chunksize * MB,
+        max_concurrency=max_concurrency,
+        gcs_chunk_size=int(gcs_chunk_size * MB),
+    )
+    download_cache = None
+    if cache_dir is not None:
+        download_cache = DownloadCache(cache_dir, int(cache_max_size * GB))
+    return LeanplumExporter(
+        project, client_config, batch_size=batch_size, download_cache=download_cache,
+        profiler=profiler, coerce_types=coerce_types, nested=nested,
+        rollups=rollups, workers=workers, max_inflight_bytes=int(max_inflight * MB),
+        dedup=dedup, dedup_capacity=dedup_capacity,
+        partition_by=dict(parse_table_option(option) for option in partition_by),
+        cluster_by={data_type: [column.strip() for column in columns.split(",")
+                                if column.strip()]
+                    for data_type, columns in map(parse_table_option, cluster_by)},
+    )
 
 
 @click.command()
@@ -25,10 +127,95 @@ from leanplum_data_export.get_messages import LeanplumMessageFetcher
 @click.option("--clean/--no-clean", default=False,
               help="A clean run will reprocess the entire day.  "
                    "By default, files that have already been processed will be ignored.")
-def export_leanplum(date, bucket, prefix, bq_dataset, table_prefix,
-                    version, project, s3_bucket, clean):
-    exporter = LeanplumExporter(project)
-    exporter.export(date, s3_bucket, bucket, prefix, bq_dataset, table_prefix, version, clean)
+@click.option("--only-types", default=None,
+              help="Comma-separated data types to rebuild from all of the day's files, "
+                   "e.g. sessions,events. By default, only data types whose schema changed "
+                   "since the day was exported are rebuilt.")
+@exporter_options
+@click.pass_obj
+def export_leanplum(profiler, date, bucket, prefix, bq_dataset, table_prefix,
+                    version, project, s3_bucket, clean, only_types, **options):
+    exporter = create_exporter(project, profiler, **options)
+    if only_types is not None:
+        only_types = [data_type.strip() for data_type in only_types.split(",")]
+    exporter.export(date, s3_bucket, bucket, prefix, bq_dataset, table_prefix, version, clean,
+                    only_types=only_types)
+
+
+@click.command()
+@click.option("--date", required=True)
+@click.option("--source-dir", required=True,
+              help="Directory laid out like the S3 bucket, with data files in <prefix>/<date>/")
+@click.option("--stage-dir", required=True,
+              help="Directory the converted files are staged in, laid out like the GCS bucket")
+@click.option("--database", required=True, help="SQLite database the tables are loaded into")
+@click.option("--prefix", required=True)
+@click.option("--dataset", default="leanplum",
+              help="Prefix of the table names in the database, e.g. leanplum.sessions_v1")
+@click.option("--table-prefix", default=None)
+@click.option("--version", default=1)
+@click.option("--clean/--no-clean", default=False)
+@click.option("--only-types", default=None)
+@click.option("--workers", default=1)
+@click.option("--batch-size", default=0)
+@click.option("--coerce-types/--no-coerce-types", default=True)
+@click.option("--nested/--no-nested", default=False)
+@click.option("--rollups/--no-rollups", default=False)
+@click.option("--dedup", type=click.Choice(["drop", "flag"]), default=None)
+@click.pass_obj
+def export_local(profiler, date, source_dir, stage_dir, database, prefix, dataset, table_prefix,
+                 version, clean, only_types, workers, batch_size, coerce_types, nested, rollups,
+                 dedup):
+    """
+    Run export-leanplum against local directories and a SQLite database, e.g. to
+    load test the pipeline on synthetic data or reprocess a few files offline
+    """
+    from leanplum_data_export.local import LocalExporter
+
+    exporter = LocalExporter(database, batch_size=batch_size, profiler=profiler,
+                             coerce_types=coerce_types, nested=nested, rollups=rollups,
+                             workers=workers, dedup=dedup)
+    if only_types is not None:
+        only_types = [data_type.strip() for data_type in only_types.split(",")]
+    exporter.export(date, source_dir, stage_dir, prefix, dataset, table_prefix, version, clean,
+                    only_types=only_types)
+
+
+@click.command()
+@click.option("--date", "dates", multiple=True,
+              help="Date to watch, can be given more than once. "
+                   "By default the current and previous UTC dates are watched.")
+@click.option("--bucket", required=True)
+@click.option("--prefix", default="")
+@click.option("--bq-dataset", required=True)
+@click.option("--project", required=True)
+@click.option("--table-prefix", default=None)
+@click.option("--version", default=1)
+@click.option("--s3-bucket", required=True,
+              help="Name of the bucket to retrieve exported streaming data from")
+@click.option("--poll-interval", default=60.0, envvar="LEANPLUM_POLL_INTERVAL",
+              help="Seconds between listings of new data files")
+@click.option("--load-interval", default=900.0, envvar="LEANPLUM_LOAD_INTERVAL",
+              help="Seconds between BigQuery loads of the dates that got new data files")
+@exporter_options
+@click.pass_obj
+def watch(profiler, dates, bucket, prefix, bq_dataset, project, table_prefix, version, s3_bucket,
+          poll_interval, load_interval, **options):
+    """
+    Keep running and export data files as they land in S3, loading them into BigQuery
+    every load interval. Stops after the next load on SIGINT or SIGTERM.
+    """
+    import signal
+
+    from leanplum_data_export.watch import FileWatcher
+
+    exporter = create_exporter(project, profiler, **options)
+    watcher = FileWatcher(exporter, s3_bucket, bucket, prefix, bq_dataset, table_prefix, version,
+                          dates=list(dates) or None, poll_interval=poll_interval,
+                          load_interval=load_interval)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: watcher.stop())
+    watcher.run()
 
 
 @click.command()
@@ -40,6 +227,8 @@ def export_leanplum(date, bucket, prefix, bq_dataset, table_prefix,
 @click.option("--table-prefix", default=None)
 @click.option("--version", default=1)
 def get_messages(date, app_id, client_key, project, bq_dataset, table_prefix, version):
+    from leanplum_data_export.get_messages import LeanplumMessageFetcher
+
     message_fetcher = LeanplumMessageFetcher(
         app_id, client_key, project, bq_dataset, table_prefix, version
     )
@@ -47,12 +236,27 @@ def get_messages(date, app_id, client_key, project, bq_dataset, table_prefix, ve
 
 
 @click.group()
-def main(args=None):
+@click.option("--profile", "profile_dir", default=None, envvar="LEANPLUM_PROFILE_DIR",
+              help="Profile CPU and memory use and the time taken by each data file. "
+                   "Results are written to this directory and summarized in the log.")
+@click.option("--profile-top", default=20, help="Number of entries in profile summaries")
+@click.pass_context
+def main(ctx, profile_dir, profile_top):
     """Command line utility"""
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
+    if profile_dir is not None:
+        from leanplum_data_export.profiling import Profiler
+
+        profiler = Profiler(profile_dir, profile_top)
+        profiler.start()
+        ctx.call_on_close(profiler.stop)
+        ctx.obj = profiler
+
 
 main.add_command(export_leanplum)
+main.add_command(export_local)
+main.add_command(watch)
 main.add_command(get_messages)
 
 
@@ -0,0 +1,148 @@
+"""
+Column-batched alternative to LeanplumExporter.write_to_csv.
+
+Sessions are decoded into one list per column for every data type instead of
+one dict per row, and each data type is written with a single writerows call
+per batch. The output is identical to the row-at-a-time path.
+"""
+
+from itertools import repeat
+from typing import Callable, Dict, List
+
+from leanplum_data_export import data_parser
+
+# columns filled from the session data, other schema columns are written empty
+USER_ATTRIBUTE_COLUMNS = ["sessionId", "name", "value"]
+EXPERIMENT_COLUMNS = ["sessionId", "experimentId", "variantId"]
+EVENT_COLUMNS = ["sessionId", "stateId", "eventId", "eventName", "start", "value", "info",
+                 "timeUntilFirstForUser"]
+EVENT_PARAMETER_COLUMNS = ["eventId", "name", "value"]
+
+
+class ColumnBatchWriter(object):
+
+    def __init__(self, csv_writers: Dict, schemas: Dict[str, List[str]],
+                 batch_size: int = 10000,
+                 converters: Dict[str, Dict[str, Callable]] = None):
+        """
+        csv_writers are plain csv writers, headers are expected to be written already.
+        converters optionally maps data type and column to a function that is applied
+        to the whole column before it is written.
+        """
+        self.csv_writers = csv_writers
+        self.schemas = schemas
+        self.batch_size = batch_size
+        self.converters = converters or {}
+        self.produced_columns = {
+            "userattributes": USER_ATTRIBUTE_COLUMNS,
+            "experiments": EXPERIMENT_COLUMNS,
+            "sessions": schemas.get("sessions", []),
+            "events": EVENT_COLUMNS,
+            "eventparameters": EVENT_PARAMETER_COLUMNS,
+            "states": [],
+        }
+        self.columns = {}
+        self.session_count = 0
+        self._reset()
+
+    def _reset(self):
+        self.columns = {data_type: {name: [] for name in self.produced_columns[data_type]}
+                        for data_type in self.csv_writers}
+        self.session_count = 0
+
+        if "sessions" in self.columns:
+            session_columns = self.columns["sessions"]
+            self._session_appends = [
+                (session_columns[name].append,
+                 data_parser.SESSION_FIELD_MAPPINGS.get(name, name),
+                 name in data_parser.INTERNED_SESSION_COLUMNS)
+                for name in self.produced_columns["sessions"] if name != "isDeveloper"
+            ]
+            self._append_is_developer = (session_columns["isDeveloper"].append
+                                         if "isDeveloper" in session_columns else None)
+
+    def add(self, session_data: Dict) -> None:
+        intern = data_parser.pool.intern
+        columns = self.columns
+        session_id = int(session_data["sessionId"])
+
+        attributes = session_data.get("userAttributes")
+        if attributes and "userattributes" in columns:
+            attribute_columns = columns["userattributes"]
+            attribute_columns["sessionId"].extend(repeat(session_id, len(attributes)))
+            attribute_columns["name"].extend(map(intern, attributes.keys()))
+            attribute_columns["value"].extend(attributes.values())
+
+        experiments = session_data.get("experiments")
+        if experiments and "experiments" in columns:
+            experiment_columns = columns["experiments"]
+            experiment_columns["sessionId"].extend(repeat(session_id, len(experiments)))
+            experiment_columns["experimentId"].extend(
+                [experiment["id"] for experiment in experiments])
+            experiment_columns["variantId"].extend(
+                [experiment["variantId"] for experiment in experiments])
+
+        if "sessions" in columns:
+            get = session_data.get
+            for append, source_name, interned in self._session_appends:
+                append(intern(get(source_name)) if interned else get(source_name))
+            if self._append_is_developer is not None:
+                self._append_is_developer(get("isDeveloper", False))
+
+        states = session_data.get("states")
+        if states and ("events" in columns or "eventparameters" in columns):
+            self._add_events(states, session_id)
+
+        self.session_count += 1
+        if self.session_count >= self.batch_size:
+            self.flush()
+
+    def _add_events(self, states, session_id):
+        intern = data_parser.pool.intern
+        event_columns = self.columns.get("events")
+        parameter_columns = self.columns.get("eventparameters")
+
+        for state in states:
+            events = state.get("events")
+            if not events:
+                continue
+
+            if event_columns is not None:
+                event_columns["sessionId"].extend(repeat(session_id, len(events)))
+                event_columns["stateId"].extend(repeat(state["stateId"], len(events)))
+                event_columns["eventId"].extend([event["eventId"] for event in events])
+                event_columns["eventName"].extend([intern(event["name"]) for event in events])
+                event_columns["start"].extend([event["time"] for event in events])
+                event_columns["value"].extend([event["value"] for event in events])
+                event_columns["info"].extend([event.get("info") for event in events])
+                event_columns["timeUntilFirstForUser"].extend(
+                    [event.get("timeUntilFirstForUser") for event in events])
+
+            if parameter_columns is not None:
+                for event in events:
+                    parameters = event.get("parameters")
+                    if not parameters:
+                        continue
+                    parameter_columns["eventId"].extend(repeat(event["eventId"], len(parameters)))
+                    parameter_columns["name"].extend(map(intern, parameters.keys()))
+                    parameter_columns["value"].extend(parameters.values())
+
+    def flush(self) -> None:
+        for data_type, csv_writer in self.csv_writers.items():
+            columns = self.columns[data_type]
+            row_count = len(next(iter(columns.values()))) if columns else 0
+            if row_count == 0:
+                continue
+
+            converters = self.converters.get(data_type, {})
+            ordered_columns = []
+            for name in self.schemas[data_type]:
+                column = columns.get(name)
+                if column is None:
+                    column = repeat(None, row_count)
+                elif name in converters:
+                    column = map(converters[name], column)
+                ordered_columns.append(column)
+            csv_writer.writerows(zip(*ordered_columns))
+
+        self._reset()
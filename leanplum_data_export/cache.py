@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import Counter
+
+GB = 1024 * 1024 * 1024
+
+
+class DownloadCache(object):
+    """
+    Keeps downloaded S3 data files in a local directory so reruns on the same node
+    don't download them again.
+    Entries are keyed by bucket, key and ETag so a replaced object is never served stale.
+    Downloads are checked against the object's size, and against its MD5 when the ETag is
+    one, before they are cached; entries are checked against the SHA-256 recorded at
+    download time before they are used.
+    The least recently used entries are evicted when the cache grows over max_bytes,
+    except for entries that were fetched and not released yet.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 50 * GB):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # entries in use by callers of fetch, which eviction skips
+        self._pins = Counter()
+        os.makedirs(directory, exist_ok=True)
+
+    def fetch(self, s3_client, bucket: str, key: str, destination: str,
+              transfer_config=None) -> str:
+        """
+        Return the path of a local copy of the object, which must be passed to release
+        once it has been read.
+        This is the cached copy if there is a valid one, otherwise the object is downloaded
+        into the cache. Objects larger than the cache are downloaded to destination instead.
+        """
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        etag = head["ETag"].strip('"')
+        entry_path = self.get_entry_path(bucket, key, etag)
+
+        # pinned before it is checked, so that other threads can't evict it in between
+        with self._lock:
+            self._pins[entry_path] += 1
+        try:
+            return self._fetch(s3_client, bucket, key, destination, transfer_config, head,
+                               entry_path)
+        except Exception:
+            self.release(entry_path)
+            raise
+
+    def _fetch(self, s3_client, bucket, key, destination, transfer_config, head, entry_path):
+        etag = head["ETag"].strip('"')
+        if self.is_valid(entry_path):
+            logging.info(f"Using cached copy of s3://{bucket}/{key}")
+            os.utime(entry_path)
+            return entry_path
+
+        if head["ContentLength"] > self.max_bytes:
+            logging.info(f"s3://{bucket}/{key} is larger than the download cache, not caching")
+            s3_client.download_file(bucket, key, destination, Config=transfer_config)
+            self.verify_download(destination, head, bucket, key)
+            self.release(entry_path)
+            return destination
+
+        # download next to the entry and rename so partial files are never visible
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".download")
+        os.close(fd)
+        try:
+            s3_client.download_file(bucket, key, tmp_path, Config=transfer_config)
+            self.verify_download(tmp_path, head, bucket, key)
+            metadata = {
+                "bucket": bucket,
+                "key": key,
+                "etag": etag,
+                "size": os.path.getsize(tmp_path),
+                "sha256": self.checksum(tmp_path),
+            }
+            with open(f"{entry_path}.json", "w") as f:
+                json.dump(metadata, f)
+            os.replace(tmp_path, entry_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict()
+        return entry_path
+
+    def verify_download(self, path: str, head, bucket: str, key: str) -> None:
+        """
+        Raise an IOError if a download doesn't match the object's size, or its MD5 for
+        objects that weren't uploaded in parts, whose ETag is their MD5
+        """
+        size = os.path.getsize(path)
+        if size != head["ContentLength"]:
+            raise IOError(f"Downloaded {size} bytes of s3://{bucket}/{key}, "
+                          f"expected {head['ContentLength']}")
+        etag = head["ETag"].strip('"')
+        if "-" not in etag and self.checksum(path, "md5") != etag:
+            raise IOError(f"Download of s3://{bucket}/{key} doesn't match its ETag {etag}")
+
+    def release(self, path: str) -> None:
+        """
+        Allow a fetched entry to be evicted again
+        """
+        with self._lock:
+            if self._pins[path] > 1:
+                self._pins[path] -= 1
+            else:
+                self._pins.pop(path, None)
+
+    def get_entry_path(self, bucket: str, key: str, etag: str) -> str:
+        name = hashlib.sha256(f"{bucket}/{key}/{etag}".encode()).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def is_valid(self, entry_path: str) -> bool:
+        try:
+            with open(f"{entry_path}.json") as f:
+                metadata = json.load(f)
+            if (os.path.getsize(entry_path) == metadata["size"]
+                    and self.checksum(entry_path) == metadata["sha256"]):
+                return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+        logging.warning(f"Discarding corrupted cache entry {entry_path}")
+        self.remove(entry_path)
+        return False
+
+    def evict(self) -> None:
+        """
+        Remove least recently used entries that aren't in use until the cache fits
+        in max_bytes
+        """
+        with self._lock:
+            entries = []
+            total_bytes = 0
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith((".json", ".download")):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                total_bytes += stat.st_size
+                if path not in self._pins:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                logging.info(f"Evicting {path} from the download cache")
+                self.remove(path)
+                total_bytes -= size
+
+    @staticmethod
+    def remove(entry_path: str) -> None:
+        for path in (entry_path, f"{entry_path}.json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def checksum(path: str, algorithm: str = "sha256") -> str:
+        digest = hashlib.new(algorithm)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
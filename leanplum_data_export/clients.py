@@ -0,0 +1,96 @@
+import threading
+
+MB = 1024 * 1024
+
+
+class ClientConfig(object):
+    """
+    Connection, retry and transfer settings shared by the S3, GCS and BigQuery clients
+    """
+
+    def __init__(self, max_pool_connections: int = 32, max_attempts: int = 10,
+                 retry_mode: str = "adaptive", multipart_threshold: int = 8 * MB,
+                 multipart_chunksize: int = 8 * MB, max_concurrency: int = 10,
+                 gcs_chunk_size: int = 50 * MB):
+        # GCS resumable uploads require the chunk size to be a multiple of 256KB
+        if gcs_chunk_size % (256 * 1024) != 0:
+            raise ValueError(f"GCS chunk size must be a multiple of 256KB, got {gcs_chunk_size}")
+
+        self.max_pool_connections = max_pool_connections
+        self.max_attempts = max_attempts
+        self.retry_mode = retry_mode
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.max_concurrency = max_concurrency
+        self.gcs_chunk_size = gcs_chunk_size
+
+
+class ClientFactory(object):
+    """
+    Creates the cloud clients once and hands out the same instances afterwards.
+    Clients are created, and their libraries imported, on first use: the cloud libraries
+    take seconds to import and not every command or run needs all of them.
+    Clients are built under a lock so the factory can be shared between threads;
+    the clients themselves are safe to use concurrently.
+    """
+
+    def __init__(self, project: str, config: ClientConfig = None):
+        self.project = project
+        self.config = ClientConfig() if config is None else config
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def s3(self):
+        return self._get("s3", self._create_s3_client)
+
+    def gcs(self):
+        return self._get("gcs", self._create_gcs_client)
+
+    def bigquery(self):
+        return self._get("bigquery", self._create_bigquery_client)
+
+    def s3_transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+
+        return TransferConfig(
+            multipart_threshold=self.config.multipart_threshold,
+            multipart_chunksize=self.config.multipart_chunksize,
+            max_concurrency=self.config.max_concurrency,
+        )
+
+    def _get(self, name, create):
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = create()
+            return self._clients[name]
+
+    def _create_s3_client(self):
+        import boto3
+        from botocore.config import Config
+
+        # boto3.client uses the default session, which is not thread safe
+        session = boto3.session.Session()
+        return session.client("s3", config=Config(
+            max_pool_connections=self.config.max_pool_connections,
+            retries={"total_max_attempts": self.config.max_attempts,
+                     "mode": self.config.retry_mode},
+        ))
+
+    def _create_gcs_client(self):
+        from google.cloud import storage
+
+        return self._with_connection_pool(storage.Client(project=self.project))
+
+    def _create_bigquery_client(self):
+        from google.cloud import bigquery
+
+        return self._with_connection_pool(bigquery.Client(project=self.project))
+
+    def _with_connection_pool(self, client):
+        from requests.adapters import HTTPAdapter
+
+        # google clients share one requests session whose default pool holds 10 connections
+        adapter = HTTPAdapter(pool_connections=self.config.max_pool_connections,
+                              pool_maxsize=self.config.max_pool_connections)
+        client._http.mount("https://", adapter)
+        return client
@@ -0,0 +1,216 @@
+"""
+Convert values to the canonical CSV encoding of their BigQuery column type.
+
+Leanplum exports booleans as Python-style strings and timestamps as float epoch
+seconds; converting them once here means BigQuery doesn't have to coerce them
+when it reads the external tables, and values that can't be converted are
+written to a side output instead of being counted against max_bad_records.
+"""
+
+import csv
+import logging
+import math
+import os
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List
+
+REJECTS_PREFIX = "rejects"
+
+BOOLEANS = {"true": "true", "false": "false", "1": "true", "0": "false"}
+
+
+def to_integer(value):
+    value_type = type(value)
+    if value_type is int:
+        return value
+    if value_type is str:
+        try:
+            return int(value)
+        except ValueError:
+            value = float(value)
+            value_type = float
+    if value_type is float and value.is_integer():
+        return int(value)
+    raise ValueError(f"Not an integer: {value!r}")
+
+
+def to_float(value):
+    if type(value) is bool:
+        raise ValueError(f"Not a float: {value!r}")
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"Not a finite float: {value!r}")
+    return value
+
+
+def to_boolean(value):
+    if type(value) is bool:
+        return "true" if value else "false"
+    return BOOLEANS[str(value).lower()]
+
+
+def to_timestamp(value):
+    """
+    Leanplum timestamps are seconds since the epoch, as numbers or strings like 1.591474962721E9
+    """
+    if type(value) is bool:
+        raise ValueError(f"Not a timestamp: {value!r}")
+    timestamp = datetime.fromtimestamp(float(value), timezone.utc)
+    return timestamp.strftime("%Y-%m-%d %H:%M:%S.%f UTC")
+
+
+CONVERTERS = {
+    "INTEGER": to_integer,
+    "FLOAT": to_float,
+    "BOOLEAN": to_boolean,
+    "TIMESTAMP": to_timestamp,
+}
+
+
+def get_record_converters(fields: List[Dict]) -> Dict:
+    """
+    Converters of the typed fields of RECORD fields, nested like the records
+    """
+    converters = {}
+    for field in fields:
+        if field.get("type") == "RECORD":
+            converters[field["name"]] = {
+                **{subfield["name"]: CONVERTERS[subfield.get("type", "STRING")]
+                   for subfield in field["fields"]
+                   if subfield.get("type", "STRING") in CONVERTERS},
+                **get_record_converters(field["fields"]),
+            }
+    return converters
+
+
+class Rejects(object):
+    """
+    Side output of the values of a data file that could not be converted, one CSV per data type
+    """
+
+    def __init__(self, data_dir: str, file_id: str):
+        self.data_dir = data_dir
+        self.file_id = file_id
+        self.counts = Counter()
+        self._files = {}
+        self._writers = {}
+
+    def add(self, data_type: str, column: str, value) -> None:
+        if data_type not in self._writers:
+            path = os.path.join(self.data_dir, f"{REJECTS_PREFIX}-{data_type}-{self.file_id}.csv")
+            self._files[data_type] = open(path, "w")
+            self._writers[data_type] = csv.writer(self._files[data_type])
+            self._writers[data_type].writerow(["column", "value"])
+        self._writers[data_type].writerow([column, value])
+        self.counts[(data_type, column)] += 1
+
+    def close(self) -> None:
+        for rejects_file in self._files.values():
+            rejects_file.close()
+        for (data_type, column), count in sorted(self.counts.items()):
+            logging.warning(f"Rejected {count} values of {data_type}.{column} in {self.file_id}")
+
+    def paths(self) -> Dict[str, Path]:
+        """
+        Paths of the written files, keyed by the GCS data type directory they belong in
+        """
+        return {f"{REJECTS_PREFIX}/{data_type}": Path(rejects_file.name)
+                for data_type, rejects_file in self._files.items()}
+
+
+class Coercer(object):
+    """
+    Converters for every typed column of the given schemas, built once and shared by all files
+    """
+
+    def __init__(self, schemas: Dict[str, List[Dict]]):
+        self.converters = {
+            data_type: {field["name"]: CONVERTERS[field.get("type", "STRING")]
+                        for field in schema if field.get("type", "STRING") in CONVERTERS}
+            for data_type, schema in schemas.items()
+        }
+        # only nested data types have record converters, flat rows skip the recursion
+        self.record_converters = {
+            data_type: get_record_converters(schema) for data_type, schema in schemas.items()
+            if any(field.get("type") == "RECORD" for field in schema)
+        }
+
+    def coerce_row(self, data_type: str, row: Dict, rejects: Rejects) -> Dict:
+        for name, convert in self.converters.get(data_type, {}).items():
+            value = row.get(name)
+            if value is None:
+                continue
+            try:
+                row[name] = convert(value)
+            except (ValueError, TypeError, KeyError, OverflowError, OSError):
+                rejects.add(data_type, name, value)
+                row[name] = None
+        if data_type in self.record_converters:
+            self._coerce_records(data_type, row, self.record_converters[data_type], "", rejects)
+        return row
+
+    def _coerce_records(self, data_type: str, row: Dict, converters: Dict, path: str,
+                        rejects: Rejects) -> None:
+        """
+        Convert the fields of the records of row, rejected values are reported by their
+        dotted path, e.g. states.events.start
+        """
+        for name, record_converters in converters.items():
+            records = row.get(name)
+            if records is None:
+                continue
+            if type(records) is not list:
+                records = [records]
+            for record in records:
+                for field, convert in record_converters.items():
+                    value = record.get(field)
+                    if value is None:
+                        continue
+                    if type(convert) is dict:
+                        self._coerce_records(data_type, record, {field: convert},
+                                             f"{path}{name}.", rejects)
+                        continue
+                    try:
+                        record[field] = convert(value)
+                    except (ValueError, TypeError, KeyError, OverflowError, OSError):
+                        rejects.add(data_type, f"{path}{name}.{field}", value)
+                        record[field] = None
+
+    def column_converters(self, data_type: str, rejects: Rejects) -> Dict[str, Callable]:
+        """
+        Converters for whole columns, as used by the column batch writer
+        """
+        def safe(name, convert):
+            def safe_convert(value):
+                if value is None:
+                    return None
+                try:
+                    return convert(value)
+                except (ValueError, TypeError, KeyError, OverflowError, OSError):
+                    rejects.add(data_type, name, value)
+                    return None
+            return safe_convert
+
+        return {name: safe(name, convert)
+                for name, convert in self.converters.get(data_type, {}).items()}
+
+
+class CoercingWriter(object):
+    """
+    Wraps a csv.DictWriter to convert each row before it is written
+    """
+
+    def __init__(self, csv_writer: csv.DictWriter, data_type: str, coercer: Coercer,
+                 rejects: Rejects):
+        self.csv_writer = csv_writer
+        self.data_type = data_type
+        self.coercer = coercer
+        self.rejects = rejects
+
+    def writeheader(self):
+        self.csv_writer.writeheader()
+
+    def writerow(self, row: Dict):
+        self.csv_writer.writerow(self.coercer.coerce_row(self.data_type, row, self.rejects))
@@ -1,9 +1,65 @@
+class InternPool(object):
+    """
+    Hands out a single shared object for equal strings.
+    Names and low-cardinality values (event names, parameter and attribute names,
+    countries, app versions...) repeat millions of times in a day of sessions, but json
+    decodes each occurrence into a new object. Free-form values such as parameter values
+    are not worth pooling. The pool starts over once it holds max_size entries, so that
+    a long-running process keeps pooling the strings that currently repeat.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._pool = {}
+
+    def __len__(self):
+        return len(self._pool)
+
+    def intern(self, value):
+        # only strings are pooled; True == 1 == 1.0 would otherwise share one entry
+        if type(value) is not str:
+            return value
+        pooled = self._pool.get(value)
+        if pooled is not None:
+            return pooled
+        if len(self._pool) >= self.max_size:
+            self._pool.clear()
+        self._pool[value] = value
+        return value
+
+    def clear(self):
+        self._pool.clear()
+
+
+# shared by the extract functions below
+pool = InternPool()
+
+# session columns with few distinct values that are worth interning
+INTERNED_SESSION_COLUMNS = {
+    "country", "region", "city", "locale", "timezone", "appVersion", "client", "sdkVersion",
+    "osName", "osVersion", "deviceModel", "browserName", "browserVersion", "sourcePublisherId",
+    "sourcePublisher", "sourceSubPublisher", "sourceSite", "sourceCampaign", "sourceAdGroup",
+    "sourceAd",
+}
+
+# mapping from name in destination table to name in source data
+SESSION_FIELD_MAPPINGS = {
+    "timezoneOffset": "timezoneOffsetSeconds",
+    "osName": "systemName",
+    "osVersion": "systemVersion",
+    "userStart": "firstRun",
+    "start": "time",
+}
+
+
 def extract_user_attributes(session_data):
+    intern = pool.intern
+    session_id = int(session_data["sessionId"])
     attributes = []
     for attribute, value in session_data.get("userAttributes", {}).items():
         attributes.append({
-            "sessionId": int(session_data["sessionId"]),
-            "name": attribute,
+            "sessionId": session_id,
+            "name": intern(attribute),
             "value": value,
         })
     return attributes
@@ -19,10 +75,11 @@ def extract_states(session_data):
 
 
 def extract_experiments(session_data):
+    session_id = int(session_data["sessionId"])
     experiments = []
     for experiment in session_data.get("experiments", []):
         experiments.append({
-            "sessionId": int(session_data["sessionId"]),
+            "sessionId": session_id,
             "experimentId": experiment["id"],
             "variantId": experiment["variantId"],
         })
@@ -30,15 +87,18 @@ def extract_experiments(session_data):
 
 
 def extract_events(session_data):
+    intern = pool.intern
+    session_id = int(session_data["sessionId"])
     events = []
     event_parameters = []
     for state in session_data.get("states", []):
+        state_id = state["stateId"]
         for event in state.get("events", []):
             events.append({
-                "sessionId": int(session_data["sessionId"]),
-                "stateId": state["stateId"],
+                "sessionId": session_id,
+                "stateId": state_id,
                 "eventId": event["eventId"],
-                "eventName": event["name"],
+                "eventName": intern(event["name"]),
                 "start": event["time"],
                 "value": event["value"],
                 "info": event.get("info"),
@@ -47,7 +107,7 @@ def extract_events(session_data):
             for parameter, value in event.get("parameters", {}).items():
                 event_parameters.append({
                     "eventId": event["eventId"],
-                    "name": parameter,
+                    "name": intern(parameter),
                     "value": value,
                 })
 
@@ -55,17 +115,57 @@ def extract_events(session_data):
 
 
 def extract_session(session_data, session_columns):
-    # mapping from name in destination table to name in source data
-    field_name_mappings = {
-        "timezoneOffset": "timezoneOffsetSeconds",
-        "osName": "systemName",
-        "osVersion": "systemVersion",
-        "userStart": "firstRun",
-        "start": "time",
-    }
+    intern = pool.intern
     session = {}
     for name in session_columns:
-        session[name] = session_data.get(field_name_mappings.get(name, name))
+        value = session_data.get(SESSION_FIELD_MAPPINGS.get(name, name))
+        if name in INTERNED_SESSION_COLUMNS:
+            value = intern(value)
+        session[name] = value
     session["isDeveloper"] = session_data.get("isDeveloper", False)
 
     return session
+
+
+# fields of the nested session that hold the session's child rows
+NESTED_SESSION_FIELDS = {"userAttributes", "experiments", "states"}
+
+
+def extract_nested_session(session_data, session_columns):
+    """
+    The session with its user attributes, experiments, states, events and event parameters
+    as repeated records, for the denormalized sessions_nested table
+    """
+    intern = pool.intern
+    session = extract_session(
+        session_data, [name for name in session_columns if name not in NESTED_SESSION_FIELDS])
+
+    session["userAttributes"] = [
+        {"name": intern(attribute), "value": intern(value)}
+        for attribute, value in session_data.get("userAttributes", {}).items()
+    ]
+    session["experiments"] = [
+        {"experimentId": experiment["id"], "variantId": experiment["variantId"]}
+        for experiment in session_data.get("experiments", [])
+    ]
+
+    states = []
+    for state in session_data.get("states", []):
+        events = []
+        for event in state.get("events", []):
+            events.append({
+                "eventId": event["eventId"],
+                "eventName": intern(event["name"]),
+                "start": event["time"],
+                "value": event["value"],
+                "info": event.get("info"),
+                "timeUntilFirstForUser": event.get("timeUntilFirstForUser"),
+                "parameters": [
+                    {"name": intern(parameter), "value": intern(value)}
+                    for parameter, value in event.get("parameters", {}).items()
+                ],
+            })
+        states.append({"stateId": state["stateId"], "events": events})
+    session["states"] = states
+
+    return session
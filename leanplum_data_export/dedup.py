@@ -0,0 +1,151 @@
+"""
+Detect sessions that Leanplum exported in more than one data file of a date.
+
+A SessionIndex maps every session id of the date to the data file it was first seen
+in. The exact mapping is a SQLite table on local disk, so it isn't bounded by memory;
+a Bloom filter in front of it answers most lookups for sessions that were never seen
+without touching the table. The index file is kept with the date's output in GCS,
+so later runs for the date see the sessions of files converted before them.
+"""
+
+import csv
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+DEDUP_MODES = ["drop", "flag"]
+# the side files of duplicate sessions are loaded into their own table
+DUPLICATES_TYPE = "duplicates"
+
+
+class BloomFilter(object):
+    """
+    Set membership with false positives at about error_rate up to capacity items,
+    and no false negatives
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big")
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+
+class SessionIndex(object):
+    """
+    Session ids of a date and the data file each was first seen in, shared by all
+    worker threads of a run
+    """
+
+    def __init__(self, path: str, capacity: int = 10000000, error_rate: float = 0.01):
+        self.path = path
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.lookups = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(session_id TEXT PRIMARY KEY, data_file TEXT) WITHOUT ROWID")
+        for session_id, in self._connection.execute("SELECT session_id FROM sessions"):
+            self.bloom.add(session_id)
+
+    def add(self, session_id: str, data_file: str) -> Optional[str]:
+        """
+        Record the session for the data file; returns the data file it was first seen
+        in if that is another file, i.e. the session is a duplicate
+        """
+        with self._lock:
+            if session_id in self.bloom:
+                self.lookups += 1
+                row = self._connection.execute(
+                    "SELECT data_file FROM sessions WHERE session_id = ?",
+                    (session_id,)).fetchone()
+                if row is not None:
+                    return row[0] if row[0] != data_file else None
+            self.bloom.add(session_id)
+            self._connection.execute("INSERT INTO sessions VALUES (?, ?)",
+                                     (session_id, data_file))
+            return None
+
+    def commit(self) -> None:
+        with self._lock:
+            self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+
+class SessionFilter(object):
+    """
+    Checks each session of a data file against the index; duplicates are written to
+    a side file and, in drop mode, left out of the converted files. Every data file
+    gets a side file, so that the duplicates table can be loaded from any of them.
+    """
+
+    def __init__(self, index: SessionIndex, data_file: str, mode: str, data_dir: str,
+                 file_id: str):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unrecognized dedup mode: {mode}")
+        self.index = index
+        self.data_file = data_file
+        self.mode = mode
+        self.duplicates = 0
+        self._path = os.path.join(data_dir, f"{DUPLICATES_TYPE}-{file_id}.csv")
+        self._file = None
+        self._writer = None
+        # sessions repeated within the file are in the index under this file already
+        self._seen = set()
+
+    def keep(self, session_data: Dict) -> bool:
+        session_id = str(session_data["sessionId"])
+        if session_id in self._seen:
+            first_file = self.data_file
+        else:
+            self._seen.add(session_id)
+            first_file = self.index.add(session_id, self.data_file)
+            if first_file is None:
+                return True
+
+        self._get_writer().writerow([session_id, self.data_file, first_file])
+        self.duplicates += 1
+        return self.mode != "drop"
+
+    def _get_writer(self):
+        if self._writer is None:
+            self._file = open(self._path, "w")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(["sessionId", "dataFile", "firstDataFile"])
+        return self._writer
+
+    def close(self) -> None:
+        self.index.commit()
+        self._get_writer()
+        self._file.close()
+        if self.duplicates:
+            action = "Dropped" if self.mode == "drop" else "Flagged"
+            logging.warning(f"{action} {self.duplicates} duplicate sessions in {self.data_file}")
+
+    def paths(self) -> Dict[str, Path]:
+        """
+        Path of the side file, keyed by the GCS directory it belongs in
+        """
+        return {DUPLICATES_TYPE: Path(self._path)}
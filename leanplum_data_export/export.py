@@ -1,17 +1,31 @@
+import contextlib
 import csv
+import hashlib
 import json
 import logging
 import os
 import re
+import shutil
 import sys
 import tempfile
+import uuid
+from functools import cached_property
 from pathlib import Path
-from typing import Dict, List, Set
+from typing import IO, Dict, List, Optional, Set
 
-import boto3
-from google.cloud import bigquery, exceptions, storage
+from google.cloud import bigquery, exceptions
 
 from leanplum_data_export import data_parser
+from leanplum_data_export.batch import ColumnBatchWriter
+from leanplum_data_export.cache import DownloadCache
+from leanplum_data_export.clients import ClientConfig, ClientFactory
+from leanplum_data_export.coercion import REJECTS_PREFIX, Coercer, CoercingWriter, Rejects
+from leanplum_data_export.dedup import DEDUP_MODES, DUPLICATES_TYPE, SessionFilter, SessionIndex
+from leanplum_data_export.nested import NESTED_TYPE, JsonLinesWriter
+from leanplum_data_export.pipeline import ByteBudget, Pipeline
+from leanplum_data_export.profiling import Profiler
+from leanplum_data_export.rollups import ROLLUP_SCHEMAS, ROLLUPS_TYPE, Rollups
+from leanplum_data_export.run_state import EventDateRanges, RunState
 
 
 class LeanplumExporter(object):
@@ -19,56 +33,343 @@ class LeanplumExporter(object):
     DROP_COLS = {"sessions": {"lat", "lon"}}
     SCHEMA_DIR = os.path.join(os.path.dirname(__file__), "schemas", "")
     PARTITION_FIELD = "load_date"
+    # columns the destination tables are clustered by, per data type
+    CLUSTER_BY = {
+        "events": ["eventName", "sessionId"],
+        "eventparameters": ["eventId", "name"],
+        "sessions": ["userId"],
+        NESTED_TYPE: ["userId"],
+        DUPLICATES_TYPE: ["sessionId"],
+    }
     DATA_TYPES = [
         "eventparameters", "events", "experiments", "sessions", "states", "userattributes"
     ]
     FILE_HISTORY_PREFIX = "file_history"
-
-    def __init__(self, project):
-        self.bq_client = bigquery.Client(project=project)
-        self.gcs_client = storage.Client(project=project)
-        self.s3_client = boto3.client("s3")
+    SESSION_INDEX_FILE = "session_index.sqlite"
+    SCHEMA_FINGERPRINT_PREFIX = "schema_fingerprints"
+
+    def __init__(self, project, client_config: ClientConfig = None, batch_size: int = 0,
+                 download_cache: DownloadCache = None, profiler: Profiler = None,
+                 coerce_types: bool = True, partition_by: Dict[str, str] = None,
+                 cluster_by: Dict[str, List[str]] = None, nested: bool = False,
+                 rollups: bool = False, workers: int = 1, max_inflight_bytes: int = None,
+                 dedup: str = None, dedup_capacity: int = 10000000):
+        """
+        batch_size > 0 converts sessions in column batches of that many sessions
+        instead of one row at a time.
+        download_cache keeps S3 data files on local disk between runs.
+        profiler records the time and memory used to convert each data file.
+        coerce_types converts values to the encoding of their schema type, values that
+        can't be converted are written to rejects files.
+        partition_by and cluster_by override the partitioning column and clustering columns
+        of the destination tables per data type; tables are partitioned by load_date and
+        clustered according to CLUSTER_BY by default.
+        nested adds the sessions_nested data type, whole sessions with their child rows
+        as repeated records.
+        rollups computes daily aggregates while files are converted and loads them
+        into the rollup tables.
+        workers > 1 downloads, converts and uploads that many data files concurrently,
+        holding at most max_inflight_bytes of downloaded and converted files at once.
+        dedup is "drop" to leave out sessions already seen in another data file of the
+        date, or "flag" to only record them; either way they are loaded into the
+        duplicates table. dedup_capacity sizes the index's Bloom filter.
+        """
+        if dedup is not None and dedup not in DEDUP_MODES:
+            raise ValueError(f"Unrecognized dedup mode: {dedup}")
+        self.clients = ClientFactory(project, client_config)
+        self.batch_size = batch_size
+        self.download_cache = download_cache
+        self.profiler = profiler
+        self.coerce_types = coerce_types
+        self.partition_by = partition_by or {}
+        self.cluster_by = {**self.CLUSTER_BY, **(cluster_by or {})}
+        self.data_types = self.DATA_TYPES + [NESTED_TYPE] if nested else self.DATA_TYPES
+        # duplicates are written by the session filter instead of a writer, but staged
+        # and loaded like a data type
+        self.output_types = self.data_types + [DUPLICATES_TYPE] if dedup else self.data_types
+        # rollups are rebuilt like a data type but loaded into their own tables
+        if rollups:
+            self.output_types = self.output_types + [ROLLUPS_TYPE]
+        self.workers = workers
+        self.max_inflight_bytes = max_inflight_bytes
+        # sizes of the data files found by get_files, for the in-flight budget
+        self.data_file_sizes = {}
+        self.dedup = dedup
+        self.dedup_capacity = dedup_capacity
+        # the date's session index while files are converted
+        self.session_index = None
+        self.validate_table_layouts()
+
+    @cached_property
+    def bq_client(self):
+        return self.clients.bigquery()
+
+    @cached_property
+    def gcs_client(self):
+        return self.clients.gcs()
+
+    @cached_property
+    def s3_client(self):
+        return self.clients.s3()
+
+    @cached_property
+    def coercer(self):
+        return Coercer({data_type: self.parse_schema(data_type) for data_type in self.data_types})
 
     def export(self, date: str, s3_bucket: str, gcs_bucket: str, prefix: str, dataset: str,
-               table_prefix: str, version: str, clean: bool) -> None:
-        schemas = {data_type: [field["name"] for field in self.parse_schema(data_type)]
-                   for data_type in self.DATA_TYPES}
+               table_prefix: str, version: str, clean: bool,
+               only_types: List[str] = None) -> None:
+        """
+        only_types rebuilds just the given data types from every data file of the date.
+        Otherwise data types whose schema changed since the date was last exported are
+        rebuilt, and data files that were not exported yet are converted for all data types.
+        """
+        if only_types is not None:
+            unknown_types = set(only_types) - set(self.output_types)
+            if unknown_types:
+                raise ValueError(f"Unrecognized data types: {', '.join(sorted(unknown_types))}")
+
+        schemas = self.get_schemas()
+        fingerprints = {data_type: self.get_schema_fingerprint(data_type)
+                        for data_type in self.output_types}
 
         data_file_keys = self.get_files(date, s3_bucket, prefix)
 
-        if clean:
+        if clean and only_types is None:
             self.delete_gcs_prefix(self.gcs_client.bucket(gcs_bucket),
                                    self.get_gcs_prefix(prefix, version, date))
 
+        previous_fingerprints = self.get_schema_fingerprints(gcs_bucket, prefix, version, date)
+        if only_types is not None:
+            rebuild_types = [data_type for data_type in self.output_types
+                             if data_type in only_types]
+        else:
+            # data exported before fingerprints were recorded is assumed to be current,
+            # data types without a fingerprint next to ones with one were just enabled
+            rebuild_types = [data_type for data_type in self.output_types
+                             if previous_fingerprints
+                             and previous_fingerprints.get(data_type) != fingerprints[data_type]]
+
+        for data_type in rebuild_types:
+            logging.info(f"Rebuilding {data_type}")
+            for data_type_prefix in (data_type, f"{REJECTS_PREFIX}/{data_type}"):
+                self.delete_gcs_prefix(self.gcs_client.bucket(gcs_bucket),
+                                       self.get_gcs_prefix(prefix, version, date, data_type_prefix))
+
         file_history = self.get_previously_imported_files(gcs_bucket, prefix, version, date)
+        imported_files = set(file_history)
 
-        # Transform data file into csv for each data type and then save to GCS
+        file_jobs = []
         for key in data_file_keys:
             data_file_name = os.path.basename(key)
             if data_file_name in file_history:
-                logging.info(f"Skipping export for {data_file_name}")
-                continue
-
-            with tempfile.TemporaryDirectory() as data_dir:
-                csv_file_paths = self.transform_data_file(key, schemas, data_dir, s3_bucket)
-
-                for data_type, csv_file_path in csv_file_paths.items():
-                    self.write_to_gcs(csv_file_path, data_type, gcs_bucket, prefix, version, date)
-
-            with tempfile.NamedTemporaryFile() as empty_file:
-                self.write_to_gcs(Path(empty_file.name), self.FILE_HISTORY_PREFIX,
-                                  gcs_bucket, prefix, version, date, file_name=data_file_name)
+                if not rebuild_types:
+                    logging.info(f"Skipping export for {data_file_name}")
+                    continue
+                # files in the history only need the rebuilt data types
+                file_schemas = {data_type: schemas[data_type] for data_type in rebuild_types}
+            else:
+                file_schemas = schemas
+            file_jobs.append((key, file_schemas))
+
+        new_files = any(os.path.basename(key) not in file_history for key, _ in file_jobs)
+        imported_files.update(os.path.basename(key) for key, _ in file_jobs)
+
+        self.convert_files(file_jobs, file_history, s3_bucket, gcs_bucket, prefix, version, date)
+
+        # the rebuilt tables must be reloaded by any later run once the fingerprints say
+        # they are current, so their progress is reset first
+        run_state = self.get_run_state(gcs_bucket, prefix, version, date, imported_files)
+        if rebuild_types:
+            run_state.reset(rebuild_types)
+
+        self.write_schema_fingerprints(gcs_bucket, prefix, version, date,
+                                       fingerprints, previous_fingerprints)
+
+        # only the rebuilt tables need to be reloaded unless there is new data
+        output_types = rebuild_types if rebuild_types and not new_files else self.output_types
+        tables = [data_type for data_type in output_types if data_type != ROLLUPS_TYPE]
+
+        self.create_external_tables(gcs_bucket, prefix, date, tables,
+                                    self.TMP_DATASET, dataset, table_prefix, version,
+                                    run_state=run_state)
+        self.delete_existing_data(dataset, table_prefix, tables, version, date,
+                                  run_state=run_state,
+                                  event_dates=self.get_event_dates(gcs_bucket, prefix, version,
+                                                                   date, tables))
+        self.load_tables(self.TMP_DATASET, dataset, table_prefix, tables, version, date,
+                         run_state=run_state)
+        self.drop_external_tables(self.TMP_DATASET, dataset, table_prefix,
+                                  tables, version, date, run_state=run_state)
+        if ROLLUPS_TYPE in output_types:
+            self.load_rollups(gcs_bucket, prefix, version, date, dataset, table_prefix,
+                              run_state=run_state)
 
-        self.create_external_tables(gcs_bucket, prefix, date, self.DATA_TYPES,
-                                    self.TMP_DATASET, dataset, table_prefix, version)
-        self.delete_existing_data(dataset, table_prefix, self.DATA_TYPES, version, date)
-        self.load_tables(self.TMP_DATASET, dataset, table_prefix, self.DATA_TYPES, version, date)
+    def append(self, date: str, data_file_keys: List[str], gcs_bucket: str, prefix: str,
+               dataset: str, table_prefix: str, version: str) -> None:
+        """
+        Append the rows of data files that were converted but not loaded yet to the
+        destination tables, leaving the rows loaded before in place. Rollups are merged
+        from all of the date's files and replace the date's partition as in export.
+        """
+        tables = [data_type for data_type in self.output_types if data_type != ROLLUPS_TYPE]
+
+        self.create_external_tables(gcs_bucket, prefix, date, tables,
+                                    self.TMP_DATASET, dataset, table_prefix, version,
+                                    data_file_keys=data_file_keys)
+        event_dates = self.get_event_dates(gcs_bucket, prefix, version, date, tables)
+        if event_dates is not None:
+            for table in tables:
+                if self.get_partition_field(table) != self.PARTITION_FIELD:
+                    self.record_event_dates(
+                        self.TMP_DATASET,
+                        self.get_table_name(table_prefix, table, version, date, dataset),
+                        table, event_dates)
+        self.load_tables(self.TMP_DATASET, dataset, table_prefix, tables, version, date)
         self.drop_external_tables(self.TMP_DATASET, dataset, table_prefix,
-                                  self.DATA_TYPES, version, date)
+                                  tables, version, date)
+        if ROLLUPS_TYPE in self.output_types:
+            self.load_rollups(gcs_bucket, prefix, version, date, dataset, table_prefix)
 
-    def get_files(self, date: str, bucket: str, prefix: str, max_keys: int = None) -> List[str]:
+    def get_schemas(self) -> Dict[str, List[str]]:
         """
-        Get the s3 keys of the data files in the given bucket
+        Columns of each output type; rollups are listed by table
+        """
+        schemas = {data_type: [field["name"] for field in self.parse_schema(data_type)]
+                   for data_type in self.output_types if data_type != ROLLUPS_TYPE}
+        if ROLLUPS_TYPE in self.output_types:
+            schemas[ROLLUPS_TYPE] = list(ROLLUP_SCHEMAS)
+        return schemas
+
+    def convert_files(self, file_jobs: List, file_history: Set[str], s3_bucket: str,
+                      gcs_bucket: str, prefix: str, version: str, date: str) -> None:
+        """
+        Convert the data files of file_jobs, given as (key, schemas), upload the converted
+        files to GCS and add the data files that are not in file_history to it
+        """
+        with contextlib.ExitStack() as stack:
+            if self.dedup is not None and file_jobs:
+                index_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                self.session_index = self.get_session_index(gcs_bucket, prefix, version, date,
+                                                            index_dir)
+                # saved even if a file fails, the index must cover every file in the history
+                stack.callback(self.save_session_index, gcs_bucket, prefix, version, date)
+
+            if self.workers > 1:
+                self.convert_files_concurrently(file_jobs, file_history, s3_bucket, gcs_bucket,
+                                                prefix, version, date)
+                return
+
+            # Transform data file into csv for each data type and then save to GCS
+            for key, file_schemas in file_jobs:
+                trace_file = (self.profiler.trace_file(key) if self.profiler is not None
+                              else contextlib.nullcontext())
+                with tempfile.TemporaryDirectory() as data_dir:
+                    with trace_file:
+                        csv_file_paths = self.transform_data_file(key, file_schemas, data_dir,
+                                                                  s3_bucket)
+
+                    for data_type, csv_file_path in csv_file_paths.items():
+                        self.write_to_gcs(csv_file_path, data_type, gcs_bucket, prefix,
+                                          version, date)
+
+                if os.path.basename(key) not in file_history:
+                    self.write_file_history(os.path.basename(key), gcs_bucket, prefix,
+                                            version, date)
+
+    def convert_files_concurrently(self, file_jobs: List, file_history: Set[str],
+                                   s3_bucket: str, gcs_bucket: str, prefix: str,
+                                   version: str, date: str) -> None:
+        """
+        Download, convert and upload data files in a pipeline of bounded queues,
+        with workers threads per stage. The in-flight budget covers each file from its
+        download until its converted files are uploaded.
+        """
+        budget = None
+        if self.max_inflight_bytes is not None:
+            budget = ByteBudget(self.max_inflight_bytes)
+
+        with tempfile.TemporaryDirectory() as run_dir:
+
+            def fetch(job):
+                key, file_schemas = job
+                size = self.data_file_sizes.get(key, 0)
+                if budget is not None:
+                    budget.acquire(size)
+                data_dir = tempfile.mkdtemp(dir=run_dir)
+                data_file_path = self.download_data_file(key, data_dir, s3_bucket)
+                return key, file_schemas, data_dir, data_file_path, size
+
+            def convert(fetched):
+                key, file_schemas, data_dir, data_file_path, size = fetched
+                trace_file = (self.profiler.trace_file(key) if self.profiler is not None
+                              else contextlib.nullcontext())
+                try:
+                    with trace_file:
+                        file_paths = self.transform_data_file(key, file_schemas, data_dir,
+                                                              s3_bucket,
+                                                              data_file_path=data_file_path)
+                finally:
+                    self.release_data_file(data_file_path)
+                # the budget now covers the converted files instead of the data file
+                if data_file_path.startswith(data_dir):
+                    os.remove(data_file_path)
+                converted_size = sum(os.path.getsize(path) for path in file_paths.values())
+                if budget is not None:
+                    budget.resize(size, converted_size)
+                return key, data_dir, file_paths, converted_size
+
+            def upload(converted):
+                key, data_dir, file_paths, converted_size = converted
+                try:
+                    for data_type, file_path in file_paths.items():
+                        self.write_to_gcs(file_path, data_type, gcs_bucket, prefix, version, date)
+                    if os.path.basename(key) not in file_history:
+                        self.write_file_history(os.path.basename(key), gcs_bucket, prefix,
+                                                version, date)
+                finally:
+                    shutil.rmtree(data_dir)
+                    if budget is not None:
+                        budget.release(converted_size)
+
+            pipeline = Pipeline(
+                [("download", fetch, self.workers), ("convert", convert, self.workers),
+                 ("upload", upload, self.workers)],
+                queue_size=self.workers, budget=budget, profiler=self.profiler)
+            pipeline.run(file_jobs)
+
+    def get_session_index(self, bucket: str, prefix: str, version: str, date: str,
+                          index_dir: str) -> SessionIndex:
+        """
+        Get the date's session index from GCS, or start a new one
+        """
+        path = os.path.join(index_dir, self.SESSION_INDEX_FILE)
+        blob = self.gcs_client.bucket(bucket).blob(
+            os.path.join(self.get_gcs_prefix(prefix, version, date), self.SESSION_INDEX_FILE))
+        try:
+            blob.download_to_filename(path)
+        except exceptions.NotFound:
+            logging.info("Starting a new session index")
+            if os.path.exists(path):
+                os.remove(path)
+        return SessionIndex(path, self.dedup_capacity)
+
+    def save_session_index(self, bucket: str, prefix: str, version: str, date: str) -> None:
+        session_index, self.session_index = self.session_index, None
+        session_index.close()
+        self.write_to_gcs(Path(session_index.path), "", bucket, prefix, version, date)
+
+    def write_file_history(self, data_file_name: str, bucket: str, prefix: str,
+                           version: str, date: str) -> None:
+        with tempfile.NamedTemporaryFile() as empty_file:
+            self.write_to_gcs(Path(empty_file.name), self.FILE_HISTORY_PREFIX,
+                              bucket, prefix, version, date, file_name=data_file_name)
+
+    def get_files(self, date: str, bucket: str, prefix: str, max_keys: int = None,
+                  allow_empty: bool = False) -> List[str]:
+        """
+        Get the s3 keys of the data files in the given bucket.
+        A date without data files is an error unless allow_empty is set.
         """
         max_keys = {} if max_keys is None else {"MaxKeys": max_keys}  # for testing pagination
         filename_re = re.compile(r"^.*/\d{8}/export-.*-output-([0-9]+)$")
@@ -83,14 +384,19 @@ class LeanplumExporter(object):
                 **max_keys,
             )
 
+            if allow_empty and object_list["KeyCount"] == 0:
+                break
+
             try:
                 assert object_list["KeyCount"] > 0
             except AssertionError:
                 print(f"Error: No data files found for date {date}", file=sys.stderr)
                 raise
 
-            data_file_keys.extend([content["Key"] for content in object_list["Contents"]
-                                   if filename_re.fullmatch(content["Key"])])
+            for content in object_list["Contents"]:
+                if filename_re.fullmatch(content["Key"]):
+                    data_file_keys.append(content["Key"])
+                    self.data_file_sizes[content["Key"]] = content.get("Size", 0)
 
             if not object_list["IsTruncated"]:
                 break
@@ -115,6 +421,46 @@ class LeanplumExporter(object):
 
         return set(file_names)
 
+    def get_schema_fingerprints(self, bucket: str, prefix: str,
+                                version: str, date: str) -> Dict[str, str]:
+        """
+        Get the fingerprints of the schemas the date's data types were exported with.
+        They are stored as empty blobs named <data type>-<fingerprint>.
+        """
+        blobs = self.gcs_client.list_blobs(
+            bucket,
+            prefix=self.get_gcs_prefix(prefix, version, date, self.SCHEMA_FINGERPRINT_PREFIX)
+        )
+        fingerprints = {}
+        for page in blobs.pages:
+            for blob in page:
+                data_type, _, fingerprint = os.path.basename(blob.name).rpartition("-")
+                fingerprints[data_type] = fingerprint
+
+        return fingerprints
+
+    def write_schema_fingerprints(self, bucket: str, prefix: str, version: str, date: str,
+                                  fingerprints: Dict[str, str],
+                                  previous_fingerprints: Dict[str, str]) -> None:
+        gcs_bucket = self.gcs_client.bucket(bucket)
+        fingerprint_prefix = self.get_gcs_prefix(prefix, version, date,
+                                                 self.SCHEMA_FINGERPRINT_PREFIX)
+
+        # data types that are no longer exported must be rebuilt if they are enabled again
+        for data_type in sorted(previous_fingerprints.keys() - fingerprints.keys()):
+            gcs_bucket.delete_blob(os.path.join(
+                fingerprint_prefix, f"{data_type}-{previous_fingerprints[data_type]}"))
+
+        for data_type, fingerprint in fingerprints.items():
+            previous_fingerprint = previous_fingerprints.get(data_type)
+            if previous_fingerprint == fingerprint:
+                continue
+            if previous_fingerprint is not None:
+                gcs_bucket.delete_blob(
+                    os.path.join(fingerprint_prefix, f"{data_type}-{previous_fingerprint}"))
+            blob = gcs_bucket.blob(os.path.join(fingerprint_prefix, f"{data_type}-{fingerprint}"))
+            blob.upload_from_string("")
+
     def write_to_gcs(self, file_path: Path, data_type: str, bucket: str,
                      prefix: str, version: str, date: str, file_name: str = None) -> None:
         """
@@ -128,62 +474,264 @@ class LeanplumExporter(object):
         logging.info(f"Uploading {file_name} to gs://{gcs_path}")
         # set lower chunksize to avoid timeouts after 60s while uploading chunks (default is 100MB)
         # More details here: https://github.com/googleapis/python-storage/issues/74
-        blob = self.gcs_client.bucket(bucket).blob(gcs_path, chunk_size=1024*1024*50)
+        blob = self.gcs_client.bucket(bucket).blob(
+            gcs_path, chunk_size=self.clients.config.gcs_chunk_size)
         blob.upload_from_filename(str(file_path))
 
     def write_to_csv(self, csv_writers: Dict[str, csv.DictWriter], session_data: Dict,
                      schemas: Dict[str, List[str]]) -> None:
-        for user_attribute in data_parser.extract_user_attributes(session_data):
-            csv_writers["userattributes"].writerow(user_attribute)
-
-        for state in data_parser.extract_states(session_data):
-            csv_writers["states"].writerow(state)
-
-        for experiment in data_parser.extract_experiments(session_data):
-            csv_writers["experiments"].writerow(experiment)
-
-        csv_writers["sessions"].writerow(
-            data_parser.extract_session(session_data, schemas["sessions"]))
-
-        events, event_parameters = data_parser.extract_events(session_data)
-        for event in events:
-            csv_writers["events"].writerow(event)
-        for event_parameter in event_parameters:
-            csv_writers["eventparameters"].writerow(event_parameter)
+        """
+        Write the rows of a session for each data type that has a writer
+        """
+        if "userattributes" in csv_writers:
+            for user_attribute in data_parser.extract_user_attributes(session_data):
+                csv_writers["userattributes"].writerow(user_attribute)
+
+        if "states" in csv_writers:
+            for state in data_parser.extract_states(session_data):
+                csv_writers["states"].writerow(state)
+
+        if "experiments" in csv_writers:
+            for experiment in data_parser.extract_experiments(session_data):
+                csv_writers["experiments"].writerow(experiment)
+
+        if "sessions" in csv_writers:
+            csv_writers["sessions"].writerow(
+                data_parser.extract_session(session_data, schemas["sessions"]))
+
+        if "events" in csv_writers or "eventparameters" in csv_writers:
+            events, event_parameters = data_parser.extract_events(session_data)
+            if "events" in csv_writers:
+                for event in events:
+                    csv_writers["events"].writerow(event)
+            if "eventparameters" in csv_writers:
+                for event_parameter in event_parameters:
+                    csv_writers["eventparameters"].writerow(event_parameter)
+
+        if NESTED_TYPE in csv_writers:
+            csv_writers[NESTED_TYPE].writerow(
+                data_parser.extract_nested_session(session_data, schemas[NESTED_TYPE]))
 
     def transform_data_file(self, data_file_key: str, schemas: Dict[str, List[str]],
-                            data_dir: str, bucket: str) -> Dict[str, Path]:
+                            data_dir: str, bucket: str,
+                            data_file_path: str = None) -> Dict[str, Path]:
         """
-        Get data file contents and convert from JSON to CSV for each data type and
-        return paths to the files.
+        Get data file contents and convert from JSON to CSV for each data type in schemas
+        (or to newline-delimited JSON for sessions_nested) and return paths to the files.
         The JSON data file is not in a format that can be loaded into bigquery.
+        data_file_path is the data file if it was already downloaded.
         """
         logging.info(f"Exporting {data_file_key}")
 
-        # downloading the entire file at once is much faster than using boto3 s3 streaming
-        self.s3_client.download_file(bucket, data_file_key, os.path.join(data_dir, "data.ndjson"))
+        if data_file_path is not None:
+            return self._convert_data_file(data_file_key, schemas, data_dir, data_file_path)
 
-        file_id = "-".join(data_file_key.split("-")[2:])
-        csv_file_paths = {data_type: Path(os.path.join(data_dir, f"{data_type}-{file_id}.csv"))
-                          for data_type in self.DATA_TYPES}
+        data_file_path = self.download_data_file(data_file_key, data_dir, bucket)
+        try:
+            return self._convert_data_file(data_file_key, schemas, data_dir, data_file_path)
+        finally:
+            self.release_data_file(data_file_path)
+
+    def _convert_data_file(self, data_file_key: str, schemas: Dict[str, List[str]],
+                           data_dir: str, data_file_path: str) -> Dict[str, Path]:
+        file_id = self.get_file_id(data_file_key)
+        csv_file_paths = {
+            data_type: Path(os.path.join(
+                data_dir, self.get_converted_file_name(data_type, data_file_key)))
+            for data_type in self.data_types if data_type in schemas
+        }
         csv_files = {data_type: open(file_path, "w")
                      for data_type, file_path in csv_file_paths.items()}
+        rejects = Rejects(data_dir, file_id) if self.coerce_types else None
+        rollups = Rollups() if ROLLUPS_TYPE in schemas else None
+        session_filter = None
+        if self.session_index is not None:
+            session_filter = SessionFilter(self.session_index, os.path.basename(data_file_key),
+                                           self.dedup, data_dir, file_id)
         try:
-            csv_writers = {data_type: csv.DictWriter(csv_files[data_type], schemas[data_type],
-                                                     extrasaction="ignore")
-                           for data_type in self.DATA_TYPES}
-            for csv_writer in csv_writers.values():
-                csv_writer.writeheader()
-            with open(os.path.join(data_dir, "data.ndjson")) as f:
-                for line in f:
-                    session_data = json.loads(line)
-                    self.write_to_csv(csv_writers, session_data, schemas)
+            if self.batch_size > 0:
+                self.write_batches(csv_files, data_file_path, schemas, rejects, rollups,
+                                   session_filter)
+            else:
+                self.write_rows(csv_files, data_file_path, schemas, rejects, rollups,
+                                session_filter)
         finally:
             for csv_file in csv_files.values():
                 csv_file.close()
-
+            if rejects is not None:
+                rejects.close()
+            if session_filter is not None:
+                session_filter.close()
+
+        if rejects is not None:
+            csv_file_paths.update(rejects.paths())
+        if session_filter is not None:
+            csv_file_paths.update(session_filter.paths())
+        if rollups is not None:
+            # a partial rollup of the file, merged with the date's other files when loaded
+            csv_file_paths[ROLLUPS_TYPE] = Path(os.path.join(data_dir, f"rollups-{file_id}.json"))
+            with open(csv_file_paths[ROLLUPS_TYPE], "w") as rollups_file:
+                json.dump(rollups.to_dict(), rollups_file)
         return csv_file_paths
 
+    def download_data_file(self, data_file_key: str, data_dir: str, bucket: str) -> str:
+        """
+        Download the data file, or find it in the download cache, and return its local path
+        """
+        destination = os.path.join(data_dir, "data.ndjson")
+        transfer_config = self.clients.s3_transfer_config()
+
+        if self.download_cache is not None:
+            return self.download_cache.fetch(self.s3_client, bucket, data_file_key,
+                                             destination, transfer_config)
+
+        # downloading the entire file at once is much faster than using boto3 s3 streaming
+        self.s3_client.download_file(bucket, data_file_key, destination, Config=transfer_config)
+        return destination
+
+    def release_data_file(self, data_file_path: str) -> None:
+        """
+        Let the download cache evict a downloaded data file that has been converted
+        """
+        if self.download_cache is not None:
+            self.download_cache.release(data_file_path)
+
+    def write_rows(self, csv_files: Dict[str, IO], data_file_path: str,
+                   schemas: Dict[str, List[str]], rejects: Rejects = None,
+                   rollups: Rollups = None, session_filter: SessionFilter = None) -> None:
+        """
+        Convert the data file one session at a time.
+        Values are converted to their schema type if rejects is given,
+        sessions are counted into rollups if given, and only sessions that
+        session_filter keeps are converted.
+        """
+        csv_writers = {data_type: self.get_row_writer(csv_file, data_type, schemas[data_type])
+                       for data_type, csv_file in csv_files.items()}
+        if rejects is not None:
+            csv_writers = {data_type: CoercingWriter(csv_writer, data_type, self.coercer, rejects)
+                           for data_type, csv_writer in csv_writers.items()}
+        for csv_writer in csv_writers.values():
+            csv_writer.writeheader()
+        with open(data_file_path) as f:
+            for line in f:
+                session_data = json.loads(line)
+                if session_filter is not None and not session_filter.keep(session_data):
+                    continue
+                self.write_to_csv(csv_writers, session_data, schemas)
+                if rollups is not None:
+                    rollups.add(session_data)
+
+    def write_batches(self, csv_files: Dict[str, IO], data_file_path: str,
+                      schemas: Dict[str, List[str]], rejects: Rejects = None,
+                      rollups: Rollups = None, session_filter: SessionFilter = None) -> None:
+        """
+        Convert the data file in column batches of batch_size sessions.
+        Values are converted to their schema type if rejects is given,
+        sessions are counted into rollups if given, and only sessions that
+        session_filter keeps are converted.
+        """
+        csv_writers = {data_type: csv.writer(csv_file) for data_type, csv_file in csv_files.items()
+                       if data_type != NESTED_TYPE}
+        for data_type, csv_writer in csv_writers.items():
+            csv_writer.writerow(schemas[data_type])
+        converters = None
+        if rejects is not None:
+            converters = {data_type: self.coercer.column_converters(data_type, rejects)
+                          for data_type in csv_writers}
+        batch_writer = ColumnBatchWriter(csv_writers, schemas, self.batch_size, converters)
+
+        # nested sessions are records already, they are written a session at a time
+        nested_writer = None
+        if NESTED_TYPE in csv_files:
+            nested_writer = JsonLinesWriter(csv_files[NESTED_TYPE])
+            if rejects is not None:
+                nested_writer = CoercingWriter(nested_writer, NESTED_TYPE, self.coercer, rejects)
+
+        with open(data_file_path) as f:
+            for line in f:
+                session_data = json.loads(line)
+                if session_filter is not None and not session_filter.keep(session_data):
+                    continue
+                batch_writer.add(session_data)
+                if nested_writer is not None:
+                    nested_writer.writerow(data_parser.extract_nested_session(
+                        session_data, schemas[NESTED_TYPE]))
+                if rollups is not None:
+                    rollups.add(session_data)
+        batch_writer.flush()
+
+    def get_row_writer(self, output: IO, data_type: str, columns: List[str]):
+        """
+        Writer of one data type's rows, with the interface of csv.DictWriter
+        """
+        if data_type == NESTED_TYPE:
+            return JsonLinesWriter(output)
+        return csv.DictWriter(output, columns, extrasaction="ignore")
+
+    @staticmethod
+    def get_file_extension(data_type):
+        return "ndjson" if data_type == NESTED_TYPE else "csv"
+
+    @staticmethod
+    def get_file_id(data_file_key):
+        return "-".join(data_file_key.split("-")[2:])
+
+    def get_converted_file_name(self, data_type, data_file_key):
+        return (f"{data_type}-{self.get_file_id(data_file_key)}."
+                f"{self.get_file_extension(data_type)}")
+
+    def get_run_state(self, bucket: str, prefix: str, version: str, date: str,
+                      files: Set[str]) -> RunState:
+        """
+        Get the progress of the BigQuery stages for the date, if it was recorded for
+        the same set of data files
+        """
+        path = os.path.join(self.get_gcs_prefix(prefix, version, date), RunState.FILE_NAME)
+        return RunState.load(self.gcs_client, bucket, path, files)
+
+    def get_event_dates(self, bucket: str, prefix: str, version: str, date: str,
+                        tables: List[str]) -> Optional[EventDateRanges]:
+        """
+        Get the event dates loaded for the date, if any of the tables is partitioned by
+        event time
+        """
+        if all(self.get_partition_field(table) == self.PARTITION_FIELD for table in tables):
+            return None
+        path = os.path.join(self.get_gcs_prefix(prefix, version, date), EventDateRanges.FILE_NAME)
+        return EventDateRanges.load(self.gcs_client, bucket, path)
+
+    def run_query(self, sql: str, stage: str, table: str, date: str,
+                  run_state: RunState = None) -> None:
+        """
+        Run a query and wait for it to finish.
+        With a run state, a job that was started by a previous run is waited for instead
+        of starting the query again, unless it failed.
+        """
+        if run_state is not None:
+            job_id = run_state.get_job_id(stage, table)
+            if job_id is not None:
+                try:
+                    job = self.bq_client.get_job(job_id)
+                except exceptions.NotFound:
+                    job = None
+
+                if job is not None and (job.state != "DONE" or job.error_result is None):
+                    logging.info(f"Reattaching to {stage} job {job_id} for {table}")
+                    job.result()
+                    run_state.mark_done(stage, table)
+                    return
+
+        job_id = f"leanplum_{stage}_{table}_{date}_{uuid.uuid4().hex}"
+        if run_state is not None:
+            # recorded before the job starts so that it can't run without the state knowing
+            run_state.set_job_id(stage, table, job_id)
+
+        job = self.bq_client.query(sql, job_id=job_id)
+        job.result()
+
+        if run_state is not None:
+            run_state.mark_done(stage, table)
+
     def delete_gcs_prefix(self, bucket, prefix):
         blobs = self.gcs_client.list_blobs(bucket, prefix=prefix)
 
@@ -191,15 +739,22 @@ class LeanplumExporter(object):
             bucket.delete_blobs(list(page))
 
     def create_external_tables(self, bucket_name, prefix, date, tables,
-                               ext_dataset, dataset, table_prefix, version):
+                               ext_dataset, dataset, table_prefix, version, run_state=None,
+                               data_file_keys=None):
         """
-        Create external tables using CSVs in GCS as the data source
+        Create external tables using CSVs (or newline-delimited JSON for sessions_nested)
+        in GCS as the data source.
+        data_file_keys restricts the source to the converted files of those data files.
         """
         gcs_loc = f"gs://{bucket_name}/{self.get_gcs_prefix(prefix, version, date)}"
         dataset_ref = self.bq_client.dataset(ext_dataset)
 
         for leanplum_name in tables:
             table_name = self.get_table_name(table_prefix, leanplum_name, version, date, dataset)
+            if run_state is not None and run_state.is_done("create", leanplum_name):
+                logging.info(f"External table {ext_dataset}.{table_name} was already created")
+                continue
+
             logging.info(f"Creating external table {ext_dataset}.{table_name}")
 
             table_ref = bigquery.TableReference(dataset_ref, table_name)
@@ -207,43 +762,80 @@ class LeanplumExporter(object):
 
             self.bq_client.delete_table(table, not_found_ok=True)
 
-            schema = [
-                bigquery.SchemaField(
-                    field["name"],
-                    field_type=field.get("type", "STRING"),
-                    mode=field.get("mode", "NULLABLE"),
-                )
-                for field in self.parse_schema(leanplum_name)
-            ]
-
-            external_config = bigquery.ExternalConfig('CSV')
-            external_config.source_uris = [os.path.join(gcs_loc, leanplum_name, "*")]
+            schema = self.get_schema_fields(self.parse_schema(leanplum_name))
+
+            if leanplum_name == NESTED_TYPE:
+                external_config = bigquery.ExternalConfig("NEWLINE_DELIMITED_JSON")
+            else:
+                external_config = bigquery.ExternalConfig('CSV')
+                external_config.options.skip_leading_rows = 1
+                external_config.options.allow_quoted_newlines = True
+            if data_file_keys is None:
+                external_config.source_uris = [os.path.join(gcs_loc, leanplum_name, "*")]
+            else:
+                external_config.source_uris = [
+                    os.path.join(gcs_loc, leanplum_name,
+                                 self.get_converted_file_name(leanplum_name, key))
+                    for key in data_file_keys]
             external_config.schema = schema
             # there are rare cases of corrupted values that should be ignored instead of failing
             external_config.max_bad_records = 100
-            external_config.options.skip_leading_rows = 1
-            external_config.options.allow_quoted_newlines = True
 
             table.external_data_configuration = external_config
 
             self.bq_client.create_table(table)
 
-    def delete_existing_data(self, dataset, table_prefix, tables, version, date):
+            if run_state is not None:
+                run_state.mark_done("create", leanplum_name)
+
+    def delete_existing_data(self, dataset, table_prefix, tables, version, date, run_state=None,
+                             event_dates=None):
         """
-        Delete existing data in the target table partition
+        Delete existing data in the target table partition.
+        For tables partitioned by event time, event_dates limits the DELETE to the event
+        dates loaded for the date, after adding those of the staged data to it.
         """
+        destination_dataset = self.bq_client.dataset(dataset)
+
         for table in tables:
             table_name = self.get_table_name(table_prefix, table, version)
+            if run_state is not None and run_state.is_done("delete", table):
+                logging.info(f"Data was already deleted from {dataset}.{table_name}")
+                continue
+
+            partition_field = self.get_partition_field(table)
+            recorded_dates = date_range = None
+            if partition_field != self.PARTITION_FIELD and event_dates is not None:
+                ext_table_name = self.get_table_name(table_prefix, table, version, date, dataset)
+                recorded_dates, date_range = self.record_event_dates(
+                    self.TMP_DATASET, ext_table_name, table, event_dates)
+
+            # the first load of a table creates it, there is nothing to delete yet
+            if not self.get_table_exists(bigquery.TableReference(destination_dataset,
+                                                                 table_name)):
+                logging.info(f"Table {dataset}.{table_name} doesn't exist yet")
+                if run_state is not None:
+                    run_state.mark_done("delete", table)
+                continue
 
             delete_sql = (
                 f"DELETE FROM `{dataset}.{table_name}` "
                 f"WHERE {self.PARTITION_FIELD} = PARSE_DATE('%Y%m%d', '{date}')")
+            if partition_field != self.PARTITION_FIELD:
+                if recorded_dates is None:
+                    # rows loaded before the dates were recorded can be in any partition
+                    logging.warning(f"No {partition_field} dates were recorded for {date} in "
+                                    f"{dataset}.{table_name}, deleting without a partition "
+                                    f"filter scans the whole table")
+                else:
+                    delete_sql += self.get_partition_filter_sql(partition_field, *date_range)
 
             logging.info(f"Deleting data from {dataset}.{table_name}")
             logging.info(delete_sql)
-            self.bq_client.query(delete_sql)
+            self.run_query(delete_sql, "delete", table, date, run_state)
 
-    def load_tables(self, ext_dataset, dataset, table_prefix, tables, version, date):
+    def load_tables(self, ext_dataset, dataset, table_prefix, tables, version, date,
+                    run_state=None):
         """
         Load data from external tables into final tables using SELECT statement
         """
@@ -252,6 +844,9 @@ class LeanplumExporter(object):
         for table in tables:
             ext_table_name = self.get_table_name(table_prefix, table, version, date, dataset)
             table_name = self.get_table_name(table_prefix, table, version)
+            if run_state is not None and run_state.is_done("load", table):
+                logging.info(f"Data was already loaded into {dataset}.{table_name}")
+                continue
 
             destination_table = bigquery.TableReference(destination_dataset, table_name)
 
@@ -267,8 +862,9 @@ class LeanplumExporter(object):
             if not self.get_table_exists(destination_table):
                 sql = (
                     f"CREATE TABLE `{dataset}.{table_name}` "
-                    f"PARTITION BY {self.PARTITION_FIELD} AS {select_sql}")
+                    f"{self.get_table_layout_sql(table)} AS {select_sql}")
             else:
+                self.update_table_layout(destination_table, table)
                 sql = f"INSERT INTO `{dataset}.{table_name}` {select_sql}"
 
             logging.info((
@@ -276,10 +872,10 @@ class LeanplumExporter(object):
                 f"from {ext_dataset}.{ext_table_name}"))
             logging.info(sql)
 
-            job = self.bq_client.query(sql)
-            job.result()
+            self.run_query(sql, "load", table, date, run_state)
 
-    def drop_external_tables(self, ext_dataset, dataset, table_prefix, tables, version, date):
+    def drop_external_tables(self, ext_dataset, dataset, table_prefix, tables, version, date,
+                             run_state=None):
         """
         Delete temporary tables used for loading data into final tables
         """
@@ -287,12 +883,146 @@ class LeanplumExporter(object):
 
         for leanplum_name in tables:
             table_name = self.get_table_name(table_prefix, leanplum_name, version, date, dataset)
+            if run_state is not None and run_state.is_done("drop", leanplum_name):
+                continue
             table_ref = bigquery.TableReference(dataset_ref, table_name)
             table = bigquery.Table(table_ref)
 
             logging.info(f"Dropping table {ext_dataset}.{table_name}")
 
-            self.bq_client.delete_table(table)
+            self.bq_client.delete_table(table, not_found_ok=True)
+
+            if run_state is not None:
+                run_state.mark_done("drop", leanplum_name)
+
+    def load_rollups(self, bucket, prefix, version, date, dataset, table_prefix, run_state=None):
+        """
+        Merge the partial rollups of the date's data files and replace the date's
+        partition of each rollup table with them
+        """
+        if run_state is not None and run_state.is_done("load", ROLLUPS_TYPE):
+            logging.info(f"Rollups were already loaded into {dataset}")
+            return
+
+        rollups = self.get_rollups(bucket, prefix, version, date)
+        for table, rows in rollups.get_rows(self.get_load_date(date)).items():
+            table_name = self.get_table_name(table_prefix, table, version)
+            if not rows:
+                logging.info(f"No rows for {dataset}.{table_name}")
+                continue
+
+            job_config = bigquery.LoadJobConfig(
+                schema=self.get_schema_fields(
+                    ROLLUP_SCHEMAS[table] + [{"type": "DATE", "name": self.PARTITION_FIELD}]),
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                time_partitioning=self.get_time_partitioning(table),
+                clustering_fields=self.get_clustering_fields(table),
+            )
+            logging.info(f"Loading {len(rows)} rows into {dataset}.{table_name}")
+            self.bq_client.load_table_from_json(
+                rows, f"{dataset}.{table_name}${date}", job_config=job_config).result()
+
+        if run_state is not None:
+            run_state.mark_done("load", ROLLUPS_TYPE)
+
+    def get_rollups(self, bucket: str, prefix: str, version: str, date: str) -> Rollups:
+        """
+        Merge the partial rollups of the date's data files
+        """
+        rollups = Rollups()
+        blobs = self.gcs_client.list_blobs(
+            bucket, prefix=self.get_gcs_prefix(prefix, version, date, ROLLUPS_TYPE))
+        for page in blobs.pages:
+            for blob in page:
+                rollups.merge(Rollups.from_dict(json.loads(blob.download_as_string())))
+        return rollups
+
+    def validate_table_layouts(self):
+        for data_type, column in self.partition_by.items():
+            if column == self.PARTITION_FIELD:
+                continue
+            types = {field["name"]: field.get("type") for field in self.parse_schema(data_type)}
+            if types.get(column) not in ("TIMESTAMP", "DATE"):
+                raise ValueError(f"{data_type} can't be partitioned by {column}, "
+                                 f"it must be a TIMESTAMP or DATE column or {self.PARTITION_FIELD}")
+
+        for data_type, columns in self.cluster_by.items():
+            names = ({field["name"] for field in self.parse_schema(data_type)}
+                     - self.DROP_COLS.get(data_type, set())) | {self.PARTITION_FIELD}
+            unknown = [column for column in columns if column not in names]
+            if unknown or len(columns) > 4:
+                raise ValueError(f"{data_type} can't be clustered by {', '.join(columns)}; "
+                                 f"up to 4 of its columns can be used")
+
+    def get_partition_field(self, data_type):
+        return self.partition_by.get(data_type, self.PARTITION_FIELD)
+
+    def get_clustering_fields(self, data_type):
+        return self.cluster_by.get(data_type) or None
+
+    def get_time_partitioning(self, data_type):
+        """
+        Partitioning of the destination table, for job configurations such as
+        WRITE_TRUNCATE loads which must match the table's layout
+        """
+        return bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY,
+                                         field=self.get_partition_field(data_type))
+
+    def record_event_dates(self, ext_dataset, ext_table_name, table, event_dates):
+        """
+        Add the event dates of a table's staged data to those recorded for the date, before
+        the data is loaded. Returns the recorded range from before and after.
+        Partition pruning needs constants, so the dates are queried first.
+        """
+        partition_field = self.get_partition_field(table)
+        recorded_dates = event_dates.get(table)
+        rows = list(self.bq_client.query(
+            f"SELECT MIN(DATE({partition_field})) AS first_date, "
+            f"MAX(DATE({partition_field})) AS last_date "
+            f"FROM `{ext_dataset}.{ext_table_name}`").result())
+        if rows and rows[0].first_date is not None:
+            event_dates.extend(table, rows[0].first_date.isoformat(),
+                               rows[0].last_date.isoformat())
+        return recorded_dates, event_dates.get(table)
+
+    def get_partition_filter_sql(self, partition_field, first_date, last_date):
+        """
+        Restrict a DELETE on a table partitioned by event time to the partitions the
+        date's rows can be in, so that it doesn't scan the whole table
+        """
+        return (f" AND ({partition_field} IS NULL OR DATE({partition_field}) "
+                f"BETWEEN '{first_date}' AND '{last_date}')")
+
+    def get_table_layout_sql(self, data_type):
+        partition_field = self.get_partition_field(data_type)
+        if partition_field == self.PARTITION_FIELD:
+            sql = f"PARTITION BY {partition_field}"
+        else:
+            sql = f"PARTITION BY DATE({partition_field})"
+
+        clustering_fields = self.get_clustering_fields(data_type)
+        if clustering_fields:
+            sql += f" CLUSTER BY {', '.join(clustering_fields)}"
+        return sql
+
+    def update_table_layout(self, table_ref, data_type):
+        """
+        Bring the clustering of an existing table in line with its configuration.
+        Partitioning can't be changed once a table is created.
+        """
+        table = self.bq_client.get_table(table_ref)
+        clustering_fields = self.get_clustering_fields(data_type)
+        if table.clustering_fields != clustering_fields:
+            logging.info(f"Clustering {table.table_id} by {clustering_fields}")
+            table.clustering_fields = clustering_fields
+            self.bq_client.update_table(table, ["clustering_fields"])
+
+        partition_field = self.get_partition_field(data_type)
+        if table.time_partitioning is not None and \
+                table.time_partitioning.field != partition_field:
+            logging.warning(f"{table.table_id} is partitioned by "
+                            f"{table.time_partitioning.field} instead of {partition_field}; "
+                            f"recreate it to change its partitioning")
 
     def get_table_exists(self, table):
         try:
@@ -315,6 +1045,23 @@ class LeanplumExporter(object):
 
         return name
 
+    def get_schema_fields(self, fields):
+        return [
+            bigquery.SchemaField(
+                field["name"],
+                field_type=field.get("type", "STRING"),
+                mode=field.get("mode", "NULLABLE"),
+                fields=self.get_schema_fields(field.get("fields", [])),
+            )
+            for field in fields
+        ]
+
+    def get_schema_fingerprint(self, data_type):
+        if data_type == ROLLUPS_TYPE:
+            return Rollups.get_fingerprint()
+        schema = json.dumps(self.parse_schema(data_type), sort_keys=True)
+        return hashlib.sha256(schema.encode()).hexdigest()[:16]
+
     def parse_schema(self, data_type):
         try:
             with open(os.path.join(
@@ -323,6 +1070,10 @@ class LeanplumExporter(object):
         except FileNotFoundError:
             raise ValueError(f"Unrecognized table name encountered: {data_type}")
 
+    @staticmethod
+    def get_load_date(date):
+        return f"{date[:4]}-{date[4:6]}-{date[6:]}"
+
     @staticmethod
     def get_gcs_prefix(prefix, version, date, data_type=None):
         if data_type is None:
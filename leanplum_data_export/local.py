@@ -0,0 +1,347 @@
+"""
+Run a whole export on one machine, without S3, GCS or BigQuery.
+
+LocalExporter reads data files from a local directory laid out like the S3 bucket,
+stages its output in a local directory laid out like the GCS bucket, and loads the
+tables into a SQLite database. The S3 and GCS clients are replaced by stand-ins that
+implement the calls the exporter makes, so conversion, file history, schema
+fingerprints and run state work exactly as they do in production; only the
+BigQuery stages are reimplemented in SQL that SQLite understands.
+"""
+
+import csv
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+from functools import cached_property
+from typing import Dict, List
+
+from google.cloud import exceptions
+
+from leanplum_data_export.export import LeanplumExporter
+from leanplum_data_export.nested import NESTED_TYPE
+from leanplum_data_export.rollups import ROLLUP_SCHEMAS, ROLLUPS_TYPE
+
+SQLITE_TYPES = {"INTEGER": "INTEGER", "FLOAT": "REAL"}
+
+
+class LocalExportUnsupported(RuntimeError):
+    """
+    Raised by the parts of LeanplumExporter that only work against BigQuery
+    """
+
+    def __init__(self, operation: str):
+        super().__init__(f"export-local loads into SQLite and doesn't support {operation}, "
+                         f"which needs BigQuery")
+
+
+class LocalS3Client(object):
+    """
+    The S3 calls of the exporter, where a bucket is a local directory
+    """
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None, MaxKeys=1000):
+        keys = sorted(
+            os.path.relpath(path, Bucket).replace(os.sep, "/")
+            for path in glob.glob(os.path.join(Bucket, "**"), recursive=True)
+            if os.path.isfile(path)
+        )
+        keys = [key for key in keys if key.startswith(Prefix)]
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + MaxKeys]
+        response = {
+            "KeyCount": len(page),
+            "Contents": [{"Key": key, "Size": os.path.getsize(os.path.join(Bucket, key))}
+                         for key in page],
+            "IsTruncated": start + MaxKeys < len(keys),
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + MaxKeys)
+        return response
+
+    def head_object(self, Bucket, Key):
+        # the MD5 of the content, like the ETag of an object uploaded in one part
+        path = os.path.join(Bucket, Key)
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(block)
+        return {"ETag": f'"{md5.hexdigest()}"', "ContentLength": os.path.getsize(path)}
+
+    def download_file(self, bucket, key, filename, Config=None):
+        shutil.copyfile(os.path.join(bucket, key), filename)
+
+
+class LocalBlob(object):
+
+    def __init__(self, bucket: "LocalBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.name, name)
+
+    def upload_from_filename(self, filename):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+    def upload_from_string(self, data, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(data.encode() if isinstance(data, str) else data)
+
+    def download_to_filename(self, filename):
+        try:
+            shutil.copyfile(self.path, filename)
+        except FileNotFoundError:
+            raise exceptions.NotFound(f"No such file: {self.path}")
+
+    def download_as_string(self):
+        try:
+            with open(self.path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise exceptions.NotFound(f"No such file: {self.path}")
+
+
+class LocalBucket(object):
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def blob(self, name, chunk_size=None):
+        return LocalBlob(self, name)
+
+    def delete_blob(self, name):
+        try:
+            os.remove(os.path.join(self.name, name))
+        except FileNotFoundError:
+            raise exceptions.NotFound(f"No such file: {name}")
+
+    def delete_blobs(self, blobs):
+        for blob in blobs:
+            os.remove(blob.path)
+
+
+class LocalBlobs(object):
+
+    def __init__(self, blobs: List[LocalBlob]):
+        self.pages = [blobs]
+
+
+class LocalStorageClient(object):
+    """
+    The GCS calls of the exporter, where a bucket is a local directory
+    """
+
+    def bucket(self, name):
+        return LocalBucket(name)
+
+    def list_blobs(self, bucket, prefix=""):
+        if not isinstance(bucket, LocalBucket):
+            bucket = self.bucket(bucket)
+        names = sorted(
+            os.path.relpath(path, bucket.name).replace(os.sep, "/")
+            for path in glob.glob(os.path.join(bucket.name, "**"), recursive=True)
+            if os.path.isfile(path)
+        )
+        return LocalBlobs([bucket.blob(name) for name in names if name.startswith(prefix)])
+
+
+class LocalExporter(LeanplumExporter):
+    """
+    LeanplumExporter that reads from and stages in local directories and loads into SQLite.
+    The S3 and GCS bucket arguments of export are directories, and datasets are
+    prefixes of table names, e.g. "leanplum.sessions_v1".
+    """
+
+    def __init__(self, database: str, **kwargs):
+        super().__init__("local", **kwargs)
+        self.database = database
+
+        partitioned = [data_type for data_type, column in self.partition_by.items()
+                       if column != self.PARTITION_FIELD]
+        if partitioned:
+            raise ValueError(f"export-local only partitions by {self.PARTITION_FIELD}, "
+                             f"not {', '.join(sorted(partitioned))} by event time")
+
+    @cached_property
+    def s3_client(self):
+        return LocalS3Client()
+
+    @cached_property
+    def gcs_client(self):
+        return LocalStorageClient()
+
+    @cached_property
+    def bq_client(self):
+        raise LocalExportUnsupported("the BigQuery client")
+
+    @cached_property
+    def connection(self):
+        return sqlite3.connect(self.database)
+
+    def create_external_tables(self, bucket_name, prefix, date, tables,
+                               ext_dataset, dataset, table_prefix, version, run_state=None,
+                               data_file_keys=None):
+        """
+        Copy the staged files into temporary tables; SQLite has no external tables
+        """
+        for leanplum_name in tables:
+            table_name = self.get_table_name(table_prefix, leanplum_name, version, date, dataset)
+            if run_state is not None and run_state.is_done("create", leanplum_name):
+                logging.info(f"External table {ext_dataset}.{table_name} was already created")
+                continue
+
+            logging.info(f"Creating external table {ext_dataset}.{table_name}")
+            ext_table = self.get_sqlite_name(ext_dataset, table_name)
+            schema = self.parse_schema(leanplum_name)
+            columns = [field["name"] for field in schema]
+            self.connection.execute(f"DROP TABLE IF EXISTS {ext_table}")
+            self.connection.execute(f"CREATE TABLE {ext_table} ({self.get_columns_sql(schema)})")
+
+            staged_dir = os.path.join(
+                bucket_name, self.get_gcs_prefix(prefix, version, date, leanplum_name))
+            if data_file_keys is None:
+                staged_files = sorted(glob.glob(os.path.join(staged_dir, "*")))
+            else:
+                staged_files = [
+                    os.path.join(staged_dir, self.get_converted_file_name(leanplum_name, key))
+                    for key in data_file_keys]
+            insert_sql = (f"INSERT INTO {ext_table} VALUES "
+                          f"({', '.join('?' * len(columns))})")
+            for staged_file in staged_files:
+                with open(staged_file) as f:
+                    self.connection.executemany(
+                        insert_sql, self.read_staged_rows(f, leanplum_name, columns))
+            self.connection.commit()
+
+            if run_state is not None:
+                run_state.mark_done("create", leanplum_name)
+
+    def read_staged_rows(self, staged_file, data_type: str, columns: List[str]):
+        if data_type == NESTED_TYPE:
+            for line in staged_file:
+                record = json.loads(line)
+                yield [json.dumps(value) if isinstance(value, (list, dict)) else value
+                       for value in map(record.get, columns)]
+        else:
+            # empty CSV values are NULLs, as in BigQuery
+            for row in csv.DictReader(staged_file):
+                yield [row.get(column) or None for column in columns]
+
+    def delete_existing_data(self, dataset, table_prefix, tables, version, date, run_state=None,
+                             event_dates=None):
+        for table in tables:
+            table_name = self.get_table_name(table_prefix, table, version)
+            if run_state is not None and run_state.is_done("delete", table):
+                logging.info(f"Data was already deleted from {dataset}.{table_name}")
+                continue
+
+            logging.info(f"Deleting data from {dataset}.{table_name}")
+            if self.get_table_exists(self.get_sqlite_name(dataset, table_name)):
+                self.connection.execute(
+                    f"DELETE FROM {self.get_sqlite_name(dataset, table_name)} "
+                    f"WHERE {self.PARTITION_FIELD} = ?", (self.get_load_date(date),))
+                self.connection.commit()
+
+            if run_state is not None:
+                run_state.mark_done("delete", table)
+
+    def load_tables(self, ext_dataset, dataset, table_prefix, tables, version, date,
+                    run_state=None):
+        for table in tables:
+            ext_table_name = self.get_table_name(table_prefix, table, version, date, dataset)
+            table_name = self.get_table_name(table_prefix, table, version)
+            if run_state is not None and run_state.is_done("load", table):
+                logging.info(f"Data was already loaded into {dataset}.{table_name}")
+                continue
+
+            drop_cols = self.DROP_COLS.get(table, set())
+            schema = [field for field in self.parse_schema(table) if field["name"] not in drop_cols]
+            destination = self.get_sqlite_name(dataset, table_name)
+            self.create_table(destination, schema, table)
+
+            columns = ", ".join(field["name"] for field in schema)
+            logging.info(f"Inserting into table {dataset}.{table_name} "
+                         f"from {ext_dataset}.{ext_table_name}")
+            self.connection.execute(
+                f"INSERT INTO {destination} ({columns}, {self.PARTITION_FIELD}) "
+                f"SELECT {columns}, ? FROM {self.get_sqlite_name(ext_dataset, ext_table_name)}",
+                (self.get_load_date(date),))
+            self.connection.commit()
+
+            if run_state is not None:
+                run_state.mark_done("load", table)
+
+    def drop_external_tables(self, ext_dataset, dataset, table_prefix, tables, version, date,
+                             run_state=None):
+        for leanplum_name in tables:
+            table_name = self.get_table_name(table_prefix, leanplum_name, version, date, dataset)
+            if run_state is not None and run_state.is_done("drop", leanplum_name):
+                continue
+
+            logging.info(f"Dropping table {ext_dataset}.{table_name}")
+            self.connection.execute(
+                f"DROP TABLE IF EXISTS {self.get_sqlite_name(ext_dataset, table_name)}")
+            self.connection.commit()
+
+            if run_state is not None:
+                run_state.mark_done("drop", leanplum_name)
+
+    def load_rollups(self, bucket, prefix, version, date, dataset, table_prefix, run_state=None):
+        if run_state is not None and run_state.is_done("load", ROLLUPS_TYPE):
+            logging.info(f"Rollups were already loaded into {dataset}")
+            return
+
+        load_date = self.get_load_date(date)
+        rollups = self.get_rollups(bucket, prefix, version, date)
+        for table, rows in rollups.get_rows(load_date).items():
+            table_name = self.get_table_name(table_prefix, table, version)
+            destination = self.get_sqlite_name(dataset, table_name)
+            schema = ROLLUP_SCHEMAS[table]
+            self.create_table(destination, schema, table)
+
+            columns = [field["name"] for field in schema] + [self.PARTITION_FIELD]
+            logging.info(f"Loading {len(rows)} rows into {dataset}.{table_name}")
+            self.connection.execute(
+                f"DELETE FROM {destination} WHERE {self.PARTITION_FIELD} = ?", (load_date,))
+            self.connection.executemany(
+                f"INSERT INTO {destination} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                [[row[column] for column in columns] for row in rows])
+            self.connection.commit()
+
+        if run_state is not None:
+            run_state.mark_done("load", ROLLUPS_TYPE)
+
+    def create_table(self, table: str, schema: List[Dict], data_type: str) -> None:
+        """
+        Create a destination table if it doesn't exist, indexed like the BigQuery table
+        is partitioned and clustered
+        """
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            f"({self.get_columns_sql(schema)}, {self.PARTITION_FIELD} TEXT)")
+        index_columns = [self.PARTITION_FIELD] + (self.get_clustering_fields(data_type) or [])
+        index_name = self.get_sqlite_name(table.strip('"'), "layout")
+        self.connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({', '.join(index_columns)})")
+
+    def get_table_exists(self, table):
+        return self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table.strip('"'),)).fetchone() is not None
+
+    @staticmethod
+    def get_columns_sql(schema: List[Dict]) -> str:
+        # repeated and record fields are stored as JSON text
+        return ", ".join(
+            f"{field['name']} {SQLITE_TYPES.get(field.get('type', 'STRING'), 'TEXT')}"
+            for field in schema)
+
+    @staticmethod
+    def get_sqlite_name(dataset: str, table_name: str) -> str:
+        return f'"{dataset}.{table_name}"'
@@ -0,0 +1,30 @@
+"""
+Denormalized output of whole sessions, written next to the flat data types.
+
+sessions_nested holds each session with its user attributes, experiments, states,
+events and event parameters as repeated records, so queries can read them without
+joining the flat tables on sessionId and eventId. It is written as newline-delimited
+JSON, since CSV can't represent repeated records.
+"""
+
+import json
+from typing import IO, Dict
+
+NESTED_TYPE = "sessions_nested"
+
+
+class JsonLinesWriter(object):
+    """
+    Writes rows as newline-delimited JSON, with the writer interface of csv.DictWriter
+    """
+
+    def __init__(self, output: IO):
+        self.output = output
+        self._encode = json.JSONEncoder(separators=(",", ":")).encode
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, row: Dict):
+        self.output.write(self._encode(row))
+        self.output.write("\n")
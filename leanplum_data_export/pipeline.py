@@ -0,0 +1,215 @@
+"""
+Stages of worker threads connected by bounded queues.
+
+Each stage takes items from its input queue and puts its results on the next stage's
+queue; a full queue blocks the stage before it, so a slow stage throttles the ones
+feeding it instead of letting their output pile up. A ByteBudget additionally limits
+the bytes held by items anywhere in the pipeline, e.g. downloaded and converted files
+on local disk, which a queue length can't bound when file sizes vary.
+"""
+
+import logging
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from typing import Callable, Iterable, List, Tuple
+
+# marks the end of a stage's input
+DONE = object()
+
+
+class BudgetClosed(Exception):
+    pass
+
+
+class ByteBudget(object):
+    """
+    Bytes that may be in flight at once. An item larger than the whole budget is
+    let through when nothing else is in flight, so it can't block forever.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.peak = 0
+        self.wait_seconds = 0.0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int) -> None:
+        with self._condition:
+            start = time.perf_counter()
+            while self.in_use > 0 and self.in_use + size > self.max_bytes and not self._closed:
+                self._condition.wait()
+            self.wait_seconds += time.perf_counter() - start
+            if self._closed:
+                raise BudgetClosed()
+            self._add(size)
+
+    def resize(self, old_size: int, new_size: int) -> None:
+        """
+        Account for an item that changed size, without blocking; only new items wait
+        """
+        with self._condition:
+            self._add(new_size - old_size)
+            self._condition.notify_all()
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self._add(-size)
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        """
+        Wake up and fail any waiting acquire, e.g. because the pipeline failed
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _add(self, size: int) -> None:
+        self.in_use += size
+        self.peak = max(self.peak, self.in_use)
+
+
+class Stage(object):
+
+    def __init__(self, name: str, function: Callable, workers: int):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.busy_seconds = 0.0
+        self.starved_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def add_times(self, busy: float, starved: float, blocked: float) -> None:
+        with self._lock:
+            self.busy_seconds += busy
+            self.starved_seconds += starved
+            self.blocked_seconds += blocked
+            self.items += 1
+
+
+class Pipeline(object):
+    """
+    Runs items through stages given as (name, function, workers). Each function takes
+    the previous stage's result; the first stage takes the items themselves.
+    The first exception in any stage stops the pipeline and is raised by run().
+    """
+
+    def __init__(self, stages: List[Tuple[str, Callable, int]], queue_size: int = 2,
+                 budget: ByteBudget = None, profiler=None, report_interval: float = 30.0):
+        self.stages = [Stage(name, function, workers) for name, function, workers in stages]
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in self.stages]
+        self.budget = budget
+        self.profiler = profiler
+        self.report_interval = report_interval
+        self.max_depths = [0] * len(self.queues)
+        self._error = None
+        self._failed = threading.Event()
+        self._finished = threading.Event()
+
+    def run(self, items: Iterable) -> None:
+        threads = []
+        for index, stage in enumerate(self.stages):
+            stage_threads = [
+                threading.Thread(target=self._work, args=(index,), name=f"{stage.name}-{i}")
+                for i in range(stage.workers)
+            ]
+            threads.append(stage_threads)
+            for thread in stage_threads:
+                thread.start()
+        reporter = threading.Thread(target=self._report_periodically, daemon=True)
+        reporter.start()
+
+        try:
+            for item in items:
+                if self._failed.is_set():
+                    break
+                self._put(0, item)
+        finally:
+            # stages are shut down in order, so each one's input is complete when it stops
+            for index, stage_threads in enumerate(threads):
+                for _ in stage_threads:
+                    self.queues[index].put(DONE)
+                for thread in stage_threads:
+                    thread.join()
+            self._finished.set()
+            reporter.join()
+            self.report_summary()
+
+        if self._error is not None:
+            raise self._error
+
+    def report_depths(self) -> None:
+        depths = ", ".join(f"{stage.name} {stage_queue.qsize()}/{stage_queue.maxsize}"
+                           for stage, stage_queue in zip(self.stages, self.queues))
+        message = f"Queued items: {depths}"
+        if self.budget is not None:
+            message += (f"; in flight: {self.budget.in_use / 2 ** 20:,.0f}MB"
+                        f"/{self.budget.max_bytes / 2 ** 20:,.0f}MB")
+        logging.info(message)
+
+    def report_summary(self) -> None:
+        lines = []
+        for stage, max_depth in zip(self.stages, self.max_depths):
+            lines.append(
+                f"{stage.name}: {stage.items} items on {stage.workers} workers, "
+                f"busy {stage.busy_seconds:.1f}s, waited for input {stage.starved_seconds:.1f}s, "
+                f"blocked on output {stage.blocked_seconds:.1f}s, max queued {max_depth}")
+        if self.budget is not None:
+            lines.append(f"peak in flight {self.budget.peak / 2 ** 20:,.1f}MB, "
+                         f"waited for budget {self.budget.wait_seconds:.1f}s")
+        bottleneck = max(self.stages, key=lambda stage: stage.busy_seconds / stage.workers)
+        lines.append(f"bottleneck: {bottleneck.name}")
+        logging.info("Pipeline summary:\n" + "\n".join(lines))
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        profile = self.profiler.profile_thread() if self.profiler is not None else nullcontext()
+        with profile:
+            while True:
+                start = time.perf_counter()
+                item = self.queues[index].get()
+                starved = time.perf_counter() - start
+                if item is DONE:
+                    return
+                if self._failed.is_set():
+                    # drain the queue so that earlier stages don't block
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    result = stage.function(item)
+                except BudgetClosed:
+                    continue
+                except Exception as e:
+                    self._fail(e)
+                    continue
+                busy = time.perf_counter() - start
+
+                blocked = 0.0
+                if index + 1 < len(self.stages) and result is not None:
+                    start = time.perf_counter()
+                    self._put(index + 1, result)
+                    blocked = time.perf_counter() - start
+                stage.add_times(busy, starved, blocked)
+
+    def _put(self, index: int, item) -> None:
+        self.queues[index].put(item)
+        self.max_depths[index] = max(self.max_depths[index], self.queues[index].qsize())
+
+    def _fail(self, error: Exception) -> None:
+        if not self._failed.is_set():
+            self._error = error
+            self._failed.set()
+            logging.error(f"Pipeline stopped: {error!r}")
+            if self.budget is not None:
+                self.budget.close()
+
+    def _report_periodically(self) -> None:
+        while not self._finished.wait(self.report_interval):
+            self.report_depths()
@@ -0,0 +1,143 @@
+import cProfile
+import glob
+import io
+import itertools
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    """
+    Collects CPU profiles, memory snapshots and per-file parse times of a run into a directory.
+    Every process and thread writes its own files, named after its pid and thread id,
+    so workers don't overwrite each other; summarize() merges everything in the directory.
+    """
+
+    def __init__(self, directory: str, top_n: int = 20):
+        self.directory = directory
+        self.top_n = top_n
+        self.file_timings = []
+        self._lock = threading.Lock()
+        self._main_profile = None
+        self._dump_count = itertools.count()
+        # files being traced, and whether another file was traced at the same time
+        self._active = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self) -> None:
+        tracemalloc.start()
+        self._main_profile = cProfile.Profile()
+        self._main_profile.enable()
+
+    def stop(self) -> None:
+        """
+        Write this process's results and log a summary of every result in the directory
+        """
+        if self._main_profile is not None:
+            self._main_profile.disable()
+            self._dump(self._main_profile)
+            self._main_profile = None
+
+        with self._lock:
+            if self.file_timings:
+                with open(os.path.join(self.directory, f"files-{os.getpid()}.json"), "w") as f:
+                    json.dump(self.file_timings, f)
+        tracemalloc.stop()
+
+        self.summarize()
+
+    @contextmanager
+    def profile_thread(self):
+        """
+        Profile the CPU time of the current thread, for use in worker threads;
+        cProfile only sees the thread it was enabled in
+        """
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._dump(profile)
+
+    @contextmanager
+    def trace_file(self, name: str):
+        """
+        Time the conversion of a data file and record which lines allocated the memory
+        it retained and how much it used at peak.
+        tracemalloc only measures the whole process, so while other files are converted
+        at the same time only the process's peak is recorded, as process_peak_bytes.
+        """
+        tracing = tracemalloc.is_tracing()
+        token = object()
+        with self._lock:
+            concurrent = bool(self._active)
+            for other in self._active:
+                self._active[other] = True
+            self._active[token] = concurrent
+            if tracing and not concurrent:
+                before = tracemalloc.take_snapshot()
+                tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timing = {"file": name, "seconds": time.perf_counter() - start}
+            with self._lock:
+                concurrent = self._active.pop(token)
+            if tracing and concurrent:
+                timing["process_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            elif tracing:
+                timing["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                self._dump_memory(name, tracemalloc.take_snapshot().compare_to(before, "lineno"))
+            with self._lock:
+                self.file_timings.append(timing)
+            logging.info(f"Converted {name} in {timing['seconds']:.2f}s")
+
+    def summarize(self) -> None:
+        stats_files = glob.glob(os.path.join(self.directory, "cpu-*.pstats"))
+        if stats_files:
+            output = io.StringIO()
+            stats = pstats.Stats(*stats_files, stream=output)
+            stats.dump_stats(os.path.join(self.directory, "merged.pstats"))
+            stats.sort_stats("cumulative").print_stats(self.top_n)
+            logging.info(f"CPU profile of {len(stats_files)} profiled threads and processes, "
+                         f"merged into {self.directory}/merged.pstats:\n{output.getvalue()}")
+
+        file_timings = []
+        for timings_file in glob.glob(os.path.join(self.directory, "files-*.json")):
+            with open(timings_file) as f:
+                file_timings.extend(json.load(f))
+        if file_timings:
+            slowest = sorted(file_timings, key=lambda timing: timing["seconds"], reverse=True)
+            lines = [f"{timing['seconds']:8.2f}s  {self.format_peak(timing)}  {timing['file']}"
+                     for timing in slowest[:self.top_n]]
+            total = sum(timing["seconds"] for timing in file_timings)
+            message = f"Converted {len(file_timings)} files in {total:.2f}s, slowest:\n"
+            if any("process_peak_bytes" in timing for timing in file_timings):
+                message = (f"{message}(process peak: memory of the whole process, "
+                           f"other files were converted at the same time)\n")
+            logging.info(message + "\n".join(lines))
+
+    @staticmethod
+    def format_peak(timing) -> str:
+        if "process_peak_bytes" in timing:
+            return f"{timing['process_peak_bytes'] / 2 ** 20:8.1f}MB process peak"
+        return f"{timing.get('peak_bytes', 0) / 2 ** 20:8.1f}MB peak        "
+
+    def _dump(self, profile: cProfile.Profile) -> None:
+        profile.dump_stats(os.path.join(
+            self.directory,
+            f"cpu-{os.getpid()}-{threading.get_ident()}-{next(self._dump_count)}.pstats"))
+
+    def _dump_memory(self, name: str, differences) -> None:
+        path = os.path.join(self.directory, f"memory-{os.getpid()}-{os.path.basename(name)}.txt")
+        with open(path, "w") as f:
+            for difference in differences[:self.top_n]:
+                f.write(f"{difference}\n")
@@ -0,0 +1,207 @@
+"""
+Daily rollups computed while data files are converted.
+
+Dashboards aggregate the raw tables every day; the same aggregates are counted here
+from the sessions the exporter already decodes. Each data file gets a partial rollup
+that is stored in GCS next to its CSVs, and the partials of a date are merged when
+the rollup tables are loaded, so files converted by earlier runs are still counted.
+Distinct users are estimated with HyperLogLog sketches, which merge across files.
+"""
+
+import base64
+import hashlib
+import json
+import math
+from collections import Counter
+from typing import Dict, List
+
+ROLLUPS_TYPE = "rollups"
+
+# overflow key of counters that reached their maximum number of keys
+OTHER = "__other__"
+
+ROLLUP_SCHEMAS = {
+    "rollup_event_counts": [
+        {"type": "STRING", "name": "eventName"},
+        {"type": "STRING", "name": "country"},
+        {"type": "INTEGER", "name": "events"},
+    ],
+    "rollup_app_versions": [
+        {"type": "STRING", "name": "appVersion"},
+        {"type": "INTEGER", "name": "sessions"},
+        {"type": "INTEGER", "name": "users"},
+    ],
+    "rollup_experiment_exposures": [
+        {"type": "INTEGER", "name": "experimentId"},
+        {"type": "INTEGER", "name": "variantId"},
+        {"type": "INTEGER", "name": "sessions"},
+        {"type": "INTEGER", "name": "users"},
+    ],
+}
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values added, within about 1.04 / sqrt(2 ** precision)
+    """
+
+    def __init__(self, precision: int = 11, registers: bytearray = None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add(self, value) -> None:
+        hashed = int.from_bytes(
+            hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if other.precision != self.precision:
+            raise ValueError("Can't merge HyperLogLogs of different precisions")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = size * math.log(size / zeros)
+        return round(estimate)
+
+    def to_string(self) -> str:
+        return base64.b64encode(self.registers).decode()
+
+    @classmethod
+    def from_string(cls, value: str, precision: int) -> "HyperLogLog":
+        return cls(precision, bytearray(base64.b64decode(value)))
+
+
+class Rollups(object):
+    """
+    Counters of a set of sessions, keeping at most max_keys keys per rollup;
+    further keys are counted under OTHER
+    """
+
+    VERSION = 1
+
+    def __init__(self, max_keys: int = 10000, precision: int = 11):
+        self.max_keys = max_keys
+        self.precision = precision
+        self.event_counts = Counter()
+        self.app_version_sessions = Counter()
+        self.app_version_users = {}
+        self.exposure_sessions = Counter()
+        self.exposure_users = {}
+
+    @staticmethod
+    def get_fingerprint() -> str:
+        """
+        Changes whenever partial rollups written before would no longer be compatible
+        """
+        rollups = json.dumps([Rollups.VERSION, ROLLUP_SCHEMAS], sort_keys=True)
+        return hashlib.sha256(rollups.encode()).hexdigest()[:16]
+
+    def _key(self, counter, key, other):
+        if key in counter or len(counter) < self.max_keys:
+            return key
+        return other
+
+    def _users(self, sketches, key) -> HyperLogLog:
+        sketch = sketches.get(key)
+        if sketch is None:
+            sketch = sketches[key] = HyperLogLog(self.precision)
+        return sketch
+
+    def add(self, session_data: Dict) -> None:
+        user_id = session_data.get("userId")
+        country = session_data.get("country")
+
+        app_version = self._key(self.app_version_sessions, session_data.get("appVersion"), OTHER)
+        self.app_version_sessions[app_version] += 1
+        self._users(self.app_version_users, app_version).add(user_id)
+
+        for experiment in session_data.get("experiments", []):
+            exposure = self._key(self.exposure_sessions,
+                                 (experiment["id"], experiment["variantId"]), (None, None))
+            self.exposure_sessions[exposure] += 1
+            self._users(self.exposure_users, exposure).add(user_id)
+
+        event_counts = self.event_counts
+        for state in session_data.get("states", []):
+            for event in state.get("events", []):
+                key = (event["name"], country)
+                if key not in event_counts and len(event_counts) >= self.max_keys:
+                    key = (OTHER, OTHER)
+                event_counts[key] += 1
+
+    def merge(self, other: "Rollups") -> None:
+        for key, count in other.event_counts.items():
+            self.event_counts[self._key(self.event_counts, key, (OTHER, OTHER))] += count
+        for key, count in other.app_version_sessions.items():
+            merged_key = self._key(self.app_version_sessions, key, OTHER)
+            self.app_version_sessions[merged_key] += count
+            self._users(self.app_version_users, merged_key).merge(other.app_version_users[key])
+        for key, count in other.exposure_sessions.items():
+            merged_key = self._key(self.exposure_sessions, key, (None, None))
+            self.exposure_sessions[merged_key] += count
+            self._users(self.exposure_users, merged_key).merge(other.exposure_users[key])
+
+    def to_dict(self) -> Dict:
+        return {
+            "version": self.VERSION,
+            "precision": self.precision,
+            "event_counts": [[*key, count] for key, count in self.event_counts.items()],
+            "app_versions": [
+                [key, count, self.app_version_users[key].to_string()]
+                for key, count in self.app_version_sessions.items()
+            ],
+            "experiment_exposures": [
+                [*key, count, self.exposure_users[key].to_string()]
+                for key, count in self.exposure_sessions.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict, max_keys: int = 10000) -> "Rollups":
+        if data["version"] != cls.VERSION:
+            raise ValueError(f"Unsupported rollups version {data['version']}")
+        rollups = cls(max_keys, data["precision"])
+        for event_name, country, count in data["event_counts"]:
+            rollups.event_counts[(event_name, country)] = count
+        for app_version, count, users in data["app_versions"]:
+            rollups.app_version_sessions[app_version] = count
+            rollups.app_version_users[app_version] = HyperLogLog.from_string(
+                users, rollups.precision)
+        for experiment_id, variant_id, count, users in data["experiment_exposures"]:
+            key = (experiment_id, variant_id)
+            rollups.exposure_sessions[key] = count
+            rollups.exposure_users[key] = HyperLogLog.from_string(users, rollups.precision)
+        return rollups
+
+    def get_rows(self, load_date: str) -> Dict[str, List[Dict]]:
+        """
+        Rows of each rollup table, load_date is formatted as YYYY-MM-DD
+        """
+        return {
+            "rollup_event_counts": [
+                {"load_date": load_date, "eventName": event_name, "country": country,
+                 "events": count}
+                for (event_name, country), count in self.event_counts.items()
+            ],
+            "rollup_app_versions": [
+                {"load_date": load_date, "appVersion": app_version, "sessions": count,
+                 "users": self.app_version_users[app_version].count()}
+                for app_version, count in self.app_version_sessions.items()
+            ],
+            "rollup_experiment_exposures": [
+                {"load_date": load_date, "experimentId": experiment_id,
+                 "variantId": variant_id, "sessions": count,
+                 "users": self.exposure_users[(experiment_id, variant_id)].count()}
+                for (experiment_id, variant_id), count in self.exposure_sessions.items()
+            ],
+        }
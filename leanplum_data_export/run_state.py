@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+import threading
+from typing import Iterable, Optional, Tuple
+
+from google.cloud import exceptions
+
+
+class RunState(object):
+    """
+    Progress of the BigQuery stages of an export, stored as JSON next to the date's data in GCS.
+    For every stage and table it records whether the stage has finished and the id of the
+    BigQuery job running it, so a rerun can skip finished work and reattach to running jobs.
+    The state only applies to the set of data files it was recorded for; converting any
+    new file starts a fresh state.
+    """
+
+    STAGES = ["create", "delete", "load", "drop"]
+    FILE_NAME = "run_state.json"
+
+    def __init__(self, blob, files_fingerprint: str, stages: dict = None):
+        self.blob = blob
+        self.files_fingerprint = files_fingerprint
+        self.stages = stages if stages is not None else {stage: {} for stage in self.STAGES}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, gcs_client, bucket: str, path: str, files: Iterable[str]) -> "RunState":
+        blob = gcs_client.bucket(bucket).blob(path)
+        files_fingerprint = cls.get_files_fingerprint(files)
+
+        try:
+            state = json.loads(blob.download_as_string())
+        except exceptions.NotFound:
+            return cls(blob, files_fingerprint)
+
+        if state.get("files_fingerprint") != files_fingerprint:
+            logging.info("Data files changed since the last run, starting a new run state")
+            return cls(blob, files_fingerprint)
+
+        return cls(blob, files_fingerprint, state["stages"])
+
+    @staticmethod
+    def get_files_fingerprint(files: Iterable[str]) -> str:
+        return hashlib.sha256("\n".join(sorted(files)).encode()).hexdigest()
+
+    def is_done(self, stage: str, table: str) -> bool:
+        return self.stages[stage].get(table, {}).get("done", False)
+
+    def get_job_id(self, stage: str, table: str) -> str:
+        return self.stages[stage].get(table, {}).get("job_id")
+
+    def set_job_id(self, stage: str, table: str, job_id: str) -> None:
+        with self._lock:
+            self.stages[stage][table] = {"done": False, "job_id": job_id}
+            self.save()
+
+    def mark_done(self, stage: str, table: str) -> None:
+        with self._lock:
+            self.stages[stage].setdefault(table, {})["done"] = True
+            self.save()
+
+    def reset(self, tables: Iterable[str]) -> None:
+        """
+        Forget the progress of the given tables, e.g. because their data was rebuilt
+        """
+        with self._lock:
+            for stage_tables in self.stages.values():
+                for table in tables:
+                    stage_tables.pop(table, None)
+            self.save()
+
+    def save(self) -> None:
+        self.blob.upload_from_string(
+            json.dumps({"files_fingerprint": self.files_fingerprint, "stages": self.stages}),
+            content_type="application/json",
+        )
+
+
+class EventDateRanges(object):
+    """
+    First and last event date loaded for the date into each table partitioned by event
+    time, stored as JSON next to the date's data in GCS. A reload deletes the date's rows
+    from the recorded range, which a rebuild, a clean run, dedup or coercion may have
+    narrowed since it was loaded. Ranges only grow.
+    """
+
+    FILE_NAME = "event_dates.json"
+
+    def __init__(self, blob, ranges: dict = None):
+        self.blob = blob
+        self.ranges = ranges if ranges is not None else {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, gcs_client, bucket: str, path: str) -> "EventDateRanges":
+        blob = gcs_client.bucket(bucket).blob(path)
+        try:
+            return cls(blob, json.loads(blob.download_as_string()))
+        except exceptions.NotFound:
+            return cls(blob)
+
+    def get(self, table: str) -> Optional[Tuple[str, str]]:
+        date_range = self.ranges.get(table)
+        return tuple(date_range) if date_range is not None else None
+
+    def extend(self, table: str, first_date: str, last_date: str) -> None:
+        """
+        Record ISO dates as loaded into the table, before they are loaded
+        """
+        with self._lock:
+            if table in self.ranges:
+                recorded_first, recorded_last = self.ranges[table]
+                first_date = min(first_date, recorded_first)
+                last_date = max(last_date, recorded_last)
+            self.ranges[table] = [first_date, last_date]
+            self.save()
+
+    def save(self) -> None:
+        self.blob.upload_from_string(json.dumps(self.ranges), content_type="application/json")
@@ -0,0 +1,123 @@
+"""Generate synthetic Leanplum session exports for benchmarks and load tests."""
+
+import json
+import os
+import random
+
+COUNTRIES = ["US", "CA", "DE", "FR", "GB", "IN", "BR", "JP", "MX", "(none)"]
+LOCALES = ["en-US_US", "en-CA_CA", "de-DE_DE", "fr-FR_FR", "en-GB_GB", "pt-BR_BR", "ja-JP_JP"]
+TIMEZONES = ["America/Los_Angeles", "America/New_York", "Europe/Berlin", "Asia/Tokyo"]
+CLIENTS = [("ios", "iOS", ["13.4.1", "13.5", "14.0"], ["iPhone X", "iPhone 11", "iPad"]),
+           ("android", "Android OS", ["9", "10", "11"], ["Pixel 3", "SM-G960F", "Moto G"])]
+APP_VERSIONS = [str(version) for version in range(18000, 18100, 7)]
+EVENT_NAMES = [f"E_Event_{i}" for i in range(150)]
+PARAMETER_NAMES = [f"p{i}" for i in range(20)]
+ATTRIBUTE_NAMES = ["Mailto Is Default", "FxA account is verified", "Default Browser",
+                   "Signed In Sync", "Pocket Installed", "Focus Installed"]
+
+
+def generate_sessions(count, seed=0, start=1591000000.0):
+    """
+    Yield `count` session dicts shaped like the Leanplum streaming export.
+    The same seed always yields the same sessions.
+    """
+    rng = random.Random(seed)
+    user_ids = [f"user-{rng.getrandbits(64):016x}" for _ in range(max(1, count // 4))]
+
+    for session_number in range(count):
+        client, os_name, os_versions, device_models = rng.choice(CLIENTS)
+        session_start = start + rng.random() * 86400
+        user_id = rng.choice(user_ids)
+
+        states = []
+        for _ in range(rng.randint(0, 3)):
+            events = []
+            for _ in range(rng.randint(1, 8)):
+                event = {
+                    "eventId": rng.getrandbits(63),
+                    "name": rng.choice(EVENT_NAMES),
+                    "time": repr(session_start + rng.random() * 600),
+                    "value": 0.0,
+                }
+                if rng.random() < 0.3:
+                    event["timeUntilFirstForUser"] = rng.randint(0, 10000)
+                if rng.random() < 0.5:
+                    # some values are free-form, like URLs and search terms in real data
+                    event["parameters"] = {
+                        name: rng.choice(["value", "true", "false", "1", None])
+                        or f"https://example.com/search?q={event['eventId']:x}{name}"
+                        for name in rng.sample(PARAMETER_NAMES, rng.randint(1, 3))
+                    }
+                events.append(event)
+            states.append({"stateId": rng.getrandbits(63) - 2 ** 62, "events": events})
+
+        yield {
+            "sessionId": str(session_number + 1),
+            "userId": user_id,
+            "deviceId": user_id,
+            "userBucket": rng.randint(0, 999),
+            "firstRun": repr(session_start - rng.random() * 3e7),
+            "time": repr(session_start),
+            "duration": round(rng.random() * 600, 3),
+            "country": rng.choice(COUNTRIES),
+            "region": "CA",
+            "city": "City",
+            "lat": "67.8536262512207",
+            "lon": "-100.13395690917969",
+            "locale": rng.choice(LOCALES),
+            "timezone": rng.choice(TIMEZONES),
+            "timezoneOffsetSeconds": -25200,
+            "appVersion": rng.choice(APP_VERSIONS),
+            "client": client,
+            "sdkVersion": "2.7.2",
+            "systemName": os_name,
+            "systemVersion": rng.choice(os_versions),
+            "deviceModel": rng.choice(device_models),
+            "priorEvents": rng.randint(0, 5000),
+            "priorSessions": rng.randint(0, 500),
+            "priorTimeSpentInApp": round(rng.random() * 1e5, 3),
+            "priorStates": 0,
+            "isSession": rng.random() < 0.9,
+            "sourcePublisher": "Product Marketing (Owned media)",
+            "sourceCampaign": "fxa-conf-page",
+            "sourceAdGroup": "sms",
+            "sourceAd": "link",
+            "userAttributes": {
+                name: rng.choice(["True", "False"])
+                for name in rng.sample(ATTRIBUTE_NAMES, rng.randint(0, len(ATTRIBUTE_NAMES)))
+            },
+            "experiments": [
+                {"id": 800315004 + i, "variantId": 796675005 + rng.randint(0, 2)}
+                for i in range(rng.randint(0, 3))
+            ],
+            "states": states,
+        }
+
+
+def write_ndjson(path, count, seed=0):
+    """
+    Write `count` synthetic sessions to `path` in the export's newline-delimited JSON format
+    """
+    with open(path, "w") as f:
+        for session in generate_sessions(count, seed):
+            f.write(json.dumps(session))
+            f.write("\n")
+
+
+def write_export_files(directory, date, files, sessions_per_file, seed=0):
+    """
+    Write a day of synthetic data files to `directory`/`date`, named like the S3 export
+    """
+    os.makedirs(os.path.join(directory, date), exist_ok=True)
+    paths = []
+    for file_number in range(files):
+        path = os.path.join(directory, date, f"export-{seed}-output-{file_number}")
+        # session ids continue across files, like in a real export
+        with open(path, "w") as f:
+            for session in generate_sessions(sessions_per_file, seed + file_number):
+                session["sessionId"] = str(int(session["sessionId"])
+                                           + file_number * sessions_per_file)
+                f.write(json.dumps(session))
+                f.write("\n")
+        paths.append(path)
+    return paths
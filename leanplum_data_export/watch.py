@@ -0,0 +1,212 @@
+"""
+Export data files as they land in S3 instead of once a day.
+
+A FileWatcher runs until it is stopped. Every poll interval it lists the data files of
+the dates it watches, or takes the keys of S3 event notifications from a queue, and
+converts the files that aren't in their date's file history, reusing the exporter's
+clients. Every load interval the files converted since the last load are appended to
+the destination tables. The first load of a date in a run, and its final load when it
+leaves the watched dates or the watcher stops, export the date again instead, which
+replaces its partitions with all of its files.
+"""
+
+import datetime
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Set, Tuple
+from urllib.parse import unquote_plus
+
+from leanplum_data_export.export import LeanplumExporter
+
+DATA_FILE_RE = re.compile(r"^(.*/)?(\d{8})/export-.*-output-[0-9]+$")
+
+
+def get_notification_keys(message) -> List[Tuple[str, int]]:
+    """
+    S3 keys and sizes of a notification, which is either an S3 event notification
+    or just a key
+    """
+    if isinstance(message, str):
+        return [(message, 0)]
+    return [
+        # keys in event notifications are URL encoded
+        (unquote_plus(record["s3"]["object"]["key"]), record["s3"]["object"].get("size", 0))
+        for record in message.get("Records", []) if "s3" in record
+    ]
+
+
+class FileWatcher(object):
+    """
+    Converts new data files every poll_interval seconds and loads their dates every
+    load_interval seconds. By default the current and previous UTC dates are polled,
+    so files that land after midnight are still picked up. With a notifications queue,
+    the keys of the notifications are converted instead of polling S3.
+    """
+
+    def __init__(self, exporter: LeanplumExporter, s3_bucket: str, gcs_bucket: str, prefix: str,
+                 dataset: str, table_prefix: str, version: str, dates: List[str] = None,
+                 poll_interval: float = 60.0, load_interval: float = 900.0,
+                 notifications: queue.Queue = None, clock: Callable[[], float] = time.monotonic):
+        self.exporter = exporter
+        self.s3_bucket = s3_bucket
+        self.gcs_bucket = gcs_bucket
+        self.prefix = prefix
+        self.dataset = dataset
+        self.table_prefix = table_prefix
+        self.version = version
+        self.dates = dates
+        self.poll_interval = poll_interval
+        self.load_interval = load_interval
+        self.notifications = notifications
+        self.clock = clock
+        self.schemas = exporter.get_schemas()
+        # file names in each date's file history, read from GCS when first needed
+        self.histories = {}
+        # keys of the data files converted since their date was last loaded, by date
+        self.pending = {}
+        # dates whose tables hold all the files of their history, new files can be appended
+        self.loaded = set()
+        # dates that files were appended to since they were last exported
+        self.appended = set()
+        self.next_load = None
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        """
+        Watch for new files until stop() is called, then load what was converted
+        """
+        self.next_load = self.clock() + self.load_interval
+        while not self._stopped.is_set():
+            self.run_once()
+            if self.notifications is None:
+                self._stopped.wait(self.poll_interval)
+        self.load(final=True)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def run_once(self) -> None:
+        # a failure is retried on the next poll, the watcher keeps running
+        try:
+            self.convert(self.get_new_files())
+        except Exception:
+            logging.exception("Converting new data files failed")
+
+        if self.next_load is None or self.clock() >= self.next_load:
+            try:
+                self.load()
+            except Exception:
+                logging.exception("Loading new data files failed")
+            self.next_load = self.clock() + self.load_interval
+
+    def get_dates(self) -> List[str]:
+        if self.dates is not None:
+            return self.dates
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        return [(today - datetime.timedelta(days=days)).strftime("%Y%m%d") for days in (1, 0)]
+
+    def get_new_files(self) -> Dict[str, List[str]]:
+        """
+        Keys of the data files that are not in their date's file history, by date
+        """
+        dates = self.get_dates()
+        for date in set(self.histories) - set(dates) - set(self.pending):
+            del self.histories[date]
+
+        if self.notifications is not None:
+            keys = self.receive_notifications()
+        else:
+            keys = []
+            for date in dates:
+                keys.extend(self.exporter.get_files(date, self.s3_bucket, self.prefix,
+                                                    allow_empty=True))
+
+        new_files = defaultdict(list)
+        for key in keys:
+            match = DATA_FILE_RE.fullmatch(key)
+            if match is None or os.path.dirname(os.path.dirname(key)) != self.prefix.rstrip("/"):
+                continue
+            date = match.group(2)
+            if os.path.basename(key) not in self.get_history(date) and key not in new_files[date]:
+                new_files[date].append(key)
+        return new_files
+
+    def receive_notifications(self) -> List[str]:
+        """
+        Keys of the notifications received within a poll interval
+        """
+        messages = []
+        try:
+            messages.append(self.notifications.get(timeout=self.poll_interval))
+            while True:
+                messages.append(self.notifications.get_nowait())
+        except queue.Empty:
+            pass
+
+        keys = []
+        for message in messages:
+            for key, size in get_notification_keys(message):
+                if size:
+                    self.exporter.data_file_sizes[key] = size
+                keys.append(key)
+        return keys
+
+    def get_history(self, date: str) -> Set[str]:
+        if date not in self.histories:
+            self.histories[date] = self.exporter.get_previously_imported_files(
+                self.gcs_bucket, self.prefix, self.version, date)
+        return self.histories[date]
+
+    def convert(self, new_files: Dict[str, List[str]]) -> None:
+        for date, keys in sorted(new_files.items()):
+            logging.info(f"Converting {len(keys)} new data files of {date}")
+            history = self.get_history(date)
+            # files that fail here are converted again by the next poll, or by the
+            # date's next export
+            pending = self.pending.setdefault(date, set())
+            self.exporter.convert_files([(key, self.schemas) for key in keys], history,
+                                        self.s3_bucket, self.gcs_bucket, self.prefix,
+                                        self.version, date)
+            history.update(os.path.basename(key) for key in keys)
+            pending.update(keys)
+
+    def load(self, final: bool = False) -> None:
+        """
+        Append the files converted since the last load to their dates' tables, or export
+        the dates that weren't loaded in this run yet. final exports every date that was
+        appended to, as do dates that are no longer watched.
+        """
+        dates = set(self.get_dates())
+        finished_dates = {date for date in self.appended if final or date not in dates}
+        for date in sorted(set(self.pending) | finished_dates):
+            finished = final or date not in dates
+            if date in self.loaded and not finished:
+                keys = sorted(self.pending[date])
+                if keys:
+                    logging.info(f"Appending {len(keys)} data files of {date}")
+                    # a failed append may have loaded some of the tables,
+                    # the date is exported again instead
+                    self.loaded.discard(date)
+                    self.exporter.append(date, keys, self.gcs_bucket, self.prefix,
+                                         self.dataset, self.table_prefix, self.version)
+                    self.loaded.add(date)
+                    self.appended.add(date)
+                del self.pending[date]
+                continue
+
+            logging.info(f"Loading the data files of {date} converted so far")
+            self.exporter.export(date, self.s3_bucket, self.gcs_bucket, self.prefix,
+                                 self.dataset, self.table_prefix, self.version, False)
+            self.pending.pop(date, None)
+            self.appended.discard(date)
+            # the export converts files that landed since the last poll too
+            self.histories.pop(date, None)
+            if finished:
+                self.loaded.discard(date)
+            else:
+                self.loaded.add(date)
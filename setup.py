@@ -26,7 +26,7 @@ setup(
     },
 
     # These don't necessarily need changed
-    python_requires='>=3.6.0',
+    python_requires='>=3.9.0',
     version='0.0.0',
     long_description=readme,
     include_package_data=True,
@@ -0,0 +1,95 @@
+import sqlite3
+from unittest.mock import Mock
+
+import pytest
+
+from leanplum_data_export.export import LeanplumExporter
+from leanplum_data_export.local import LocalExporter
+from leanplum_data_export.synthetic import write_export_files
+
+DATE = "20200601"
+
+
+def pytest_addoption(parser):
+    parser.addoption("--run-perf", action="store_true", default=False,
+                     help="Run the performance tests against tests/perf_baseline.json")
+    parser.addoption("--update-perf-baseline", action="store_true", default=False,
+                     help="Run the performance tests and record their results as the baseline")
+    parser.addoption("--perf-tolerance", type=float, default=None,
+                     help="Allowed regression as a fraction of the baseline, "
+                          "instead of the baseline's own tolerance")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "perf: performance test, only run with --run-perf")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-perf") or config.getoption("--update-perf-baseline"):
+        return
+    skip_perf = pytest.mark.skip(reason="performance test, run with --run-perf")
+    for item in items:
+        if "perf" in item.keywords:
+            item.add_marker(skip_perf)
+
+
+@pytest.fixture
+def exporter():
+    return LeanplumExporter("projectId")
+
+
+@pytest.fixture
+def stubbed_exporter(exporter):
+    """
+    The exporter with its S3, GCS and BigQuery stages mocked, for testing which files and
+    tables export works on. By default the day's two data files were already converted
+    with the current schemas.
+    """
+    for method in ["get_previously_imported_files", "transform_data_file", "write_to_gcs",
+                   "create_external_tables", "delete_existing_data", "load_tables",
+                   "drop_external_tables", "get_run_state", "write_schema_fingerprints",
+                   "delete_gcs_prefix", "load_rollups"]:
+        setattr(exporter, method, Mock())
+    exporter.gcs_client = Mock()
+    exporter.get_files = Mock(return_value=["a/b/file1", "a/b/file2"])
+    exporter.get_previously_imported_files.return_value = {"file1", "file2"}
+    exporter.transform_data_file.return_value = {}
+    exporter.get_schema_fingerprints = Mock(return_value={
+        data_type: exporter.get_schema_fingerprint(data_type)
+        for data_type in exporter.data_types
+    })
+    return exporter
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    """
+    A synthetic day of 3 data files of 20 sessions under the prefix dev
+    """
+    source_dir = tmp_path / "source"
+    write_export_files(str(source_dir / "dev"), DATE, files=3, sessions_per_file=20)
+    return str(source_dir)
+
+
+@pytest.fixture
+def local_export(tmp_path, source_dir):
+    """
+    Export the day with a LocalExporter created with the given keyword arguments
+    """
+    def export(clean=False, only_types=None, **kwargs):
+        exporter = LocalExporter(str(tmp_path / "leanplum.db"), **kwargs)
+        exporter.export(DATE, source_dir, str(tmp_path / "stage"), "dev", "leanplum", "",
+                        "1", clean, only_types=only_types)
+        return exporter
+    return export
+
+
+@pytest.fixture
+def count_rows(tmp_path):
+    """
+    Count the rows of a table loaded by local_export
+    """
+    def count(table):
+        with sqlite3.connect(str(tmp_path / "leanplum.db")) as connection:
+            return connection.execute(f'SELECT COUNT(*) FROM "leanplum.{table}"').fetchone()[0]
+    return count
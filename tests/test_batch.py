@@ -0,0 +1,74 @@
+import csv
+import io
+import os
+import shutil
+
+import pytest
+
+from leanplum_data_export.batch import ColumnBatchWriter
+from leanplum_data_export.export import LeanplumExporter
+from leanplum_data_export.synthetic import write_ndjson
+
+
+@pytest.fixture
+def schemas():
+    exporter = LeanplumExporter("projectId")
+    return {data_type: [field["name"] for field in exporter.parse_schema(data_type)]
+            for data_type in exporter.DATA_TYPES}
+
+
+@pytest.fixture
+def sample_data_dict():
+    return {"sessionId": "1", "systemName": "iOS", "states": [
+        {"stateId": 1, "events": [{"eventId": 1, "name": "a", "time": "1", "value": 0}]}]}
+
+
+def convert(data_file, schemas, batch_size):
+    exporter = LeanplumExporter("projectId", batch_size=batch_size)
+    csv_files = {data_type: io.StringIO() for data_type in exporter.DATA_TYPES}
+    if batch_size > 0:
+        exporter.write_batches(csv_files, data_file, schemas)
+    else:
+        exporter.write_rows(csv_files, data_file, schemas)
+    return {data_type: csv_file.getvalue() for data_type, csv_file in csv_files.items()}
+
+
+class TestColumnBatchWriter(object):
+
+    @pytest.mark.parametrize("batch_size", [1, 7, 10000])
+    def test_matches_row_output_synthetic(self, tmp_path, schemas, batch_size):
+        data_file = str(tmp_path / "data.ndjson")
+        write_ndjson(data_file, 200, seed=1)
+
+        assert convert(data_file, schemas, batch_size) == convert(data_file, schemas, 0)
+
+    def test_matches_row_output_sample(self, tmp_path, schemas):
+        data_file = str(tmp_path / "data.ndjson")
+        shutil.copy(os.path.join(os.path.dirname(__file__), "sample.ndjson"), data_file)
+
+        batch_output = convert(data_file, schemas, 2)
+
+        assert batch_output == convert(data_file, schemas, 0)
+        assert len(batch_output["events"].splitlines()) == 8
+
+    def test_converters_and_missing_columns(self):
+        output = io.StringIO()
+        batch_writer = ColumnBatchWriter(
+            {"experiments": csv.writer(output)},
+            {"experiments": ["sessionId", "experimentId", "unknown"]},
+            converters={"experiments": {"experimentId": lambda value: value * 2}},
+        )
+        batch_writer.add({"sessionId": "3", "experiments": [{"id": 1, "variantId": 2}]})
+        batch_writer.flush()
+
+        assert output.getvalue().splitlines() == ["3,2,"]
+
+    def test_only_requested_data_types(self, sample_data_dict):
+        output = io.StringIO()
+        batch_writer = ColumnBatchWriter({"sessions": csv.writer(output)},
+                                         {"sessions": ["sessionId", "osName"]})
+        batch_writer.add(sample_data_dict)
+        batch_writer.flush()
+
+        assert output.getvalue().splitlines() == ["1,iOS"]
+        assert list(batch_writer.columns) == ["sessions"]
@@ -0,0 +1,188 @@
+import os
+import time
+
+import boto3
+import pytest
+from moto import mock_s3
+
+from leanplum_data_export.cache import DownloadCache
+from leanplum_data_export.export import LeanplumExporter
+
+BUCKET = "bucket"
+
+
+@pytest.fixture
+def s3_client():
+    with mock_s3():
+        s3_client = boto3.client("s3")
+        s3_client.create_bucket(Bucket=BUCKET)
+        yield s3_client
+
+
+class CountingS3Client(object):
+    """Wraps an S3 client and counts downloads"""
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.downloads = 0
+
+    def head_object(self, **kwargs):
+        return self.s3_client.head_object(**kwargs)
+
+    def download_file(self, *args, **kwargs):
+        self.downloads += 1
+        return self.s3_client.download_file(*args, **kwargs)
+
+
+class DamagingS3Client(CountingS3Client):
+    """Wraps an S3 client and damages the downloaded files"""
+
+    def __init__(self, s3_client, damage):
+        super().__init__(s3_client)
+        self.damage = damage
+
+    def download_file(self, bucket, key, filename, **kwargs):
+        super().download_file(bucket, key, filename, **kwargs)
+        with open(filename, "rb") as f:
+            data = f.read()
+        with open(filename, "wb") as f:
+            f.write(self.damage(data))
+
+
+class TestDownloadCache(object):
+
+    def test_second_fetch_is_cached(self, s3_client, tmp_path):
+        s3_client.put_object(Bucket=BUCKET, Key="a", Body=b"hello")
+        client = CountingS3Client(s3_client)
+        cache = DownloadCache(str(tmp_path / "cache"))
+
+        first = cache.fetch(client, BUCKET, "a", str(tmp_path / "a"))
+        second = cache.fetch(client, BUCKET, "a", str(tmp_path / "a"))
+
+        assert first == second
+        assert client.downloads == 1
+        with open(second, "rb") as f:
+            assert f.read() == b"hello"
+
+    def test_changed_object_is_downloaded_again(self, s3_client, tmp_path):
+        client = CountingS3Client(s3_client)
+        cache = DownloadCache(str(tmp_path / "cache"))
+
+        s3_client.put_object(Bucket=BUCKET, Key="a", Body=b"hello")
+        cache.fetch(client, BUCKET, "a", str(tmp_path / "a"))
+        s3_client.put_object(Bucket=BUCKET, Key="a", Body=b"world")
+        path = cache.fetch(client, BUCKET, "a", str(tmp_path / "a"))
+
+        assert client.downloads == 2
+        with open(path, "rb") as f:
+            assert f.read() == b"world"
+
+    def test_corrupted_entry_is_downloaded_again(self, s3_client, tmp_path):
+        s3_client.put_object(Bucket=BUCKET, Key="a", Body=b"hello")
+        client = CountingS3Client(s3_client)
+        cache = DownloadCache(str(tmp_path / "cache"))
+
+        path = cache.fetch(client, BUCKET, "a", str(tmp_path / "a"))
+        with open(path, "wb") as f:
+            f.write(b"jello")
+        path = cache.fetch(client, BUCKET, "a", str(tmp_path / "a"))
+
+        assert client.downloads == 2
+        with open(path, "rb") as f:
+            assert f.read() == b"hello"
+
+    @pytest.mark.parametrize("damage", [lambda data: data[:-1], lambda data: data.upper()])
+    def test_damaged_download_is_not_cached(self, s3_client, tmp_path, damage):
+        s3_client.put_object(Bucket=BUCKET, Key="a", Body=b"hello")
+        cache = DownloadCache(str(tmp_path / "cache"))
+
+        with pytest.raises(IOError):
+            cache.fetch(DamagingS3Client(s3_client, damage), BUCKET, "a", str(tmp_path / "a"))
+
+        assert os.listdir(tmp_path / "cache") == []
+        assert not cache._pins
+        client = CountingS3Client(s3_client)
+        path = cache.fetch(client, BUCKET, "a", str(tmp_path / "a"))
+        assert client.downloads == 1
+        with open(path, "rb") as f:
+            assert f.read() == b"hello"
+
+    def test_multipart_etag_checks_size(self, s3_client, tmp_path):
+        s3_client.put_object(Bucket=BUCKET, Key="a", Body=b"hello")
+        client = DamagingS3Client(s3_client, lambda data: data.upper())
+        client.head_object = lambda **kwargs: {"ETag": '"abc-2"', "ContentLength": 5}
+        cache = DownloadCache(str(tmp_path / "cache"))
+
+        path = cache.fetch(client, BUCKET, "a", str(tmp_path / "a"))
+
+        # there is no MD5 to check the content of a multipart upload against
+        with open(path, "rb") as f:
+            assert f.read() == b"HELLO"
+
+    def test_least_recently_used_is_evicted(self, s3_client, tmp_path):
+        for key in ["a", "b", "c"]:
+            s3_client.put_object(Bucket=BUCKET, Key=key, Body=b"12345")
+        cache = DownloadCache(str(tmp_path / "cache"), max_bytes=10)
+
+        path_a = cache.fetch(s3_client, BUCKET, "a", str(tmp_path / "a"))
+        cache.release(path_a)
+        path_b = cache.fetch(s3_client, BUCKET, "b", str(tmp_path / "b"))
+        cache.release(path_b)
+        # make a the most recently used entry
+        os.utime(path_b, (time.time() - 60, time.time() - 60))
+        cache.release(cache.fetch(s3_client, BUCKET, "a", str(tmp_path / "a")))
+        path_c = cache.fetch(s3_client, BUCKET, "c", str(tmp_path / "c"))
+
+        assert os.path.exists(path_a)
+        assert not os.path.exists(path_b)
+        assert os.path.exists(path_c)
+
+    def test_entries_in_use_are_not_evicted(self, s3_client, tmp_path):
+        for key in ["a", "b", "c"]:
+            s3_client.put_object(Bucket=BUCKET, Key=key, Body=b"12345")
+        cache = DownloadCache(str(tmp_path / "cache"), max_bytes=10)
+
+        # a is waiting to be converted by another worker
+        path_a = cache.fetch(s3_client, BUCKET, "a", str(tmp_path / "a"))
+        os.utime(path_a, (time.time() - 60, time.time() - 60))
+        path_b = cache.fetch(s3_client, BUCKET, "b", str(tmp_path / "b"))
+        cache.release(path_b)
+        path_c = cache.fetch(s3_client, BUCKET, "c", str(tmp_path / "c"))
+
+        assert os.path.exists(path_a)
+        assert not os.path.exists(path_b)
+        assert os.path.exists(path_c)
+
+        # once released, a is the least recently used entry again
+        cache.release(path_a)
+        cache.fetch(s3_client, BUCKET, "b", str(tmp_path / "b"))
+        assert not os.path.exists(path_a)
+
+    def test_object_larger_than_cache_is_not_cached(self, s3_client, tmp_path):
+        s3_client.put_object(Bucket=BUCKET, Key="a", Body=b"hello")
+        cache = DownloadCache(str(tmp_path / "cache"), max_bytes=2)
+
+        path = cache.fetch(s3_client, BUCKET, "a", str(tmp_path / "a"))
+
+        assert path == str(tmp_path / "a")
+        assert os.listdir(tmp_path / "cache") == []
+
+    def test_transform_data_file_uses_cache(self, s3_client, tmp_path):
+        s3_client.upload_file(os.path.join(os.path.dirname(__file__), "sample.ndjson"),
+                              BUCKET, "data_file")
+        cache = DownloadCache(str(tmp_path / "cache"))
+        exporter = LeanplumExporter("projectId", download_cache=cache)
+        exporter.s3_client = CountingS3Client(s3_client)
+        schemas = {data_type: ["sessionId"] for data_type in exporter.DATA_TYPES}
+
+        for run in range(2):
+            data_dir = tmp_path / str(run)
+            data_dir.mkdir()
+            csv_file_paths = exporter.transform_data_file("data_file", schemas,
+                                                          str(data_dir), BUCKET)
+
+        assert exporter.s3_client.downloads == 1
+        # the cached data file is no longer in use
+        assert not cache._pins
+        with open(csv_file_paths["sessions"]) as f:
+            assert f.read().splitlines() == ["sessionId", "1", "2"]
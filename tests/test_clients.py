@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+
+from leanplum_data_export.clients import ClientConfig, ClientFactory, MB
+
+
+class TestClientFactory(object):
+
+    def test_s3_client_config(self):
+        config = ClientConfig(max_pool_connections=64, max_attempts=3)
+        s3_client = ClientFactory("projectId", config).s3()
+
+        assert s3_client.meta.config.max_pool_connections == 64
+        assert s3_client.meta.config.retries == {"total_max_attempts": 3, "mode": "adaptive"}
+
+    def test_clients_are_shared_across_threads(self):
+        factory = ClientFactory("projectId")
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(lambda _: factory.s3(), range(32)))
+
+        assert all(client is clients[0] for client in clients)
+
+    def test_transfer_config(self):
+        config = ClientConfig(multipart_threshold=16 * MB, multipart_chunksize=4 * MB,
+                              max_concurrency=4)
+        transfer_config = ClientFactory("projectId", config).s3_transfer_config()
+
+        assert transfer_config.multipart_threshold == 16 * MB
+        assert transfer_config.multipart_chunksize == 4 * MB
+        assert transfer_config.max_concurrency == 4
+
+    @patch("google.cloud.storage.Client")
+    def test_gcs_client_connection_pool(self, mock_gcs):
+        ClientFactory("projectId", ClientConfig(max_pool_connections=16)).gcs()
+
+        mock_http = mock_gcs.return_value._http
+        adapter = mock_http.mount.call_args[0][1]
+        assert adapter._pool_maxsize == 16
+
+    def test_invalid_gcs_chunk_size(self):
+        with pytest.raises(ValueError):
+            ClientConfig(gcs_chunk_size=MB + 1)
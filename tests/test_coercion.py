@@ -0,0 +1,113 @@
+import csv
+import io
+import json
+import os
+
+import pytest
+
+from leanplum_data_export import coercion
+from leanplum_data_export.coercion import Coercer, Rejects
+from leanplum_data_export.export import LeanplumExporter
+from leanplum_data_export.synthetic import write_ndjson
+
+
+@pytest.fixture
+def schemas(exporter):
+    return {data_type: [field["name"] for field in exporter.parse_schema(data_type)]
+            for data_type in exporter.DATA_TYPES}
+
+
+def convert(exporter, data_file, schemas, rejects):
+    csv_files = {data_type: io.StringIO() for data_type in exporter.DATA_TYPES}
+    if exporter.batch_size > 0:
+        exporter.write_batches(csv_files, data_file, schemas, rejects)
+    else:
+        exporter.write_rows(csv_files, data_file, schemas, rejects)
+    rejects.close()
+    return {data_type: csv_file.getvalue() for data_type, csv_file in csv_files.items()}
+
+
+class TestConverters(object):
+
+    @pytest.mark.parametrize("convert,value,expected", [
+        (coercion.to_integer, "1", 1),
+        (coercion.to_integer, 12, 12),
+        (coercion.to_integer, 3.0, 3),
+        (coercion.to_integer, "4.0", 4),
+        (coercion.to_float, "1.5", 1.5),
+        (coercion.to_float, 2, 2.0),
+        (coercion.to_boolean, False, "false"),
+        (coercion.to_boolean, "True", "true"),
+        (coercion.to_boolean, "0", "false"),
+        (coercion.to_timestamp, "1.591474962721E9", "2020-06-06 20:22:42.721000 UTC"),
+        (coercion.to_timestamp, 1591474962, "2020-06-06 20:22:42.000000 UTC"),
+    ])
+    def test_valid_values(self, convert, value, expected):
+        assert convert(value) == expected
+
+    @pytest.mark.parametrize("convert,value", [
+        (coercion.to_integer, "a"),
+        (coercion.to_integer, 1.5),
+        (coercion.to_integer, True),
+        (coercion.to_float, "nan"),
+        (coercion.to_float, False),
+        (coercion.to_boolean, "maybe"),
+        (coercion.to_timestamp, "yesterday"),
+        (coercion.to_timestamp, 1e20),
+    ])
+    def test_invalid_values(self, convert, value):
+        with pytest.raises((ValueError, TypeError, KeyError, OverflowError, OSError)):
+            convert(value)
+
+
+class TestCoercer(object):
+
+    def test_coerce_row(self, tmp_path):
+        coercer = Coercer({"events": [
+            {"name": "eventId", "type": "INTEGER"},
+            {"name": "start", "type": "TIMESTAMP"},
+            {"name": "eventName", "type": "STRING"},
+        ]})
+        rejects = Rejects(str(tmp_path), "1")
+
+        row = coercer.coerce_row(
+            "events", {"eventId": "bad", "start": 1591474962, "eventName": "a"}, rejects)
+        rejects.close()
+
+        assert row == {"eventId": None, "start": "2020-06-06 20:22:42.000000 UTC",
+                       "eventName": "a"}
+        assert rejects.counts == {("events", "eventId"): 1}
+        with open(rejects.paths()["rejects/events"]) as f:
+            assert list(csv.reader(f)) == [["column", "value"], ["eventId", "bad"]]
+
+    def test_sample_session(self, exporter, schemas, tmp_path):
+        data_file = os.path.join(os.path.dirname(__file__), "sample.ndjson")
+        rejects = Rejects(str(tmp_path), "1")
+
+        output = convert(exporter, data_file, schemas, rejects)
+
+        session = next(csv.DictReader(io.StringIO(output["sessions"])))
+        assert session["start"] == "2020-06-06 20:22:42.721000 UTC"
+        assert session["userStart"] == "2019-02-13 06:40:22.647000 UTC"
+        assert session["isDeveloper"] == "false"
+        assert session["isSession"] == "false"
+        assert rejects.paths() == {}
+
+    @pytest.mark.parametrize("batch_size", [1, 1000])
+    def test_batch_matches_rows(self, schemas, tmp_path, batch_size):
+        data_file = str(tmp_path / "data.ndjson")
+        write_ndjson(data_file, 100, seed=2)
+        with open(data_file, "a") as f:
+            f.write(json.dumps({"sessionId": "101", "time": "never", "userBucket": "x",
+                                "states": [{"stateId": 1, "events": [
+                                    {"eventId": "e", "name": "a", "time": "1", "value": 0}]}]}))
+
+        row_rejects = Rejects(str(tmp_path), "rows")
+        row_output = convert(LeanplumExporter("projectId"), data_file, schemas, row_rejects)
+        batch_rejects = Rejects(str(tmp_path), "batch")
+        batch_output = convert(LeanplumExporter("projectId", batch_size=batch_size),
+                               data_file, schemas, batch_rejects)
+
+        assert batch_output == row_output
+        assert batch_rejects.counts == row_rejects.counts == {
+            ("sessions", "start"): 1, ("sessions", "userBucket"): 1, ("events", "eventId"): 1}
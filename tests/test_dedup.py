@@ -0,0 +1,204 @@
+import csv
+import glob
+import os
+import shutil
+import sqlite3
+import threading
+
+import pytest
+
+from leanplum_data_export.dedup import BloomFilter, SessionFilter, SessionIndex
+from leanplum_data_export.export import LeanplumExporter
+
+DATE = "20200601"
+
+
+@pytest.fixture
+def source_dir(source_dir):
+    # Leanplum sometimes exports the same sessions again in a later file
+    shutil.copyfile(os.path.join(source_dir, "dev", DATE, "export-0-output-0"),
+                    os.path.join(source_dir, "dev", DATE, "export-0-output-3"))
+    return source_dir
+
+
+def read_duplicates(tmp_path):
+    rows = []
+    for path in sorted(glob.glob(str(tmp_path / "stage" / "dev" / "v1" / DATE / "duplicates" /
+                                     "*"))):
+        with open(path) as f:
+            rows.extend(csv.DictReader(f))
+    return rows
+
+
+class TestBloomFilter(object):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(f"session-{i}")
+
+        assert all(f"session-{i}" in bloom for i in range(1000))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"session-{i}")
+
+        false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+
+        assert false_positives < 300
+
+
+class TestSessionIndex(object):
+
+    def test_first_file_owns_session(self, tmp_path):
+        index = SessionIndex(str(tmp_path / "index.sqlite"), capacity=100)
+
+        assert index.add("1", "file-a") is None
+        assert index.add("1", "file-a") is None
+        assert index.add("1", "file-b") == "file-a"
+        assert index.add("2", "file-b") is None
+
+    def test_reopen(self, tmp_path):
+        path = str(tmp_path / "index.sqlite")
+        index = SessionIndex(path, capacity=100)
+        index.add("1", "file-a")
+        index.close()
+
+        index = SessionIndex(path, capacity=100)
+
+        assert "1" in index.bloom
+        assert index.add("1", "file-b") == "file-a"
+
+    def test_unseen_sessions_skip_lookups(self, tmp_path):
+        index = SessionIndex(str(tmp_path / "index.sqlite"), capacity=10000)
+        for i in range(1000):
+            index.add(str(i), "file-a")
+
+        assert index.lookups < 50
+
+    def test_threads(self, tmp_path):
+        index = SessionIndex(str(tmp_path / "index.sqlite"), capacity=1000)
+        owners = {}
+
+        def add(data_file):
+            owners[data_file] = [index.add(str(i), data_file) for i in range(500)]
+
+        threads = [threading.Thread(target=add, args=(f"file-{i}",)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # every session is owned by exactly one file
+        for i in range(500):
+            assert sum(owners[data_file][i] is None for data_file in owners) == 1
+
+
+class TestSessionFilter(object):
+
+    @pytest.mark.parametrize("mode,kept", [("drop", False), ("flag", True)])
+    def test_duplicates(self, tmp_path, mode, kept):
+        index = SessionIndex(str(tmp_path / "index.sqlite"), capacity=100)
+        index.add("1", "file-a")
+        session_filter = SessionFilter(index, "file-b", mode, str(tmp_path), "output-1")
+
+        assert session_filter.keep({"sessionId": 1}) is kept
+        assert session_filter.keep({"sessionId": 2}) is True
+        assert session_filter.keep({"sessionId": 2}) is kept
+        session_filter.close()
+
+        with open(session_filter.paths()["duplicates"]) as f:
+            assert list(csv.reader(f)) == [
+                ["sessionId", "dataFile", "firstDataFile"],
+                ["1", "file-b", "file-a"],
+                ["2", "file-b", "file-b"],
+            ]
+
+    def test_no_duplicates(self, tmp_path):
+        index = SessionIndex(str(tmp_path / "index.sqlite"), capacity=100)
+        session_filter = SessionFilter(index, "file-a", "drop", str(tmp_path), "output-0")
+
+        assert session_filter.keep({"sessionId": 1})
+        session_filter.close()
+
+        # an empty side file, so that the data file has one for the duplicates table
+        with open(session_filter.paths()["duplicates"]) as f:
+            assert list(csv.reader(f)) == [["sessionId", "dataFile", "firstDataFile"]]
+
+    def test_duplicates_table(self):
+        exporter = LeanplumExporter("projectId", dedup="flag", rollups=True)
+
+        assert exporter.output_types[-2:] == ["duplicates", "rollups"]
+        assert exporter.get_schemas()["duplicates"] == ["sessionId", "dataFile", "firstDataFile"]
+        assert "duplicates" not in LeanplumExporter("projectId").output_types
+
+    def test_invalid_mode(self):
+        with pytest.raises(ValueError):
+            LeanplumExporter("projectId", dedup="merge")
+
+
+class TestDedupExport(object):
+
+    def test_drop(self, tmp_path, local_export, count_rows):
+        local_export(dedup="drop", rollups=True)
+
+        assert count_rows("sessions_v1") == 60
+        assert count_rows("duplicates_v1") == 20
+        duplicates = read_duplicates(tmp_path)
+        assert len(duplicates) == 20
+        assert {row["firstDataFile"] for row in duplicates} == {"export-0-output-0"}
+        with sqlite3.connect(str(tmp_path / "leanplum.db")) as connection:
+            sessions = connection.execute(
+                'SELECT SUM(sessions) FROM "leanplum.rollup_app_versions_v1"').fetchone()[0]
+        assert sessions == 60
+
+    def test_flag(self, tmp_path, local_export, count_rows):
+        local_export(dedup="flag", batch_size=7)
+
+        assert count_rows("sessions_v1") == 80
+        assert len(read_duplicates(tmp_path)) == 20
+        # the flagged sessions are in the duplicates table, next to their other copy
+        with sqlite3.connect(str(tmp_path / "leanplum.db")) as connection:
+            flagged = connection.execute(
+                'SELECT d.dataFile, d.firstDataFile, COUNT(*) '
+                'FROM "leanplum.duplicates_v1" AS d JOIN "leanplum.sessions_v1" AS s '
+                'USING (sessionId, load_date) GROUP BY 1, 2').fetchall()
+        assert flagged == [("export-0-output-3", "export-0-output-0", 40)]
+
+    def test_without_dedup(self, tmp_path, local_export, count_rows):
+        local_export()
+
+        assert count_rows("sessions_v1") == 80
+        assert read_duplicates(tmp_path) == []
+        with pytest.raises(sqlite3.OperationalError):
+            count_rows("duplicates_v1")
+
+    def test_later_run(self, tmp_path, source_dir, local_export, count_rows):
+        duplicate = f"{source_dir}/dev/{DATE}/export-0-output-3"
+        shutil.move(duplicate, f"{duplicate}.later")
+        local_export(dedup="drop")
+        assert count_rows("sessions_v1") == 60
+
+        # the index of the first run knows the sessions of the files it converted
+        shutil.move(f"{duplicate}.later", duplicate)
+        local_export(dedup="drop")
+
+        assert count_rows("sessions_v1") == 60
+        assert len(read_duplicates(tmp_path)) == 20
+
+    def test_rebuild_is_stable(self, local_export, count_rows):
+        local_export(dedup="drop")
+
+        local_export(dedup="drop", only_types=["sessions"])
+        assert count_rows("sessions_v1") == 60
+
+        local_export(dedup="drop", clean=True)
+        assert count_rows("sessions_v1") == 60
+        assert count_rows("duplicates_v1") == 20
+
+    def test_workers(self, tmp_path, local_export, count_rows):
+        local_export(dedup="drop", workers=3)
+
+        assert count_rows("sessions_v1") == 60
+        assert len(read_duplicates(tmp_path)) == 20
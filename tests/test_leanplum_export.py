@@ -13,11 +13,6 @@ from leanplum_data_export import data_parser
 from leanplum_data_export.export import LeanplumExporter
 
 
-@pytest.fixture
-def exporter():
-    return LeanplumExporter("projectId")
-
-
 @pytest.fixture
 def sample_data():
     with open(os.path.join(os.path.dirname(__file__), "sample.ndjson")) as f:
@@ -86,6 +81,38 @@ class TestStreamingExporter(object):
             assert mock_table.external_data_configuration == mock_config
             mock_bq_client.create_table.assert_any_call(mock_table)
 
+    def test_external_tables_of_data_files(self, exporter):
+        with patch('leanplum_data_export.export.bigquery', spec=True) as MockBq:
+            mock_config = Mock()
+            MockBq.ExternalConfig.return_value = mock_config
+            exporter.bq_client = Mock()
+
+            exporter.create_external_tables(
+                "abucket", "aprefix", "20190101", ["sessions"], "ext_dataset",
+                "leanplum_dataset", "prefix", 1,
+                data_file_keys=["aprefix/20190101/export-1-output-3",
+                                "aprefix/20190101/export-1-output-4"])
+
+            assert mock_config.source_uris == [
+                "gs://abucket/aprefix/v1/20190101/sessions/sessions-output-3.csv",
+                "gs://abucket/aprefix/v1/20190101/sessions/sessions-output-4.csv",
+            ]
+
+    def test_append(self, stubbed_exporter):
+        exporter = stubbed_exporter
+        keys = ["prefix/20200601/export-1-output-3"]
+
+        exporter.append("20200601", keys, "gcs", "prefix", "dataset", "table_prefix", "1")
+
+        exporter.create_external_tables.assert_called_once_with(
+            "gcs", "prefix", "20200601", exporter.DATA_TYPES, exporter.TMP_DATASET,
+            "dataset", "table_prefix", "1", data_file_keys=keys)
+        exporter.delete_existing_data.assert_not_called()
+        exporter.load_tables.assert_called_once_with(
+            exporter.TMP_DATASET, "dataset", "table_prefix", exporter.DATA_TYPES, "1",
+            "20200601")
+        exporter.drop_external_tables.assert_called_once()
+
     def test_external_table_can_read_schema(self, exporter):
         date = "20190101"
         bucket = 'abucket'
@@ -244,6 +271,47 @@ class TestStreamingExporter(object):
 
         assert expected_session == session
 
+    def test_intern_pool_shares_objects(self):
+        pool = data_parser.InternPool()
+        first, second = "".join(["E_Opened", "_App"]), "".join(["E_Opened_", "App"])
+        assert first is not second
+
+        assert pool.intern(first) is pool.intern(second)
+
+    def test_intern_pool_max_size(self):
+        pool = data_parser.InternPool(max_size=2)
+        for value in ["a", "b", "c"]:
+            pool.intern(value)
+        assert len(pool) == 1
+
+        # strings seen after the pool started over are pooled again
+        first, second = "".join(["E_Opened", "_App"]), "".join(["E_Opened_", "App"])
+        assert pool.intern(first) is pool.intern(second)
+
+    def test_parameter_values_are_not_interned(self):
+        pool = data_parser.InternPool()
+        with patch.object(data_parser, "pool", pool):
+            data_parser.extract_events({"sessionId": "1", "states": [{"stateId": 1, "events": [
+                {"eventId": 1, "name": "E", "time": 0, "value": 0,
+                 "parameters": {"url": "https://example.com/a"}}]}]})
+            data_parser.extract_user_attributes({"sessionId": "1",
+                                                 "userAttributes": {"name": "free text"}})
+
+        assert len(pool) == 3
+
+    def test_intern_pool_ignores_non_strings(self):
+        pool = data_parser.InternPool()
+        pool.intern(1)
+
+        assert pool.intern(True) is True
+        assert len(pool) == 0
+
+    def test_extract_events_interns_names(self, sample_data):
+        events, _ = data_parser.extract_events(sample_data[0])
+        events_again, _ = data_parser.extract_events(json.loads(json.dumps(sample_data[0])))
+
+        assert events[0]["eventName"] is events_again[0]["eventName"]
+
     def test_parse_schema(self, exporter):
         session_fields = [field["name"] for field in exporter.parse_schema("sessions")]
 
@@ -407,6 +475,7 @@ class TestStreamingExporter(object):
         assert exporter.write_to_csv.call_count == 2
 
     def test_export_file_count(self, exporter):
+        exporter.gcs_client = Mock()
         exporter.get_files = Mock()
         exporter.get_previously_imported_files = Mock()
         exporter.delete_gcs_prefix = Mock()
@@ -414,6 +483,9 @@ class TestStreamingExporter(object):
         exporter.delete_existing_data = Mock()
         exporter.load_tables = Mock()
         exporter.drop_external_tables = Mock()
+        exporter.get_run_state = Mock()
+        exporter.get_schema_fingerprints = Mock(return_value={})
+        exporter.write_schema_fingerprints = Mock()
         exporter.transform_data_file = Mock()
         exporter.write_to_gcs = Mock()
 
@@ -464,6 +536,9 @@ class TestStreamingExporter(object):
         exporter.delete_existing_data = Mock()
         exporter.load_tables = Mock()
         exporter.drop_external_tables = Mock()
+        exporter.get_run_state = Mock()
+        exporter.get_schema_fingerprints = Mock(return_value={})
+        exporter.write_schema_fingerprints = Mock()
 
         exporter.export("20200601", "s3", "gcs", "prefix", "dataset",
                         "table_prefix", "version", False)
@@ -0,0 +1,122 @@
+import logging
+import sqlite3
+
+import pytest
+from click.testing import CliRunner
+
+from leanplum_data_export.__main__ import main
+from leanplum_data_export.local import (LocalExporter, LocalExportUnsupported, LocalS3Client,
+                                        LocalStorageClient)
+from leanplum_data_export.synthetic import write_ndjson
+
+DATE = "20200601"
+
+
+class TestLocalClients(object):
+
+    def test_list_objects_pagination(self, source_dir):
+        client = LocalS3Client()
+
+        first = client.list_objects_v2(Bucket=source_dir, Prefix="dev/20200601/export-",
+                                       MaxKeys=2)
+        second = client.list_objects_v2(Bucket=source_dir, Prefix="dev/20200601/export-",
+                                        MaxKeys=2,
+                                        ContinuationToken=first["NextContinuationToken"])
+
+        assert [content["Key"] for content in first["Contents"] + second["Contents"]] == [
+            f"dev/20200601/export-0-output-{i}" for i in range(3)]
+        assert first["IsTruncated"] and not second["IsTruncated"]
+
+    def test_storage(self, tmp_path):
+        client = LocalStorageClient()
+        bucket = client.bucket(str(tmp_path))
+        bucket.blob("a/b/c").upload_from_string("hello")
+        bucket.blob("a/d").upload_from_string("world")
+
+        blobs = client.list_blobs(str(tmp_path), prefix="a/b/")
+
+        assert [blob.name for page in blobs.pages for blob in page] == ["a/b/c"]
+        assert bucket.blob("a/d").download_as_string() == b"world"
+        bucket.delete_blobs(list(client.list_blobs(bucket, prefix="a/").pages[0]))
+        assert client.list_blobs(bucket).pages == [[]]
+
+
+class TestLocalExporter(object):
+
+    def test_export(self, tmp_path, local_export, count_rows):
+        local_export(nested=True, rollups=True)
+
+        assert count_rows("sessions_v1") == 60
+        assert count_rows("sessions_nested_v1") == 60
+        assert count_rows("events_v1") > 0
+        with sqlite3.connect(str(tmp_path / "leanplum.db")) as connection:
+            sessions = connection.execute(
+                'SELECT SUM(sessions) FROM "leanplum.rollup_app_versions_v1"').fetchone()[0]
+            load_dates = connection.execute(
+                'SELECT DISTINCT load_date FROM "leanplum.sessions_v1"').fetchall()
+            tables = [name for name, in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")]
+        assert sessions == 60
+        assert load_dates == [("2020-06-01",)]
+        # external tables are dropped
+        assert not [table for table in tables if table.startswith("tmp.")]
+
+    def test_each_file_is_exported_once(self, local_export, caplog):
+        with caplog.at_level(logging.INFO):
+            local_export()
+
+        exported = [record.message for record in caplog.records
+                    if record.message.startswith("Exporting ")]
+        assert sorted(exported) == [f"Exporting dev/{DATE}/export-0-output-{i}"
+                                    for i in range(3)]
+
+    def test_rerun_does_not_duplicate(self, local_export, count_rows):
+        local_export()
+        local_export()
+        assert count_rows("sessions_v1") == 60
+
+        local_export(clean=True)
+        assert count_rows("sessions_v1") == 60
+
+    def test_new_file_is_added(self, source_dir, local_export, count_rows):
+        local_export()
+        write_ndjson(f"{source_dir}/dev/{DATE}/export-0-output-3", 5, seed=1)
+
+        local_export()
+
+        assert count_rows("sessions_v1") == 65
+
+    def test_only_types(self, local_export, count_rows):
+        local_export()
+
+        local_export(only_types=["events"], batch_size=7)
+
+        assert count_rows("sessions_v1") == 60
+        assert count_rows("events_v1") > 0
+
+    @pytest.mark.parametrize("call", [
+        lambda exporter: exporter.bq_client,
+        lambda exporter: exporter.run_query("SELECT 1", "load", "sessions", DATE),
+        lambda exporter: exporter.update_table_layout(None, "sessions"),
+    ])
+    def test_bigquery_calls_are_unsupported(self, tmp_path, call):
+        exporter = LocalExporter(str(tmp_path / "leanplum.db"))
+
+        with pytest.raises(LocalExportUnsupported, match="export-local"):
+            call(exporter)
+
+    def test_partition_by_event_time_is_rejected(self, tmp_path):
+        LocalExporter(str(tmp_path / "leanplum.db"), partition_by={"sessions": "load_date"})
+
+        with pytest.raises(ValueError, match="sessions"):
+            LocalExporter(str(tmp_path / "leanplum.db"), partition_by={"sessions": "start"})
+
+    def test_cli(self, tmp_path, source_dir, count_rows):
+        result = CliRunner().invoke(main, [
+            "export-local", "--date", DATE, "--source-dir", source_dir,
+            "--stage-dir", str(tmp_path / "stage"), "--database", str(tmp_path / "leanplum.db"),
+            "--prefix", "dev",
+        ])
+
+        assert result.exit_code == 0, result.output
+        assert count_rows("sessions_v1") == 60
@@ -0,0 +1,61 @@
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+
+from leanplum_data_export.__main__ import main
+
+HEAVY_MODULES = ["boto3", "google.cloud.bigquery", "google.cloud.storage"]
+
+
+def get_loaded_heavy_modules(args):
+    # run in a new interpreter, the test session has already imported everything
+    code = (
+        "import sys\n"
+        "from click.testing import CliRunner\n"
+        "from leanplum_data_export.__main__ import main\n"
+        f"CliRunner().invoke(main, {args!r})\n"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            capture_output=True, text=True).stdout
+    return [module for module in output.strip().split(",") if module]
+
+
+class TestMain(object):
+
+    @pytest.mark.parametrize("args", [
+        ["--help"],
+        ["export-leanplum", "--help"],
+        ["watch", "--help"],
+        ["get-messages", "--help"],
+    ])
+    def test_help_does_not_import_cloud_libraries(self, args):
+        assert get_loaded_heavy_modules(args) == []
+
+    def test_export_leanplum_help(self):
+        result = CliRunner().invoke(main, ["export-leanplum", "--help"])
+
+        assert result.exit_code == 0
+        assert "--s3-bucket" in result.output
+
+    @pytest.mark.parametrize("command,run", [
+        ("export-leanplum", "leanplum_data_export.export.LeanplumExporter.export"),
+        ("watch", "leanplum_data_export.watch.FileWatcher.run"),
+    ])
+    def test_exporter_options(self, command, run, tmp_path):
+        with patch(run, autospec=True) as mock_run, patch("signal.signal"):
+            result = CliRunner().invoke(main, [
+                command, "--date", "20200601", "--bucket", "bucket", "--bq-dataset", "dataset",
+                "--project", "project", "--s3-bucket", "s3-bucket", "--max-attempts", "3",
+                "--cache-dir", str(tmp_path), "--cluster-by", "states=",
+            ])
+
+        assert result.exit_code == 0, result.output
+        exporter = mock_run.call_args[0][0]
+        exporter = getattr(exporter, "exporter", exporter)
+        assert exporter.clients.config.max_attempts == 3
+        assert exporter.download_cache.directory == str(tmp_path)
+        assert exporter.get_clustering_fields("states") is None
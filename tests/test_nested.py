@@ -0,0 +1,147 @@
+import io
+import json
+import os
+from unittest.mock import ANY, Mock, call
+
+import pytest
+
+from leanplum_data_export import data_parser
+from leanplum_data_export.coercion import Rejects
+from leanplum_data_export.export import LeanplumExporter
+from leanplum_data_export.nested import NESTED_TYPE
+from leanplum_data_export.synthetic import write_ndjson
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), "sample.ndjson")
+
+
+@pytest.fixture
+def exporter():
+    return LeanplumExporter("projectId", nested=True)
+
+
+@pytest.fixture
+def schemas(exporter):
+    return {data_type: [field["name"] for field in exporter.parse_schema(data_type)]
+            for data_type in exporter.data_types}
+
+
+def convert(exporter, data_file, schemas, rejects=None):
+    outputs = {data_type: io.StringIO() for data_type in exporter.data_types}
+    if exporter.batch_size > 0:
+        exporter.write_batches(outputs, data_file, schemas, rejects)
+    else:
+        exporter.write_rows(outputs, data_file, schemas, rejects)
+    return {data_type: output.getvalue() for data_type, output in outputs.items()}
+
+
+class TestNestedSessions(object):
+
+    def test_extract_nested_session(self, schemas):
+        with open(SAMPLE_FILE) as f:
+            session_data = json.loads(next(f))
+
+        session = data_parser.extract_nested_session(session_data, schemas[NESTED_TYPE])
+
+        assert session["sessionId"] == "1"
+        assert session["appVersion"] == "18099"
+        assert "lat" not in session
+        assert session["userAttributes"] == [
+            {"name": "Mailto Is Default", "value": "True"},
+            {"name": "FxA account is verified", "value": "False"},
+        ]
+        assert session["experiments"] == [
+            {"experimentId": 800315004, "variantId": 796675005},
+            {"experimentId": 842715057, "variantId": 858195027},
+        ]
+        events = session["states"][0]["events"]
+        assert [event["eventName"] for event in events] == [
+            "E_Opened_App", "E_Interact_With_Search_URL_Area"]
+        assert events[1]["parameters"] == [{"name": "p1", "value": "value"}]
+
+    def test_nested_output_is_coerced(self, exporter, schemas, tmp_path):
+        rejects = Rejects(str(tmp_path), "1")
+
+        output = convert(exporter, SAMPLE_FILE, schemas, rejects)
+        rejects.close()
+
+        session = json.loads(output[NESTED_TYPE].splitlines()[0])
+        assert session["sessionId"] == 1
+        assert session["isDeveloper"] == "false"
+        assert session["states"][0]["events"][0]["start"] == "2020-06-06 20:22:42.721000 UTC"
+        assert rejects.paths() == {}
+        # the flat tables are written as before
+        assert output["sessions"].startswith("sessionId,userId")
+
+    def test_nested_rejects(self, exporter, schemas, tmp_path):
+        data_file = str(tmp_path / "data.ndjson")
+        with open(data_file, "w") as f:
+            f.write(json.dumps({"sessionId": "1", "states": [{"stateId": 1, "events": [
+                {"eventId": "e", "name": "a", "time": "never", "value": 0}]}]}))
+        rejects = Rejects(str(tmp_path), "1")
+
+        output = convert(exporter, data_file, schemas, rejects)
+        rejects.close()
+
+        event = json.loads(output[NESTED_TYPE])["states"][0]["events"][0]
+        assert event["eventId"] is None
+        assert event["start"] is None
+        assert rejects.counts[(NESTED_TYPE, "states.events.eventId")] == 1
+        assert rejects.counts[(NESTED_TYPE, "states.events.start")] == 1
+
+    def test_batch_matches_rows(self, schemas, tmp_path):
+        data_file = str(tmp_path / "data.ndjson")
+        write_ndjson(data_file, 50, seed=3)
+
+        row_output = convert(LeanplumExporter("projectId", nested=True), data_file, schemas,
+                             Rejects(str(tmp_path), "rows"))
+        batch_output = convert(LeanplumExporter("projectId", nested=True, batch_size=7),
+                               data_file, schemas, Rejects(str(tmp_path), "batch"))
+
+        assert batch_output[NESTED_TYPE] == row_output[NESTED_TYPE]
+        assert len(row_output[NESTED_TYPE].splitlines()) == 50
+
+    def test_transform_data_file(self, exporter, schemas, tmp_path):
+        exporter.download_data_file = Mock(return_value=SAMPLE_FILE)
+
+        paths = exporter.transform_data_file("a/20200601/export-1-output-0", schemas,
+                                             str(tmp_path), "bucket")
+
+        assert paths[NESTED_TYPE].name == "sessions_nested-output-0.ndjson"
+        assert paths["sessions"].name == "sessions-output-0.csv"
+
+    def test_external_table(self, exporter):
+        exporter.bq_client = Mock()
+
+        exporter.create_external_tables("bucket", "prefix", "20200601", [NESTED_TYPE],
+                                        "tmp", "dataset", "", "1")
+
+        table = exporter.bq_client.create_table.call_args[0][0]
+        config = table.external_data_configuration
+        assert config.source_format == "NEWLINE_DELIMITED_JSON"
+        assert config.source_uris == ["gs://bucket/prefix/v1/20200601/sessions_nested/*"]
+        states = next(field for field in config.schema if field.name == "states")
+        assert states.mode == "REPEATED"
+        assert [field.name for field in states.fields] == ["stateId", "events"]
+
+    def test_enabling_rebuilds_from_all_files(self, stubbed_exporter):
+        exporter = stubbed_exporter
+        exporter.get_files.return_value = ["a/b/file1"]
+        exporter.get_previously_imported_files.return_value = {"file1"}
+        del exporter.get_schema_fingerprints.return_value[NESTED_TYPE]
+
+        exporter.export("20200601", "s3", "gcs", "prefix", "dataset", "table_prefix", "1", False)
+
+        exporter.transform_data_file.assert_called_once_with(
+            "a/b/file1", {NESTED_TYPE: ANY}, ANY, ANY)
+        assert exporter.load_tables.call_args[0][3] == [NESTED_TYPE]
+
+    def test_disabling_removes_fingerprint(self):
+        exporter = LeanplumExporter("projectId")
+        exporter.gcs_client = Mock()
+        bucket = exporter.gcs_client.bucket.return_value
+
+        exporter.write_schema_fingerprints("bucket", "prefix", "1", "20200601",
+                                           {"sessions": "a"}, {"sessions": "a", NESTED_TYPE: "b"})
+
+        assert bucket.delete_blob.call_args_list == [
+            call("prefix/v1/20200601/schema_fingerprints/sessions_nested-b")]
@@ -0,0 +1,52 @@
+import json
+import os
+import runpy
+
+import pytest
+
+from leanplum_data_export.synthetic import write_ndjson
+
+pytestmark = pytest.mark.perf
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "perf_baseline.json")
+PERF_MODULE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "benchmarks", "perf.py")
+measure_transform = runpy.run_path(PERF_MODULE)["measure_transform"]
+
+
+def read_baseline():
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="module")
+def data_file(tmp_path_factory):
+    baseline = read_baseline()
+    path = str(tmp_path_factory.mktemp("perf") / "data.ndjson")
+    write_ndjson(path, baseline["sessions"], baseline["seed"])
+    return path
+
+
+@pytest.mark.parametrize("mode", ["rows", "batches"])
+def test_transform(request, data_file, mode):
+    baseline = read_baseline()
+    result = measure_transform(data_file, baseline["batch_sizes"][mode])
+
+    if request.config.getoption("--update-perf-baseline"):
+        baseline["results"][mode] = {key: result[key]
+                                     for key in ("relative_throughput", "peak_memory_mb")}
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+        return
+
+    tolerance = request.config.getoption("--perf-tolerance")
+    if tolerance is None:
+        tolerance = baseline["tolerance"]
+    expected = baseline["results"][mode]
+    assert result["relative_throughput"] >= expected["relative_throughput"] * (1 - tolerance), (
+        f"{mode}: {result['relative_throughput']} sessions per calibration record "
+        f"({result['sessions_per_second']:,} sessions/s), "
+        f"baseline {expected['relative_throughput']}")
+    assert result["peak_memory_mb"] <= expected["peak_memory_mb"] * (1 + tolerance), (
+        f"{mode}: peak {result['peak_memory_mb']}MB, baseline {expected['peak_memory_mb']}MB")
@@ -0,0 +1,144 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from leanplum_data_export.local import LocalExporter
+from leanplum_data_export.pipeline import ByteBudget, Pipeline
+from leanplum_data_export.synthetic import write_export_files
+
+
+class TestByteBudget(object):
+
+    def test_acquire_waits_for_release(self):
+        budget = ByteBudget(10)
+        budget.acquire(8)
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(5)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        assert not acquired.wait(0.1)
+
+        budget.release(8)
+        thread.join()
+        assert acquired.is_set()
+        assert budget.in_use == 5
+        assert budget.peak == 8
+
+    def test_oversized_item_when_empty(self):
+        budget = ByteBudget(10)
+        budget.acquire(50)
+        assert budget.in_use == 50
+
+    def test_resize_does_not_block(self):
+        budget = ByteBudget(10)
+        budget.acquire(10)
+        budget.resize(10, 30)
+        assert budget.in_use == 30
+
+
+class TestPipeline(object):
+
+    def test_run(self):
+        results = []
+        lock = threading.Lock()
+
+        def collect(item):
+            with lock:
+                results.append(item)
+
+        pipeline = Pipeline([("double", lambda item: item * 2, 3),
+                             ("add", lambda item: item + 1, 2),
+                             ("collect", collect, 1)])
+        pipeline.run(range(100))
+
+        assert sorted(results) == [item * 2 + 1 for item in range(100)]
+        assert [stage.items for stage in pipeline.stages] == [100, 100, 100]
+
+    def test_slow_stage_throttles_earlier_stages(self):
+        in_flight = []
+        current = [0]
+        lock = threading.Lock()
+
+        def produce(item):
+            with lock:
+                current[0] += 1
+                in_flight.append(current[0])
+            return item
+
+        def consume(item):
+            time.sleep(0.005)
+            with lock:
+                current[0] -= 1
+
+        pipeline = Pipeline([("produce", produce, 1), ("consume", consume, 1)], queue_size=2)
+        pipeline.run(range(30))
+
+        # one item being consumed, two queued and one produced and waiting to be queued
+        assert max(in_flight) <= 4
+        assert pipeline.stages[0].blocked_seconds > 0
+
+    def test_budget_limits_items_in_flight(self):
+        budget = ByteBudget(300)
+        in_flight = []
+
+        def fetch(item):
+            budget.acquire(100)
+            in_flight.append(budget.in_use)
+            return item
+
+        def upload(item):
+            time.sleep(0.002)
+            budget.release(100)
+
+        pipeline = Pipeline([("fetch", fetch, 4), ("upload", upload, 1)], queue_size=8,
+                            budget=budget)
+        pipeline.run(range(20))
+
+        assert max(in_flight) <= 300
+        assert budget.in_use == 0
+
+    def test_error_stops_pipeline(self):
+        budget = ByteBudget(100)
+
+        def fetch(item):
+            budget.acquire(60)
+            return item
+
+        def fail(item):
+            raise ValueError("upload failed")
+
+        pipeline = Pipeline([("fetch", fetch, 2), ("upload", fail, 1)], budget=budget)
+        with pytest.raises(ValueError, match="upload failed"):
+            pipeline.run(range(50))
+
+
+class TestConcurrentExport(object):
+
+    def test_matches_sequential(self, tmp_path):
+        write_export_files(str(tmp_path / "source" / "dev"), "20200601", files=5,
+                           sessions_per_file=30)
+
+        counts = {}
+        for workers in (1, 3):
+            database = str(tmp_path / f"leanplum-{workers}.db")
+            # a budget smaller than one file still lets files through one at a time
+            exporter = LocalExporter(database, workers=workers, max_inflight_bytes=1)
+            exporter.export("20200601", str(tmp_path / "source"),
+                            str(tmp_path / f"stage-{workers}"), "dev", "leanplum", "", "1", False)
+            with sqlite3.connect(database) as connection:
+                counts[workers] = [
+                    connection.execute(f'SELECT COUNT(*) FROM "leanplum.{table}_v1"').fetchone()
+                    for table in ("sessions", "events", "eventparameters", "userattributes")
+                ]
+
+        assert counts[3] == counts[1]
+        assert counts[1][0] == (150,)
+        # file history was recorded for every file
+        history_dir = tmp_path / "stage-3" / "dev" / "v1" / "20200601" / "file_history"
+        assert len(list(history_dir.iterdir())) == 5
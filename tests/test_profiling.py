@@ -0,0 +1,80 @@
+import os
+import threading
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from leanplum_data_export.__main__ import main
+from leanplum_data_export.profiling import Profiler
+
+
+def busy_work():
+    return sum(i * i for i in range(10000))
+
+
+class TestProfiler(object):
+
+    def test_trace_file(self, tmp_path):
+        profiler = Profiler(str(tmp_path))
+        profiler.start()
+
+        with profiler.trace_file("a/b/export-1-output-0"):
+            data = [str(i) for i in range(10000)]
+        profiler.stop()
+
+        assert len(data) == 10000
+        assert len(profiler.file_timings) == 1
+        assert profiler.file_timings[0]["file"] == "a/b/export-1-output-0"
+        assert profiler.file_timings[0]["peak_bytes"] > 0
+        assert os.path.exists(tmp_path / f"memory-{os.getpid()}-export-1-output-0.txt")
+        assert os.path.exists(tmp_path / f"files-{os.getpid()}.json")
+
+    def test_concurrent_files(self, tmp_path):
+        profiler = Profiler(str(tmp_path))
+        profiler.start()
+
+        with profiler.trace_file("export-1-output-0"):
+            with profiler.trace_file("export-1-output-1"):
+                busy_work()
+        with profiler.trace_file("export-1-output-2"):
+            busy_work()
+        profiler.stop()
+
+        timings = {timing["file"]: timing for timing in profiler.file_timings}
+        # overlapping files only get the peak of the whole process
+        for name in ["export-1-output-0", "export-1-output-1"]:
+            assert "peak_bytes" not in timings[name]
+            assert timings[name]["process_peak_bytes"] > 0
+            assert not os.path.exists(tmp_path / f"memory-{os.getpid()}-{name}.txt")
+        assert timings["export-1-output-2"]["peak_bytes"] > 0
+        assert "process peak" in Profiler.format_peak(timings["export-1-output-0"])
+
+    def test_threads_are_merged(self, tmp_path):
+        profiler = Profiler(str(tmp_path))
+        profiler.start()
+
+        def worker():
+            with profiler.profile_thread():
+                busy_work()
+
+        threads = [threading.Thread(target=worker) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        profiler.stop()
+
+        assert len([name for name in os.listdir(tmp_path) if name.startswith("cpu-")]) == 4
+        assert os.path.exists(tmp_path / "merged.pstats")
+
+    def test_profile_option(self, tmp_path):
+        with patch("leanplum_data_export.export.LeanplumExporter.export") as mock_export:
+            result = CliRunner().invoke(main, [
+                "--profile", str(tmp_path), "export-leanplum", "--date", "20200601",
+                "--bucket", "bucket", "--bq-dataset", "dataset", "--project", "project",
+                "--s3-bucket", "s3-bucket",
+            ])
+
+        assert result.exit_code == 0, result.output
+        mock_export.assert_called_once()
+        assert os.path.exists(tmp_path / "merged.pstats")
@@ -0,0 +1,172 @@
+import json
+import os
+from unittest.mock import ANY, Mock, PropertyMock
+
+import pytest
+from google.cloud import bigquery
+
+from leanplum_data_export.export import LeanplumExporter
+from leanplum_data_export.rollups import OTHER, ROLLUPS_TYPE, HyperLogLog, Rollups
+from leanplum_data_export.synthetic import generate_sessions, write_ndjson
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), "sample.ndjson")
+
+
+def session(user_id, app_version="1", country="US", events=(), experiments=()):
+    return {
+        "sessionId": "1", "userId": user_id, "appVersion": app_version, "country": country,
+        "states": [{"stateId": 1, "events": [{"eventId": 1, "name": name, "time": "1",
+                                              "value": 0} for name in events]}],
+        "experiments": [{"id": experiment_id, "variantId": variant_id}
+                        for experiment_id, variant_id in experiments],
+    }
+
+
+class TestHyperLogLog(object):
+
+    @pytest.mark.parametrize("count", [10, 1000, 50000])
+    def test_count(self, count):
+        sketch = HyperLogLog()
+        for i in range(count):
+            sketch.add(f"user-{i}")
+            sketch.add(f"user-{i}")
+
+        assert sketch.count() == pytest.approx(count, rel=0.05)
+
+    def test_merge(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(3000):
+            first.add(i)
+            second.add(i + 2000)
+
+        first.merge(HyperLogLog.from_string(second.to_string(), second.precision))
+
+        assert first.count() == pytest.approx(5000, rel=0.05)
+
+    def test_merge_different_precisions(self):
+        with pytest.raises(ValueError):
+            HyperLogLog(10).merge(HyperLogLog(11))
+
+
+class TestRollups(object):
+
+    def test_add(self):
+        rollups = Rollups()
+        rollups.add(session("a", events=["E_Open", "E_Open", "E_Search"],
+                            experiments=[(1, 10)]))
+        rollups.add(session("a", country="DE", events=["E_Open"], experiments=[(1, 10)]))
+        rollups.add(session("b", app_version="2"))
+
+        rows = rollups.get_rows("2020-06-01")
+
+        assert sorted(rows["rollup_event_counts"], key=lambda row: row["events"]) == [
+            {"load_date": "2020-06-01", "eventName": "E_Search", "country": "US", "events": 1},
+            {"load_date": "2020-06-01", "eventName": "E_Open", "country": "DE", "events": 1},
+            {"load_date": "2020-06-01", "eventName": "E_Open", "country": "US", "events": 2},
+        ]
+        assert rows["rollup_app_versions"] == [
+            {"load_date": "2020-06-01", "appVersion": "1", "sessions": 2, "users": 1},
+            {"load_date": "2020-06-01", "appVersion": "2", "sessions": 1, "users": 1},
+        ]
+        assert rows["rollup_experiment_exposures"] == [
+            {"load_date": "2020-06-01", "experimentId": 1, "variantId": 10, "sessions": 2,
+             "users": 1},
+        ]
+
+    def test_max_keys(self):
+        rollups = Rollups(max_keys=2)
+        for app_version in ["1", "2", "3", "4", "1"]:
+            rollups.add(session(app_version, app_version=app_version, events=[app_version]))
+
+        assert rollups.app_version_sessions == {"1": 2, "2": 1, OTHER: 2}
+        assert rollups.app_version_users[OTHER].count() == 2
+        assert rollups.event_counts[(OTHER, OTHER)] == 2
+
+    def test_merged_partials_match_single_pass(self):
+        sessions = list(generate_sessions(300, seed=4))
+        single_pass = Rollups()
+        partials = [Rollups(), Rollups(), Rollups()]
+        for i, session_data in enumerate(sessions):
+            single_pass.add(session_data)
+            partials[i % 3].add(session_data)
+
+        merged = Rollups()
+        for partial in partials:
+            merged.merge(Rollups.from_dict(json.loads(json.dumps(partial.to_dict()))))
+
+        merged_rows = merged.get_rows("2020-06-01")
+        for table, rows in single_pass.get_rows("2020-06-01").items():
+            assert sorted(merged_rows[table], key=repr) == sorted(rows, key=repr)
+
+    def test_unsupported_version(self):
+        data = Rollups().to_dict()
+        data["version"] = 0
+        with pytest.raises(ValueError):
+            Rollups.from_dict(data)
+
+
+class TestExportRollups(object):
+
+    @pytest.mark.parametrize("batch_size", [0, 10])
+    def test_transform_data_file(self, tmp_path, batch_size):
+        exporter = LeanplumExporter("projectId", rollups=True, batch_size=batch_size)
+        data_file = str(tmp_path / "data.ndjson")
+        write_ndjson(data_file, 40, seed=5)
+        exporter.download_data_file = Mock(return_value=data_file)
+        data_dir = tmp_path / "data"
+        data_dir.mkdir()
+
+        paths = exporter.transform_data_file("a/20200601/export-1-output-0",
+                                             {ROLLUPS_TYPE: []}, str(data_dir), "bucket")
+
+        assert list(paths) == [ROLLUPS_TYPE]
+        with open(paths[ROLLUPS_TYPE]) as f:
+            rollups = Rollups.from_dict(json.load(f))
+        assert sum(rollups.app_version_sessions.values()) == 40
+
+    def test_load_rollups(self):
+        exporter = LeanplumExporter("projectId", rollups=True)
+        rollups = Rollups()
+        for session_data in generate_sessions(20, seed=6):
+            rollups.add(session_data)
+        blob = Mock()
+        blob.download_as_string.return_value = json.dumps(rollups.to_dict())
+        blobs = Mock()
+        type(blobs).pages = PropertyMock(return_value=[[blob, blob]])
+        exporter.gcs_client = Mock()
+        exporter.gcs_client.list_blobs.return_value = blobs
+        exporter.bq_client = Mock()
+        run_state = Mock()
+        run_state.is_done.return_value = False
+
+        exporter.load_rollups("bucket", "prefix", "1", "20200601", "dataset", "leanplum",
+                              run_state=run_state)
+
+        exporter.gcs_client.list_blobs.assert_called_once_with(
+            "bucket", prefix="prefix/v1/20200601/rollups/")
+        load_calls = exporter.bq_client.load_table_from_json.call_args_list
+        assert [load_call[0][1] for load_call in load_calls] == [
+            "dataset.leanplum_rollup_event_counts_v1$20200601",
+            "dataset.leanplum_rollup_app_versions_v1$20200601",
+            "dataset.leanplum_rollup_experiment_exposures_v1$20200601",
+        ]
+        app_version_rows = load_calls[1][0][0]
+        assert sum(row["sessions"] for row in app_version_rows) == 40
+        job_config = load_calls[1][1]["job_config"]
+        assert job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE
+        assert job_config.time_partitioning.field == "load_date"
+        run_state.mark_done.assert_called_once_with("load", ROLLUPS_TYPE)
+
+    @pytest.mark.parametrize("exporter", [LeanplumExporter("projectId", rollups=True)])
+    def test_export(self, stubbed_exporter):
+        exporter = stubbed_exporter
+        exporter.get_files.return_value = ["a/b/file1"]
+        exporter.get_previously_imported_files.return_value = set()
+
+        exporter.export("20200601", "s3", "gcs", "prefix", "dataset", "table_prefix", "1", False)
+
+        exporter.transform_data_file.assert_called_once()
+        assert ROLLUPS_TYPE in exporter.transform_data_file.call_args[0][1]
+        assert exporter.load_tables.call_args[0][3] == exporter.DATA_TYPES
+        exporter.load_rollups.assert_called_once_with(
+            "gcs", "prefix", "1", "20200601", "dataset", "table_prefix", run_state=ANY)
@@ -0,0 +1,156 @@
+import json
+from unittest.mock import Mock, call
+
+from google.cloud import exceptions
+
+from leanplum_data_export.run_state import RunState
+
+
+def get_gcs_client(stored_state=None):
+    gcs_client, blob = Mock(), Mock()
+    gcs_client.bucket.return_value.blob.return_value = blob
+    if stored_state is None:
+        blob.download_as_string.side_effect = exceptions.NotFound("not found")
+    else:
+        blob.download_as_string.return_value = json.dumps(stored_state)
+    return gcs_client, blob
+
+
+class TestRunState(object):
+
+    def test_load_new_state(self):
+        gcs_client, _ = get_gcs_client()
+
+        run_state = RunState.load(gcs_client, "bucket", "path", {"file1"})
+
+        assert not run_state.is_done("load", "sessions")
+        gcs_client.bucket.return_value.blob.assert_called_with("path")
+
+    def test_load_existing_state(self):
+        stages = {stage: {} for stage in RunState.STAGES}
+        stages["load"]["sessions"] = {"done": True, "job_id": "job1"}
+        stages["load"]["events"] = {"done": False, "job_id": "job2"}
+        gcs_client, _ = get_gcs_client({
+            "files_fingerprint": RunState.get_files_fingerprint({"file1", "file2"}),
+            "stages": stages,
+        })
+
+        run_state = RunState.load(gcs_client, "bucket", "path", {"file2", "file1"})
+
+        assert run_state.is_done("load", "sessions")
+        assert not run_state.is_done("load", "events")
+        assert run_state.get_job_id("load", "events") == "job2"
+
+    def test_load_state_for_other_files(self):
+        stages = {stage: {} for stage in RunState.STAGES}
+        stages["load"]["sessions"] = {"done": True, "job_id": "job1"}
+        gcs_client, _ = get_gcs_client({
+            "files_fingerprint": RunState.get_files_fingerprint({"file1"}),
+            "stages": stages,
+        })
+
+        run_state = RunState.load(gcs_client, "bucket", "path", {"file1", "file2"})
+
+        assert not run_state.is_done("load", "sessions")
+
+    def test_progress_is_saved(self):
+        gcs_client, blob = get_gcs_client()
+        run_state = RunState.load(gcs_client, "bucket", "path", {"file1"})
+
+        run_state.set_job_id("delete", "sessions", "job1")
+        run_state.mark_done("delete", "sessions")
+
+        saved = json.loads(blob.upload_from_string.call_args[0][0])
+        assert saved["stages"]["delete"]["sessions"] == {"done": True, "job_id": "job1"}
+
+
+class TestResumableStages(object):
+
+    def test_run_query_records_job(self, exporter):
+        exporter.bq_client = Mock()
+        run_state = Mock()
+        run_state.get_job_id.return_value = None
+
+        exporter.run_query("SELECT 1", "load", "sessions", "20200601", run_state)
+
+        job_id = run_state.set_job_id.call_args[0][2]
+        exporter.bq_client.query.assert_called_once_with("SELECT 1", job_id=job_id)
+        exporter.bq_client.query.return_value.result.assert_called_once()
+        run_state.mark_done.assert_called_once_with("load", "sessions")
+
+    def test_run_query_reattaches_to_running_job(self, exporter):
+        exporter.bq_client = Mock()
+        job = exporter.bq_client.get_job.return_value
+        job.state = "RUNNING"
+        run_state = Mock()
+        run_state.get_job_id.return_value = "job1"
+
+        exporter.run_query("SELECT 1", "load", "sessions", "20200601", run_state)
+
+        exporter.bq_client.get_job.assert_called_once_with("job1")
+        job.result.assert_called_once()
+        exporter.bq_client.query.assert_not_called()
+        run_state.mark_done.assert_called_once_with("load", "sessions")
+
+    def test_run_query_restarts_failed_job(self, exporter):
+        exporter.bq_client = Mock()
+        job = exporter.bq_client.get_job.return_value
+        job.state = "DONE"
+        job.error_result = {"reason": "invalidQuery"}
+        run_state = Mock()
+        run_state.get_job_id.return_value = "job1"
+
+        exporter.run_query("SELECT 1", "load", "sessions", "20200601", run_state)
+
+        exporter.bq_client.query.assert_called_once()
+        run_state.mark_done.assert_called_once_with("load", "sessions")
+
+    def test_load_tables_skips_finished_tables(self, exporter):
+        exporter.bq_client = Mock()
+        exporter.get_table_exists = Mock(return_value=True)
+        exporter.run_query = Mock()
+        run_state = Mock()
+        run_state.is_done.side_effect = lambda stage, table: table == "events"
+
+        exporter.load_tables("tmp", "dataset", "prefix", ["events", "sessions"], 1, "20200601",
+                             run_state=run_state)
+
+        exporter.run_query.assert_called_once()
+        assert exporter.run_query.call_args[0][1:3] == ("load", "sessions")
+
+    def test_delete_skips_missing_table(self, exporter):
+        exporter.bq_client = Mock()
+        exporter.bq_client.get_table.side_effect = exceptions.NotFound("not found")
+        exporter.run_query = Mock()
+        run_state = Mock()
+        run_state.is_done.return_value = False
+
+        exporter.delete_existing_data("dataset", "prefix", ["sessions"], 1, "20200601",
+                                      run_state=run_state)
+
+        exporter.run_query.assert_not_called()
+        run_state.mark_done.assert_called_once_with("delete", "sessions")
+
+    def test_delete_existing_table(self, exporter):
+        exporter.bq_client = Mock()
+        exporter.run_query = Mock()
+
+        exporter.delete_existing_data("dataset", "prefix", ["sessions"], 1, "20200601")
+
+        exporter.run_query.assert_called_once()
+        assert exporter.run_query.call_args[0][0].startswith(
+            "DELETE FROM `dataset.prefix_sessions_v1`")
+
+    def test_export_run_state_includes_new_files(self, stubbed_exporter):
+        exporter = stubbed_exporter
+        exporter.get_previously_imported_files.return_value = {"file1"}
+
+        exporter.export("20200601", "s3", "gcs", "prefix", "dataset",
+                        "table_prefix", "1", False)
+
+        exporter.get_run_state.assert_called_once_with(
+            "gcs", "prefix", "1", "20200601", {"file1", "file2"})
+        run_state = exporter.get_run_state.return_value
+        assert exporter.load_tables.call_args == call(
+            "tmp", "dataset", "table_prefix", exporter.DATA_TYPES, "1", "20200601",
+            run_state=run_state)
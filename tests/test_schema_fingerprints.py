@@ -0,0 +1,141 @@
+import sqlite3
+from unittest.mock import ANY, Mock, PropertyMock, call, patch
+
+import pytest
+
+from leanplum_data_export.export import LeanplumExporter
+from leanplum_data_export.local import LocalExporter
+
+
+@pytest.fixture
+def exporter(stubbed_exporter):
+    return stubbed_exporter
+
+
+class TestSchemaFingerprints(object):
+
+    def test_unchanged_schemas_skip_files(self, exporter):
+        exporter.export("20200601", "s3", "gcs", "prefix", "dataset", "table_prefix", "1", False)
+
+        exporter.transform_data_file.assert_not_called()
+        exporter.delete_gcs_prefix.assert_not_called()
+        exporter.get_run_state.return_value.reset.assert_not_called()
+        assert exporter.load_tables.call_args[0][3] == exporter.DATA_TYPES
+
+    def test_changed_schema_rebuilds_data_type(self, exporter):
+        exporter.get_schema_fingerprints.return_value["sessions"] = "outdated"
+
+        exporter.export("20200601", "s3", "gcs", "prefix", "dataset", "table_prefix", "1", False)
+
+        assert exporter.delete_gcs_prefix.call_args_list == [
+            call(ANY, "prefix/v1/20200601/sessions/"),
+            call(ANY, "prefix/v1/20200601/rejects/sessions/"),
+        ]
+        assert exporter.transform_data_file.call_count == 2
+        for transform_call in exporter.transform_data_file.call_args_list:
+            assert list(transform_call[0][1]) == ["sessions"]
+        exporter.get_run_state.return_value.reset.assert_called_once_with(["sessions"])
+        assert exporter.load_tables.call_args[0][3] == ["sessions"]
+        # rebuilt files are already in the file history
+        history_writes = [c for c in exporter.write_to_gcs.call_args_list
+                          if c[0][1] == exporter.FILE_HISTORY_PREFIX]
+        assert history_writes == []
+
+    def test_changed_schema_with_new_file_loads_all_tables(self, exporter):
+        exporter.get_schema_fingerprints.return_value["sessions"] = "outdated"
+        exporter.get_previously_imported_files.return_value = {"file1"}
+
+        exporter.export("20200601", "s3", "gcs", "prefix", "dataset", "table_prefix", "1", False)
+
+        exporter.transform_data_file.assert_has_calls([
+            call("a/b/file1", {"sessions": ANY}, ANY, ANY),
+            call("a/b/file2", ANY, ANY, ANY),
+        ])
+        assert (list(exporter.transform_data_file.call_args_list[1][0][1])
+                == exporter.DATA_TYPES)
+        assert exporter.load_tables.call_args[0][3] == exporter.DATA_TYPES
+
+    def test_only_types(self, exporter):
+        exporter.export("20200601", "s3", "gcs", "prefix", "dataset", "table_prefix", "1", True,
+                        only_types=["events", "eventparameters"])
+
+        # only the requested data types are cleaned
+        assert exporter.delete_gcs_prefix.call_args_list == [
+            call(ANY, "prefix/v1/20200601/eventparameters/"),
+            call(ANY, "prefix/v1/20200601/rejects/eventparameters/"),
+            call(ANY, "prefix/v1/20200601/events/"),
+            call(ANY, "prefix/v1/20200601/rejects/events/"),
+        ]
+        assert exporter.load_tables.call_args[0][3] == ["eventparameters", "events"]
+
+    def test_only_types_unknown_type(self, exporter):
+        with pytest.raises(ValueError):
+            exporter.export("20200601", "s3", "gcs", "prefix", "dataset", "table_prefix", "1",
+                            False, only_types=["sessions", "unknown"])
+
+    def test_get_schema_fingerprints(self):
+        exporter = LeanplumExporter("projectId")
+        blob = Mock()
+        blob.name = "prefix/v1/20200601/schema_fingerprints/sessions-abc123"
+        blobs = Mock()
+        type(blobs).pages = PropertyMock(return_value=[[blob]])
+        exporter.gcs_client = Mock()
+        exporter.gcs_client.list_blobs.return_value = blobs
+
+        fingerprints = exporter.get_schema_fingerprints("bucket", "prefix", "1", "20200601")
+
+        assert fingerprints == {"sessions": "abc123"}
+        exporter.gcs_client.list_blobs.assert_called_once_with(
+            "bucket", prefix="prefix/v1/20200601/schema_fingerprints/")
+
+    def test_write_schema_fingerprints(self):
+        exporter = LeanplumExporter("projectId")
+        exporter.gcs_client = Mock()
+        bucket = exporter.gcs_client.bucket.return_value
+
+        exporter.write_schema_fingerprints(
+            "bucket", "prefix", "1", "20200601",
+            {"sessions": "new", "events": "same", "states": "added"},
+            {"sessions": "old", "events": "same"})
+
+        bucket.delete_blob.assert_called_once_with(
+            "prefix/v1/20200601/schema_fingerprints/sessions-old")
+        bucket.blob.assert_has_calls([
+            call("prefix/v1/20200601/schema_fingerprints/sessions-new"),
+            call().upload_from_string(""),
+            call("prefix/v1/20200601/schema_fingerprints/states-added"),
+            call().upload_from_string(""),
+        ])
+
+    def test_write_to_csv_only_given_data_types(self, exporter):
+        csv_writers = {"sessions": Mock()}
+        session_data = {"sessionId": "1", "userAttributes": {"a": "b"},
+                        "states": [{"stateId": 1, "events": [
+                            {"eventId": 1, "name": "a", "time": "1", "value": 0}]}]}
+
+        exporter.write_to_csv(csv_writers, session_data, {"sessions": ["sessionId"]})
+
+        csv_writers["sessions"].writerow.assert_called_once()
+
+
+class TestInterruptedRebuild(object):
+
+    @pytest.mark.parametrize("failing_step", ["get_run_state", "write_schema_fingerprints",
+                                              "create_external_tables"])
+    def test_rerun_reloads_rebuilt_tables(self, tmp_path, local_export, count_rows,
+                                          failing_step):
+        local_export()
+        with sqlite3.connect(str(tmp_path / "leanplum.db")) as connection:
+            connection.execute('DELETE FROM "leanplum.sessions_v1"')
+
+        get_schema_fingerprint = LocalExporter.get_schema_fingerprint
+        with patch.object(LocalExporter, "get_schema_fingerprint", autospec=True,
+                          side_effect=lambda exporter, data_type: (
+                              "changed" if data_type == "sessions"
+                              else get_schema_fingerprint(exporter, data_type))):
+            with patch.object(LocalExporter, failing_step, side_effect=IOError("interrupted")):
+                with pytest.raises(IOError):
+                    local_export()
+            local_export()
+
+        assert count_rows("sessions_v1") == 60
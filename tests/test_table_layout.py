@@ -0,0 +1,185 @@
+import datetime
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+from click.testing import CliRunner
+from google.cloud import bigquery, exceptions
+
+from leanplum_data_export.__main__ import main
+from leanplum_data_export.export import LeanplumExporter
+from leanplum_data_export.run_state import EventDateRanges
+
+
+@pytest.fixture
+def exporter():
+    exporter = LeanplumExporter("projectId", partition_by={"sessions": "start"},
+                                cluster_by={"states": ["stateId"], "events": []})
+    exporter.bq_client = Mock()
+    return exporter
+
+
+@pytest.fixture
+def event_dates():
+    blob = Mock()
+    blob.download_as_string.side_effect = exceptions.NotFound("event_dates.json")
+    return EventDateRanges.load(Mock(**{"bucket.return_value.blob.return_value": blob}),
+                                "bucket", "event_dates.json")
+
+
+class TestTableLayout(object):
+
+    def test_default_layout(self):
+        exporter = LeanplumExporter("projectId")
+
+        assert exporter.get_table_layout_sql("events") == \
+            "PARTITION BY load_date CLUSTER BY eventName, sessionId"
+        assert exporter.get_table_layout_sql("experiments") == "PARTITION BY load_date"
+
+    def test_configured_layout(self, exporter):
+        assert exporter.get_table_layout_sql("sessions") == \
+            "PARTITION BY DATE(start) CLUSTER BY userId"
+        assert exporter.get_table_layout_sql("states") == \
+            "PARTITION BY load_date CLUSTER BY stateId"
+        assert exporter.get_table_layout_sql("events") == "PARTITION BY load_date"
+
+        partitioning = exporter.get_time_partitioning("sessions")
+        assert partitioning.field == "start"
+        assert partitioning.type_ == bigquery.TimePartitioningType.DAY
+
+    @pytest.mark.parametrize("partition_by,cluster_by", [
+        ({"sessions": "userId"}, None),
+        ({"sessions": "unknown"}, None),
+        (None, {"events": ["unknown"]}),
+        (None, {"sessions": ["lat"]}),
+        (None, {"sessions": ["userId", "country", "region", "city", "locale"]}),
+    ])
+    def test_invalid_layout(self, partition_by, cluster_by):
+        with pytest.raises(ValueError):
+            LeanplumExporter("projectId", partition_by=partition_by, cluster_by=cluster_by)
+
+    def test_create_table(self, exporter):
+        exporter.get_table_exists = Mock(return_value=False)
+        exporter.run_query = Mock()
+
+        exporter.load_tables("ext", "dataset", "prefix", ["sessions"], "1", "20200601")
+
+        sql = exporter.run_query.call_args[0][0]
+        assert sql.startswith("CREATE TABLE `dataset.prefix_sessions_v1` "
+                              "PARTITION BY DATE(start) CLUSTER BY userId AS SELECT")
+
+    def test_existing_table_is_reclustered(self, exporter):
+        exporter.get_table_exists = Mock(return_value=True)
+        exporter.run_query = Mock()
+        table = exporter.bq_client.get_table.return_value
+        table.clustering_fields = ["eventName", "sessionId"]
+        table.time_partitioning = bigquery.TimePartitioning(field="load_date")
+
+        exporter.load_tables("ext", "dataset", "prefix", ["events"], "1", "20200601")
+
+        assert table.clustering_fields is None
+        exporter.bq_client.update_table.assert_called_once_with(table, ["clustering_fields"])
+        assert exporter.run_query.call_args[0][0].startswith(
+            "INSERT INTO `dataset.prefix_events_v1`")
+
+    def test_existing_table_with_same_layout(self, exporter):
+        exporter.get_table_exists = Mock(return_value=True)
+        exporter.run_query = Mock()
+        table = exporter.bq_client.get_table.return_value
+        table.clustering_fields = ["stateId"]
+        table.time_partitioning = bigquery.TimePartitioning(field="load_date")
+
+        exporter.load_tables("ext", "dataset", "prefix", ["states"], "1", "20200601")
+
+        exporter.bq_client.update_table.assert_not_called()
+
+    def test_delete_by_event_time(self, exporter, event_dates):
+        exporter.run_query = Mock()
+        event_dates.extend("sessions", "2020-05-30", "2020-05-31")
+        exporter.bq_client.query.return_value.result.return_value = [
+            Mock(first_date=datetime.date(2020, 5, 31), last_date=datetime.date(2020, 6, 1))]
+
+        exporter.delete_existing_data("leanplum", "", ["sessions", "states"], 1, "20200601",
+                                      event_dates=event_dates)
+
+        sessions_sql, states_sql = [args[0][0] for args in exporter.run_query.call_args_list]
+        assert "FROM `tmp.leanplum_sessions_v1_20200601`" in \
+            exporter.bq_client.query.call_args[0][0]
+        assert sessions_sql.endswith(
+            "AND (start IS NULL OR DATE(start) BETWEEN '2020-05-30' AND '2020-06-01')")
+        assert states_sql.endswith("WHERE load_date = PARSE_DATE('%Y%m%d', '20200601')")
+        assert event_dates.get("sessions") == ("2020-05-30", "2020-06-01")
+
+    def test_delete_by_event_time_without_data(self, exporter, event_dates):
+        exporter.run_query = Mock()
+        event_dates.extend("sessions", "2020-06-01", "2020-06-01")
+        exporter.bq_client.query.return_value.result.return_value = [
+            Mock(first_date=None, last_date=None)]
+
+        exporter.delete_existing_data("leanplum", "", ["sessions"], 1, "20200601",
+                                      event_dates=event_dates)
+
+        assert exporter.run_query.call_args[0][0].endswith(
+            "AND (start IS NULL OR DATE(start) BETWEEN '2020-06-01' AND '2020-06-01')")
+
+    def test_delete_narrower_reload(self, exporter, event_dates):
+        exporter.run_query = Mock()
+        exporter.get_table_exists = Mock(return_value=False)
+        exporter.bq_client.query.return_value.result.return_value = [
+            Mock(first_date=datetime.date(2020, 5, 28), last_date=datetime.date(2020, 6, 1))]
+        exporter.delete_existing_data("leanplum", "", ["sessions"], 1, "20200601",
+                                      event_dates=event_dates)
+
+        # e.g. a rebuild coerced the oldest start times to NULL
+        exporter.get_table_exists.return_value = True
+        exporter.bq_client.query.return_value.result.return_value = [
+            Mock(first_date=datetime.date(2020, 5, 31), last_date=datetime.date(2020, 6, 1))]
+        exporter.delete_existing_data("leanplum", "", ["sessions"], 1, "20200601",
+                                      event_dates=event_dates)
+
+        assert exporter.run_query.call_args[0][0].endswith(
+            "AND (start IS NULL OR DATE(start) BETWEEN '2020-05-28' AND '2020-06-01')")
+        assert json.loads(event_dates.blob.upload_from_string.call_args[0][0]) == {
+            "sessions": ["2020-05-28", "2020-06-01"]}
+
+    def test_delete_by_event_time_without_recorded_dates(self, exporter, event_dates):
+        exporter.run_query = Mock()
+        exporter.bq_client.query.return_value.result.return_value = [
+            Mock(first_date=datetime.date(2020, 5, 31), last_date=datetime.date(2020, 6, 1))]
+
+        exporter.delete_existing_data("leanplum", "", ["sessions"], 1, "20200601",
+                                      event_dates=event_dates)
+
+        # rows loaded before the dates were recorded can be in any partition
+        assert exporter.run_query.call_args[0][0].endswith(
+            "WHERE load_date = PARSE_DATE('%Y%m%d', '20200601')")
+        assert event_dates.get("sessions") == ("2020-05-31", "2020-06-01")
+
+    def test_append_records_event_dates(self, exporter, event_dates):
+        for method in ["create_external_tables", "load_tables", "drop_external_tables"]:
+            setattr(exporter, method, Mock())
+        exporter.get_event_dates = Mock(return_value=event_dates)
+        exporter.bq_client.query.return_value.result.return_value = [
+            Mock(first_date=datetime.date(2020, 6, 1), last_date=datetime.date(2020, 6, 2))]
+
+        exporter.append("20200601", ["dev/20200601/export-0-output-0"], "gcs", "dev",
+                        "leanplum", "", "1")
+
+        assert event_dates.get("sessions") == ("2020-06-01", "2020-06-02")
+        assert event_dates.get("states") is None
+
+    def test_cli_options(self):
+        with patch("leanplum_data_export.export.LeanplumExporter.__init__",
+                   return_value=None) as mock_init, \
+                patch("leanplum_data_export.export.LeanplumExporter.export"):
+            result = CliRunner().invoke(main, [
+                "export-leanplum", "--date", "20200601", "--bucket", "bucket",
+                "--bq-dataset", "dataset", "--project", "project", "--s3-bucket", "s3-bucket",
+                "--partition-by", "sessions=start", "--cluster-by", "events=eventName, eventId",
+                "--cluster-by", "states=",
+            ])
+
+        assert result.exit_code == 0, result.output
+        assert mock_init.call_args[1]["partition_by"] == {"sessions": "start"}
+        assert mock_init.call_args[1]["cluster_by"] == {
+            "events": ["eventName", "eventId"], "states": []}
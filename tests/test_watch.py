@@ -0,0 +1,192 @@
+import queue
+import threading
+import time
+from unittest.mock import Mock
+
+from leanplum_data_export.local import LocalExporter
+from leanplum_data_export.synthetic import write_ndjson
+from leanplum_data_export.watch import FileWatcher, get_notification_keys
+
+DATE = "20200601"
+
+
+def get_watcher(tmp_path, source_dir, **kwargs):
+    exporter = LocalExporter(str(tmp_path / "leanplum.db"))
+    return FileWatcher(exporter, source_dir, str(tmp_path / "stage"), "dev", "leanplum", "", "1",
+                       **kwargs)
+
+
+class TestNotifications(object):
+
+    def test_event_notification(self):
+        message = {"Records": [
+            {"s3": {"object": {"key": "dev/20200601/export-1%3A2-output-0", "size": 42}}},
+            {"eventSource": "aws:sqs"},
+        ]}
+
+        assert get_notification_keys(message) == [("dev/20200601/export-1:2-output-0", 42)]
+
+    def test_key(self):
+        assert get_notification_keys("dev/20200601/export-1-output-0") == [
+            ("dev/20200601/export-1-output-0", 0)]
+
+
+class TestFileWatcher(object):
+
+    def test_default_dates(self, tmp_path, source_dir):
+        watcher = get_watcher(tmp_path, source_dir)
+
+        yesterday, today = watcher.get_dates()
+
+        assert len(today) == 8 and yesterday < today
+
+    def test_poll(self, tmp_path, source_dir, count_rows):
+        now = [0.0]
+        watcher = get_watcher(tmp_path, source_dir, dates=[DATE, "20200602"],
+                              load_interval=100, clock=lambda: now[0])
+        watcher.next_load = 100
+
+        watcher.run_once()
+        # converted and recorded, but not loaded before the load interval
+        assert watcher.histories[DATE] == {f"export-0-output-{i}" for i in range(3)}
+        assert set(watcher.pending) == {DATE}
+        assert watcher.get_new_files() == {}
+
+        write_ndjson(f"{source_dir}/dev/{DATE}/export-0-output-3", 5, seed=1)
+        now[0] = 100
+        watcher.run_once()
+
+        assert count_rows("sessions_v1") == 65
+        assert watcher.pending == {}
+        assert watcher.next_load == 200
+
+        # nothing new, nothing is loaded again
+        watcher.exporter.load_tables = Mock()
+        now[0] = 200
+        watcher.run_once()
+        watcher.exporter.load_tables.assert_not_called()
+
+    def test_load_picks_up_files_since_poll(self, tmp_path, source_dir, count_rows):
+        watcher = get_watcher(tmp_path, source_dir, dates=[DATE])
+        watcher.convert(watcher.get_new_files())
+        write_ndjson(f"{source_dir}/dev/{DATE}/export-0-output-3", 5, seed=1)
+
+        watcher.load()
+
+        assert count_rows("sessions_v1") == 65
+        assert watcher.get_new_files() == {}
+
+    def test_later_loads_append(self, tmp_path, source_dir, count_rows):
+        watcher = get_watcher(tmp_path, source_dir, dates=[DATE])
+        watcher.convert(watcher.get_new_files())
+        watcher.load()
+        assert count_rows("sessions_v1") == 60
+
+        write_ndjson(f"{source_dir}/dev/{DATE}/export-0-output-3", 5, seed=1)
+        watcher.exporter.export = Mock(wraps=watcher.exporter.export)
+        watcher.convert(watcher.get_new_files())
+        watcher.load()
+
+        # only the new file is loaded
+        watcher.exporter.export.assert_not_called()
+        assert count_rows("sessions_v1") == 65
+        assert watcher.appended == {DATE}
+
+        # the final load exports the date again
+        watcher.load(final=True)
+
+        watcher.exporter.export.assert_called_once()
+        assert count_rows("sessions_v1") == 65
+        assert watcher.appended == set() and watcher.loaded == set()
+
+    def test_failed_append_exports_again(self, tmp_path, source_dir, count_rows):
+        watcher = get_watcher(tmp_path, source_dir, dates=[DATE])
+        watcher.convert(watcher.get_new_files())
+        watcher.load()
+        write_ndjson(f"{source_dir}/dev/{DATE}/export-0-output-3", 5, seed=1)
+        watcher.convert(watcher.get_new_files())
+        append = watcher.exporter.append
+        watcher.exporter.append = Mock(side_effect=IOError("BigQuery is down"))
+
+        watcher.run_once()
+        assert watcher.loaded == set()
+
+        watcher.exporter.append = append
+        watcher.load()
+
+        assert count_rows("sessions_v1") == 65
+        assert watcher.loaded == {DATE}
+
+    def test_unwatched_dates_are_exported(self, tmp_path, source_dir, count_rows):
+        watcher = get_watcher(tmp_path, source_dir, dates=[DATE])
+        watcher.convert(watcher.get_new_files())
+        watcher.load()
+        write_ndjson(f"{source_dir}/dev/{DATE}/export-0-output-3", 5, seed=1)
+        watcher.convert(watcher.get_new_files())
+        watcher.load()
+        watcher.exporter.export = Mock(wraps=watcher.exporter.export)
+
+        watcher.dates = ["20200602"]
+        watcher.load()
+
+        watcher.exporter.export.assert_called_once()
+        assert count_rows("sessions_v1") == 65
+        assert watcher.appended == set()
+
+    def test_failure_is_retried(self, tmp_path, source_dir, count_rows):
+        watcher = get_watcher(tmp_path, source_dir, dates=[DATE])
+        watcher.next_load = float("inf")
+        convert_files = watcher.exporter.convert_files
+        watcher.exporter.convert_files = Mock(side_effect=IOError("S3 is down"))
+
+        watcher.run_once()
+        assert watcher.pending == {DATE: set()}
+        assert watcher.histories[DATE] == set()
+
+        watcher.exporter.convert_files = convert_files
+        watcher.load()
+
+        assert count_rows("sessions_v1") == 60
+
+    def test_notifications(self, tmp_path, source_dir):
+        notifications = queue.Queue()
+        watcher = get_watcher(tmp_path, source_dir, notifications=notifications,
+                              poll_interval=0.01)
+        notifications.put({"Records": [
+            {"s3": {"object": {"key": f"dev/{DATE}/export-0-output-0", "size": 10}}}]})
+        notifications.put(f"dev/{DATE}/export-0-output-0")
+        notifications.put(f"other/{DATE}/export-0-output-1")
+
+        new_files = watcher.get_new_files()
+
+        assert new_files == {DATE: [f"dev/{DATE}/export-0-output-0"]}
+        assert watcher.exporter.data_file_sizes[f"dev/{DATE}/export-0-output-0"] == 10
+
+    def test_notifications_forget_unwatched_histories(self, tmp_path, source_dir):
+        notifications = queue.Queue()
+        watcher = get_watcher(tmp_path, source_dir, notifications=notifications,
+                              poll_interval=0.01, dates=[DATE])
+        watcher.histories = {DATE: set(), "20200530": set(), "20200531": set()}
+        watcher.pending = {"20200531": {"dev/20200531/export-0-output-0"}}
+
+        watcher.get_new_files()
+
+        assert set(watcher.histories) == {DATE, "20200531"}
+
+    def test_run_until_stopped(self, tmp_path, source_dir, count_rows):
+        notifications = queue.Queue()
+        watcher = get_watcher(tmp_path, source_dir, notifications=notifications,
+                              poll_interval=0.01, load_interval=3600)
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+
+        notifications.put(f"dev/{DATE}/export-0-output-0")
+        notifications.put(f"dev/{DATE}/export-0-output-1")
+        while len(watcher.histories.get(DATE, ())) < 2:
+            time.sleep(0.01)
+        watcher.stop()
+        thread.join(timeout=30)
+
+        # stopping loads the date, with the file that wasn't notified
+        assert not thread.is_alive()
+        assert count_rows("sessions_v1") == 60